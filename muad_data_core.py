@@ -0,0 +1,2925 @@
+# Muad'Data core - map storage, out-of-core processing, map algebra, calibration and the tile server
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import os
+import re
+import ast
+import io
+import json
+import queue
+import hashlib
+import threading
+import time
+import itertools
+import weakref
+import struct
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from scipy import ndimage
+
+# File types accepted by every matrix loader
+MATRIX_FILETYPES = [("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("NumPy binary", "*.npy")]
+MATRIX_EXTENSIONS = ('.xlsx', '.csv', '.npy')
+
+# Parsed spreadsheets are cached here in NumPy binary format
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".muaddata", "cache")
+
+# Batch Map Math keeps track of finished files here so interrupted runs can resume
+BATCH_MANIFEST_NAME = "muaddata_batch_math.json"
+
+# Loaded maps are stored in single precision, half the memory of float64
+STORAGE_DTYPE = np.float32
+# Rounding to single precision may move a value by at most this fraction of the map's value range
+STORAGE_TOLERANCE = 1e-5
+
+# Integer types for whole-number counts float32 cannot hold exactly, smallest first
+STORAGE_INTEGER_DTYPES = (np.uint32, np.int32)
+
+class StorageCheck:
+    """Chooses how a map is stored, from its values seen tile by tile.
+
+    Maps are stored as STORAGE_DTYPE unless that loses significant precision:
+    values outside the float32 range, rounding by more than STORAGE_TOLERANCE
+    of the map's value range (a small signal on a large offset), or integer
+    counts above 2**24, which float32 no longer holds exactly. Such counts
+    are stored as a 32-bit integer type instead when the map has no empty
+    cells; integer types cannot hold NaN. empty may be set by callers that
+    know better which cells are empty (e.g. NaN in columns they will drop).
+    """
+
+    def __init__(self):
+        self.lo, self.hi = np.inf, -np.inf
+        self.worst = 0.0
+        self.integral = True
+        self.empty = False
+
+    def add(self, tile):
+        values = np.asarray(tile, dtype=float)
+        finite = np.isfinite(values)
+        self.empty = self.empty or not finite.all()
+        values = values[finite]
+        if not values.size or self.worst == np.inf:
+            return
+        with np.errstate(over='ignore'):
+            rounded = values.astype(STORAGE_DTYPE)
+        self.lo, self.hi = min(self.lo, float(values.min())), max(self.hi, float(values.max()))
+        self.worst = max(self.worst, float(np.abs(rounded - values).max()))
+        self.integral = self.integral and bool(np.all(values == np.rint(values)))
+
+    def result(self):
+        """Return (dtype, reason): reason says why the map has to stay float64, or is None."""
+        if not self.worst:
+            return STORAGE_DTYPE, None
+        if self.worst == np.inf:
+            return np.float64, "values exceed the single-precision range"
+        if self.integral:
+            if self.empty:
+                return np.float64, (f"integer counts up to {max(abs(self.lo), abs(self.hi)):.0f} are not exact in single "
+                                    "precision, and an integer type cannot hold the map's empty cells")
+            for dtype in STORAGE_INTEGER_DTYPES:
+                if np.iinfo(dtype).min <= self.lo and self.hi <= np.iinfo(dtype).max:
+                    return dtype, None
+            return np.float64, "integer counts exceed the 32-bit range"
+        if self.worst > STORAGE_TOLERANCE * ((self.hi - self.lo) or max(abs(self.lo), abs(self.hi))):
+            return np.float64, (f"single precision changes values by up to {self.worst:.3g}, "
+                                f"on a value range of only {self.hi - self.lo:.3g}")
+        return STORAGE_DTYPE, None
+
+def is_compact(mat):
+    """Return True if mat is already in a storage type chosen by StorageCheck (not float64)."""
+    return mat.dtype == STORAGE_DTYPE or mat.dtype in STORAGE_INTEGER_DTYPES
+
+def compact_matrix(mat):
+    """Return (mat in the type StorageCheck chooses, reason it stayed float64 or None)."""
+    mat = np.asarray(mat)
+    if is_compact(mat):
+        return mat, None
+    mat = np.asarray(mat, dtype=float)
+    check = StorageCheck()
+    for rows in iter_tiles(mat):
+        check.add(mat[rows])
+    dtype, reason = check.result()
+    return (mat, reason) if reason else (mat.astype(dtype), None)
+
+def working_dtype(*mats):
+    """Dtype for a map computed from mats: single precision if they all are, otherwise float64.
+
+    Integer-stored counts give float64, the only float type that holds them exactly.
+    """
+    return STORAGE_DTYPE if mats and all(mat.dtype == STORAGE_DTYPE for mat in mats) else np.float64
+
+def read_matrix_file(path):
+    """Read a matrix from an Excel, CSV or NumPy binary file."""
+    if path.endswith('.npy'):
+        return np.load(path)
+    if path.endswith('.xlsx'):
+        # Try different Excel engines to handle various formats
+        df = None
+        engines_to_try = ['openpyxl', 'xlrd', 'odf']
+
+        for engine in engines_to_try:
+            try:
+                df = pd.read_excel(path, header=None, engine=engine)
+                break  # If successful, break out of the loop
+            except Exception as e:
+                continue  # Try next engine
+
+        if df is None:
+            # If all engines failed, try with explicit sheet name
+            try:
+                df = pd.read_excel(path, header=None, sheet_name=0, engine='openpyxl')
+            except Exception:
+                try:
+                    df = pd.read_excel(path, header=None, sheet_name=0, engine='xlrd')
+                except Exception as e:
+                    raise Exception(f"Could not read Excel file with any engine. Please ensure the file is a valid Excel format. Error: {str(e)}")
+    else:
+        df = pd.read_csv(path, header=None)
+
+    df = df.apply(pd.to_numeric, errors='coerce').dropna(how='all').dropna(axis=1, how='all')
+    return df.to_numpy(dtype=float)
+
+def save_matrix_binary(path, mat):
+    """Write a matrix in NumPy binary format, atomically replacing any existing file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(mat))
+    os.replace(tmp_path, path)
+
+def decimal_values(mat):
+    """Return mat as float64 holding the shortest decimal of each float32 value, for Excel exports.
+
+    Widening float32 directly would write 0.1 as 0.10000000149011612.
+    """
+    mat = np.asarray(mat)
+    return mat.astype(str).astype(float) if mat.dtype == STORAGE_DTYPE else mat
+
+def cached_matrix_path(path):
+    """Return the binary cache file for a source file (keyed by path, mtime and size)."""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+def load_matrix(path, notes=None):
+    """Load a matrix file, reading spreadsheets through the binary cache.
+
+    Maps are stored in the type StorageCheck chooses; when that is float64
+    the reason is appended to notes, if given.
+    """
+    if path.endswith('.npy'):
+        mat, reason = compact_matrix(read_matrix_file(path))
+    else:
+        cache_path = cached_matrix_path(path)
+        mat = None
+        if os.path.exists(cache_path):
+            try:
+                mat = np.load(cache_path)
+            except Exception:
+                pass  # Damaged cache entry, parse the source again
+        if mat is not None and is_compact(mat):
+            return mat
+        # float64 cache entries are checked again, since they are kept only when float32 loses precision
+        cached = mat is not None
+        mat, reason = compact_matrix(read_matrix_file(path) if mat is None else mat)
+        if not cached or is_compact(mat):
+            try:
+                save_matrix_binary(cache_path, mat)
+            except OSError:
+                pass  # Caching is best effort
+    if reason and notes is not None:
+        notes.append(reason)
+    return mat
+
+def parse_element_name(file_name):
+    """Extract the element label from an export name like 'Sample1 Zn66_ppm.xlsx'."""
+    elem = next((part for part in file_name.split() if any(e in part for e in ['ppm', 'CPS'])), 'Unknown')
+    return elem.split('_')[0]
+
+def parse_dataset_root(file_name):
+    """Extract the dataset (sample) name, the first word of the file name."""
+    return file_name.split()[0]
+
+def validate_expression(expression):
+    """Raise an exception if a Map Math expression cannot be evaluated."""
+    eval(expression, {"__builtins__": {}}, {"x": 1.0, "np": np})
+
+def apply_expression(mat, expression):
+    """Apply a Map Math expression to the non-empty cells of a matrix and return a new matrix."""
+    result_mat = np.array(mat, dtype=working_dtype(mat))
+    # Cells with values > 0 are considered non-empty, everything else is left untouched
+    non_empty_mask = (result_mat > 0) & ~np.isnan(result_mat)
+    values = eval(expression, {"__builtins__": {}}, {"x": result_mat[non_empty_mask], "np": np})
+    result_mat[non_empty_mask] = values
+    return result_mat
+
+def list_matrix_files(directory):
+    """List the matrix files in a directory, skipping Excel lock files."""
+    names = sorted(os.listdir(directory))
+    return [os.path.join(directory, n) for n in names
+            if n.lower().endswith(MATRIX_EXTENSIONS) and not n.startswith('~$')]
+
+def natural_sort_key(text):
+    """Sort key that orders embedded numbers numerically, so 'line2' comes before 'line10'."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', text)]
+
+def parse_expression_table(text):
+    """Parse 'Element: expression' lines into a dict, validating every expression."""
+    table = {}
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if ':' not in line:
+            raise ValueError(f"Line {line_no}: expected 'Element: expression', got '{line}'")
+        elem, expression = (part.strip() for part in line.split(':', 1))
+        try:
+            validate_expression(expression)
+        except Exception as e:
+            raise ValueError(f"Line {line_no} ({elem}): {e}")
+        table[elem] = expression
+    return table
+
+def plan_batch_math(paths, expression, expression_table, output_dir):
+    """Return (source, output, expression) jobs; files without an expression are skipped."""
+    jobs = []
+    for path in paths:
+        file_name = os.path.basename(path)
+        file_expression = expression_table.get(parse_element_name(file_name), expression)
+        if not file_expression:
+            continue
+        output_path = os.path.join(output_dir, os.path.splitext(file_name)[0] + "_math.npy")
+        jobs.append((path, output_path, file_expression))
+    return jobs
+
+def _batch_manifest_entry(source, expression):
+    st = os.stat(source)
+    return {"source": os.path.abspath(source), "mtime_ns": st.st_mtime_ns, "size": st.st_size, "expression": expression}
+
+def _run_batch_math_job(source, output_path, expression):
+    # Runs in a worker process
+    result_mat = apply_expression(load_matrix(source), expression)
+    save_matrix_binary(output_path, result_mat)
+    return result_mat.shape
+
+def run_batch_math(jobs, output_dir, max_workers=None, progress=None, cancel_event=None):
+    """Run Map Math jobs in a process pool.
+
+    Finished files are recorded in a manifest in the output directory, so a rerun
+    after an interruption only processes files that are missing or out of date.
+    progress(done, total, message) is called after every file.
+    Returns a dict with 'done', 'skipped' and 'failed' lists.
+    """
+    manifest_path = os.path.join(output_dir, BATCH_MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+    def write_manifest():
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+
+    summary = {'done': [], 'skipped': [], 'failed': []}
+    pending = []
+    for source, output_path, expression in jobs:
+        key = os.path.basename(output_path)
+        if manifest.get(key) == _batch_manifest_entry(source, expression) and os.path.exists(output_path):
+            summary['skipped'].append(source)
+        else:
+            pending.append((source, output_path, expression))
+
+    total = len(jobs)
+    done = len(summary['skipped'])
+    if progress:
+        progress(done, total, f"{done} file(s) already up to date")
+    if not pending:
+        return summary
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_batch_math_job, *job): job for job in pending}
+        for future in as_completed(futures):
+            source, output_path, expression = futures[future]
+            done += 1
+            try:
+                future.result()
+                manifest[os.path.basename(output_path)] = _batch_manifest_entry(source, expression)
+                write_manifest()
+                summary['done'].append(source)
+                message = f"{os.path.basename(source)} -> {os.path.basename(output_path)}"
+            except Exception as e:
+                summary['failed'].append((source, str(e)))
+                message = f"{os.path.basename(source)} failed: {e}"
+            if progress:
+                progress(done, total, message)
+            if cancel_event is not None and cancel_event.is_set():
+                for f in futures:
+                    f.cancel()
+                break
+    return summary
+
+# Raw time-resolved exports, one file per laser line
+LINE_SCAN_EXTENSIONS = ('.csv', '.txt')
+
+def list_line_scan_files(directory):
+    """List the raw line files in a directory in acquisition order (natural sort of the names)."""
+    names = [n for n in os.listdir(directory) if n.lower().endswith(LINE_SCAN_EXTENSIONS) and not n.startswith('.')]
+    return [os.path.join(directory, n) for n in sorted(names, key=natural_sort_key)]
+
+def read_line_scan(path):
+    """Read one raw line export and return (time, isotopes, counts).
+
+    The header is the first row starting with 'Time'; instrument metadata above
+    it and footer text below the data are ignored. counts has one column per
+    isotope, in CPS.
+    """
+    with open(path, errors='replace') as f:
+        lines = f.readlines()
+    header = next((i for i, line in enumerate(lines) if line.lstrip().strip('"').lower().startswith('time')), None)
+    if header is None:
+        raise ValueError("No 'Time' column header found.")
+    df = pd.read_csv(io.StringIO(''.join(lines[header:])), header=0, skip_blank_lines=True)
+    df = df.apply(pd.to_numeric, errors='coerce').dropna(axis=1, how='all')
+    data = df.to_numpy(dtype=float)
+    data = data[~np.isnan(data[:, 0])]
+    if data.shape[1] < 2 or not len(data):
+        raise ValueError("No isotope columns with numeric data found.")
+    isotopes = [str(name).strip() for name in df.columns[1:]]
+    return data[:, 0], isotopes, data[:, 1:]
+
+def bin_line_scan(time, counts, pixel_time, blank_seconds, start_seconds, n_pixels=None):
+    """Subtract the gas blank from a line and average its samples into pixels.
+
+    The blank is the per-isotope median of the samples before blank_seconds.
+    Samples from start_seconds on fall into pixels of pixel_time seconds
+    (spot size / scan speed). All isotopes are binned together from one
+    cumulative sum; pixels without samples are NaN. Returns (pixels, isotopes).
+    """
+    blank = counts[time < blank_seconds]
+    background = np.nanmedian(blank, axis=0) if len(blank) else np.zeros(counts.shape[1])
+    keep = time >= start_seconds
+    index = np.floor((time[keep] - start_seconds) / pixel_time).astype(np.intp)
+    values = counts[keep]
+    if len(index) and np.any(np.diff(index) < 0):
+        order = np.argsort(index, kind='stable')
+        index, values = index[order], values[order]
+    if n_pixels is None:
+        n_pixels = int(index[-1]) + 1 if len(index) else 0
+
+    valid = ~np.isnan(values)
+    sums = np.zeros((len(values) + 1, values.shape[1]))
+    np.cumsum(np.where(valid, values, 0.0), axis=0, out=sums[1:])
+    samples = np.zeros((len(values) + 1, values.shape[1]))
+    np.cumsum(valid, axis=0, out=samples[1:])
+    edges = np.searchsorted(index, np.arange(n_pixels + 1))
+    totals = sums[edges[1:]] - sums[edges[:-1]]
+    n = samples[edges[1:]] - samples[edges[:-1]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pixels = np.where(n > 0, totals / n, np.nan)
+    return pixels - background
+
+def _bin_line_scan_file(path, pixel_time, blank_seconds, start_seconds, n_pixels):
+    # Runs in a worker process
+    time, isotopes, counts = read_line_scan(path)
+    return isotopes, bin_line_scan(time, counts, pixel_time, blank_seconds, start_seconds, n_pixels)
+
+def ingest_line_scans(paths, output_dir, sample, spot_size, scan_speed, blank_seconds, start_seconds=None,
+                      n_pixels=None, max_workers=None, progress=None):
+    """Build one map per isotope from raw line files (one file per row, in order).
+
+    Lines are blank-subtracted and binned in a process pool; shorter lines are
+    padded with NaN to the longest one unless n_pixels fixes the width. Each
+    map is written to output_dir as '<sample> <isotope>_CPS.npy', which both
+    tabs load directly. progress(done, total, message) is called after every
+    line. Returns the written paths.
+    """
+    if not paths:
+        raise ValueError("No line files to ingest.")
+    if spot_size <= 0 or scan_speed <= 0:
+        raise ValueError("Spot size and scan speed must be greater than 0.")
+    pixel_time = spot_size / scan_speed
+    start_seconds = blank_seconds if start_seconds is None else start_seconds
+    sample = '_'.join(sample.split()) or 'Sample'
+
+    rows = [None] * len(paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_bin_line_scan_file, path, pixel_time, blank_seconds, start_seconds, n_pixels): i
+                   for i, path in enumerate(paths)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                rows[i] = future.result()
+            except Exception as e:
+                for f in futures:
+                    f.cancel()
+                raise ValueError(f"{os.path.basename(paths[i])}: {e}") from e
+            if progress:
+                progress(done, len(paths), os.path.basename(paths[i]))
+
+    isotopes = rows[0][0]
+    for path, (line_isotopes, _) in zip(paths, rows):
+        if line_isotopes != isotopes:
+            raise ValueError(f"{os.path.basename(path)} does not have the same isotopes as {os.path.basename(paths[0])}.")
+    width = max(pixels.shape[0] for _, pixels in rows)
+    outputs = []
+    for k, isotope in enumerate(isotopes):
+        mat = np.full((len(rows), width), np.nan)
+        for r, (_, pixels) in enumerate(rows):
+            mat[r, :pixels.shape[0]] = pixels[:, k]
+        isotope = re.sub(r'[^\w.+-]', '', isotope) or f"mass{k + 1}"
+        output_path = os.path.join(output_dir, f"{sample} {isotope}_CPS.npy")
+        # Written in storage precision, so large maps can be memory-mapped as they will be held
+        save_matrix_binary(output_path, compact_matrix(mat)[0])
+        outputs.append(output_path)
+    return outputs
+
+def density_histogram(x_mat, y_mat, bins=256):
+    """Bin paired pixel values of two maps into a 2D histogram in one vectorized pass.
+
+    Returns (hist, x_edges, y_edges, bin_index). hist[ix, iy] counts pixels, and
+    bin_index maps every pixel to its flat bin ix * bins + iy, or to bins * bins
+    for pixels with a NaN in either map, so brushing can look pixels up per bin.
+    """
+    x = np.asarray(x_mat, dtype=float).ravel()
+    y = np.asarray(y_mat, dtype=float).ravel()
+    valid = np.isfinite(x) & np.isfinite(y)
+    if not valid.any():
+        raise ValueError("The two maps have no pixels with values in common.")
+    x_min, x_max = x[valid].min(), x[valid].max()
+    y_min, y_max = y[valid].min(), y[valid].max()
+    x_span = (x_max - x_min) or 1.0
+    y_span = (y_max - y_min) or 1.0
+
+    ix = np.zeros(x.shape, dtype=np.int64)
+    iy = np.zeros(y.shape, dtype=np.int64)
+    ix[valid] = np.minimum(((x[valid] - x_min) * (bins / x_span)).astype(np.int64), bins - 1)
+    iy[valid] = np.minimum(((y[valid] - y_min) * (bins / y_span)).astype(np.int64), bins - 1)
+    bin_index = ix * bins + iy
+    bin_index[~valid] = bins * bins
+
+    hist = np.bincount(bin_index, minlength=bins * bins + 1)[:bins * bins].reshape(bins, bins)
+    x_edges = np.linspace(x_min, x_min + x_span, bins + 1)
+    y_edges = np.linspace(y_min, y_min + y_span, bins + 1)
+    return hist, x_edges, y_edges, bin_index
+
+def correlation_coefficients(x_mat, y_mat):
+    """Return (pearson, spearman, n) over the pixels where both maps have values."""
+    from scipy.stats import rankdata
+
+    x = np.asarray(x_mat, dtype=float).ravel()
+    y = np.asarray(y_mat, dtype=float).ravel()
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if len(x) < 2:
+        return np.nan, np.nan, len(x)
+
+    def pearson(a, b):
+        a = a - a.mean()
+        b = b - b.mean()
+        denom = np.sqrt(np.dot(a, a) * np.dot(b, b))
+        return float(np.dot(a, b) / denom) if denom > 0 else np.nan
+
+    return pearson(x, y), pearson(rankdata(x), rankdata(y)), len(x)
+
+def otsu_threshold(mat, bins=256, budget_bytes=None):
+    """Otsu's threshold for the non-NaN values of mat, from a tiled histogram.
+
+    Pixels at or above the returned value form the foreground class.
+    """
+    hist, edges = tiled_histogram(mat, bins=bins, budget_bytes=budget_bytes)
+    if not hist.sum():
+        raise ValueError("The map contains no values.")
+    centers = (edges[:-1] + edges[1:]) / 2
+    below = np.cumsum(hist).astype(float)
+    mass = np.cumsum(hist * centers)
+    above = below[-1] - below
+    with np.errstate(invalid='ignore', divide='ignore'):
+        between = below * above * (mass / below - (mass[-1] - mass) / above) ** 2
+    return float(edges[np.nanargmax(between[:-1]) + 1]) if bins > 1 else float(edges[-1])
+
+def segment_objects(mat, lo, hi=np.inf, connectivity=8, min_area=1, budget_bytes=None):
+    """Label connected groups of pixels with lo <= value <= hi.
+
+    Returns (labels, count): labels is int32 with 0 for background and objects
+    numbered 1..count. Objects smaller than min_area pixels are dropped.
+    """
+    mask = np.empty(mat.shape, dtype=bool)
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.asarray(mat[rows], dtype=float)
+        with np.errstate(invalid='ignore'):
+            mask[rows] = (tile >= lo) & (tile <= hi)
+    structure = ndimage.generate_binary_structure(2, 2 if connectivity == 8 else 1)
+    labels, count = ndimage.label(mask, structure=structure, output=np.int32)
+    if min_area > 1 and count:
+        keep = np.bincount(labels.ravel(), minlength=count + 1) >= min_area
+        keep[0] = False
+        relabel = np.zeros(count + 1, dtype=np.int32)
+        relabel[keep] = np.arange(1, int(keep.sum()) + 1)
+        labels, count = relabel[labels], int(keep.sum())
+    return labels, count
+
+# The segmentation dialog lists this many objects; the export always has all of them
+SEGMENT_TABLE_ROWS = 1000
+
+def object_statistics(labels, count, maps, pixel_size=1.0):
+    """Measure every labelled object: area, centroid, bounding box and per-map mean, sum and max.
+
+    maps is a dict of name -> matrix with the shape of labels. The labelled
+    pixels are gathered once, sorted by object, and every statistic is a
+    bincount or reduceat over them, so the cost does not grow with the number
+    of objects. NaN pixels count towards the area but not the map statistics.
+    Returns a DataFrame with one row per object.
+    """
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat)
+    object_ids = flat[pixels]
+    order = np.argsort(object_ids, kind='stable')
+    pixels, object_ids = pixels[order], object_ids[order]
+    area = np.bincount(object_ids, minlength=count + 1)[1:]
+    starts = np.concatenate([[0], np.cumsum(area)[:-1]]).astype(np.intp)
+    rows, cols = np.divmod(pixels, labels.shape[1])
+
+    table = {'object': np.arange(1, count + 1), 'area_px': area, 'area_um2': area * float(pixel_size) ** 2}
+    columns = ['centroid_row', 'centroid_col', 'row_min', 'row_max', 'col_min', 'col_max']
+    if count:
+        table['centroid_row'] = np.bincount(object_ids, rows, count + 1)[1:] / area
+        table['centroid_col'] = np.bincount(object_ids, cols, count + 1)[1:] / area
+        # Pixels are in scan order within each object, so rows are already sorted
+        table['row_min'], table['row_max'] = rows[starts], rows[starts + area - 1]
+        table['col_min'], table['col_max'] = np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts)
+    else:
+        table.update({name: np.zeros(0) for name in columns})
+    for name, mat in maps.items():
+        values = np.asarray(mat.reshape(-1)[pixels], dtype=float)
+        valid = ~np.isnan(values)
+        n = np.bincount(object_ids, valid, count + 1)[1:]
+        total = np.bincount(object_ids, np.where(valid, values, 0.0), count + 1)[1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table[f'{name}_mean'] = np.where(n > 0, total / n, np.nan)
+        table[f'{name}_sum'] = total
+        table[f'{name}_max'] = np.fmax.reduceat(values, starts) if count else np.zeros(0)
+    return pd.DataFrame(table)
+
+# Phase clustering: pixels grouped by their multi-element signature
+CLUSTER_SCALINGS = ['Log + standardize', 'Standardize']
+# Pixels kept in memory to train the cluster centres on, whatever the map size
+CLUSTER_SAMPLE_SIZE = 200_000
+
+def memmap_matrix_file(path):
+    """Open a matrix file as a read-only memory map, going through the binary cache for spreadsheets."""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.endswith('.csv'):
+        return open_out_of_core(path)
+    cache_path = cached_matrix_path(path)
+    if not os.path.exists(cache_path):
+        mat = load_matrix(path)
+        if not os.path.exists(cache_path):
+            return mat  # The binary cache could not be written
+    return np.load(cache_path, mmap_mode='r')
+
+def pixel_features(tiles, log):
+    """Stack same-shaped tiles of every element into a float32 pixel x element matrix.
+
+    Returns (features of the pixels that have a value in every element, their
+    flat indices in the tile). With log, values are log1p-compressed first
+    (negative values count as 0).
+    """
+    features = np.stack([np.asarray(tile, dtype=np.float32).ravel() for tile in tiles], axis=1)
+    valid = np.flatnonzero(~np.isnan(features).any(axis=1))
+    features = features[valid]
+    if log:
+        np.maximum(features, 0, out=features)
+        np.log1p(features, out=features)
+    return features, valid
+
+def feature_statistics(mats, log, sample_size=CLUSTER_SAMPLE_SIZE, seed=0, budget_bytes=None):
+    """One streaming pass over the maps for phase clustering.
+
+    Accumulates the mean and covariance of the pixel features (in float64,
+    so the PCA is exact however many tiles there are) and draws a uniform
+    random sample of at most sample_size pixels to train the clusters on.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(mats)
+    total = np.zeros(n)
+    products = np.zeros((n, n))
+    count = 0
+    rate = min(sample_size / max(mats[0].size, 1), 1.0)
+    samples = []
+    budget_bytes = (budget_bytes or TILE_BUDGET_BYTES) // max(n, 1)
+    for rows in iter_tiles(mats[0], budget_bytes):
+        features, _ = pixel_features([mat[rows] for mat in mats], log)
+        if not len(features):
+            continue
+        count += len(features)
+        total += features.sum(axis=0, dtype=np.float64)
+        products += features.T.astype(np.float64) @ features
+        samples.append(features[rng.random(len(features)) < rate])
+    if count < 2:
+        raise ValueError("Too few pixels have a value in every element map.")
+    mean = total / count
+    covariance = (products - count * np.outer(mean, mean)) / (count - 1)
+    return {'count': count, 'mean': mean, 'covariance': covariance, 'sample': np.concatenate(samples)}
+
+def minibatch_kmeans(data, n_clusters, batch_size=4096, max_iter=300, tol=1e-4, seed=0):
+    """Cluster centres of data by mini-batch k-means with k-means++ seeding."""
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    # k-means++ seeding on a subset
+    seeds = data[rng.choice(len(data), min(len(data), 10 * batch_size), replace=False)]
+    centres = [seeds[rng.integers(len(seeds))]]
+    closest = ((seeds - centres[0]) ** 2).sum(axis=1)
+    for _ in range(1, n_clusters):
+        centre = seeds[rng.choice(len(seeds), p=closest / closest.sum())] if closest.sum() > 0 else seeds[rng.integers(len(seeds))]
+        centres.append(centre)
+        closest = np.minimum(closest, ((seeds - centre) ** 2).sum(axis=1))
+    centres = np.array(centres, dtype=np.float64)
+    counts = np.zeros(n_clusters)
+    # Converged once no centre moves by more than tol of the data's total variance
+    scale = max(float(data.var(axis=0).sum()), 1e-12)
+    for _ in range(max_iter):
+        batch = data[rng.integers(0, len(data), min(batch_size, len(data)))].astype(np.float64)
+        nearest = nearest_centre(batch, centres)
+        batch_counts = np.bincount(nearest, minlength=n_clusters)
+        sums = np.zeros_like(centres)
+        np.add.at(sums, nearest, batch)
+        counts += batch_counts
+        moved = batch_counts > 0
+        # Each centre moves toward its batch mean with a learning rate of its share of all points seen
+        step = (sums[moved] - batch_counts[moved, None] * centres[moved]) / counts[moved, None]
+        centres[moved] += step
+        if (step ** 2).sum(axis=1).max(initial=0) < tol * scale:
+            break
+    return centres
+
+def nearest_centre(points, centres):
+    """Index of the nearest centre of every point."""
+    distance = (centres ** 2).sum(axis=1)[None, :] - 2 * points @ centres.T
+    return np.argmin(distance, axis=1)
+
+def fit_phase_model(stats, scaling, n_components, n_clusters, seed=0):
+    """PCA and k-means cluster centres for phase clustering, from feature_statistics.
+
+    Features are standardized with the streamed mean and standard deviation,
+    projected on the leading principal components of their correlation
+    matrix and clustered there. Clusters are numbered from 1 by decreasing
+    size in the training sample.
+    """
+    std = np.sqrt(np.maximum(np.diag(stats['covariance']), 0))
+    std[std == 0] = 1.0
+    correlation = stats['covariance'] / np.outer(std, std)
+    eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+    order = np.argsort(eigenvalues)[::-1][:max(min(n_components, len(std)), 1)]
+    components = eigenvectors[:, order]
+    scores = ((stats['sample'] - stats['mean']) / std) @ components
+    centres = minibatch_kmeans(scores, n_clusters, seed=seed)
+    sizes = np.bincount(nearest_centre(scores, centres), minlength=len(centres))
+    centres = centres[np.argsort(-sizes, kind='stable')]
+    explained = eigenvalues[order] / max(eigenvalues.sum(), 1e-12)
+    return {'scaling': scaling, 'mean': stats['mean'], 'std': std, 'components': components,
+            'explained': explained, 'centres': centres}
+
+def assign_phases(mats, names, model, budget_bytes=None):
+    """Label every pixel with its phase and measure the phases in the original units.
+
+    Returns (labels, table): labels is a uint8 map with 0 for pixels missing a
+    value in some element, and the table lists each phase's pixel count,
+    area fraction and mean of every element.
+    """
+    n_clusters = len(model['centres'])
+    labels = np.zeros(mats[0].shape, dtype=np.uint8)
+    pixels = np.zeros(n_clusters + 1, dtype=np.int64)
+    sums = np.zeros((len(mats), n_clusters + 1))
+    log = model['scaling'].startswith('Log')
+    budget_bytes = (budget_bytes or TILE_BUDGET_BYTES) // max(len(mats), 1)
+    for rows in iter_tiles(mats[0], budget_bytes):
+        tiles = [np.asarray(mat[rows], dtype=float) for mat in mats]
+        features, valid = pixel_features(tiles, log)
+        if not len(features):
+            continue
+        scores = ((features - model['mean']) / model['std']) @ model['components']
+        phase = nearest_centre(scores, model['centres']) + 1
+        labels[rows].reshape(-1)[valid] = phase
+        pixels += np.bincount(phase, minlength=n_clusters + 1)
+        for i, tile in enumerate(tiles):
+            sums[i] += np.bincount(phase, weights=tile.ravel()[valid], minlength=n_clusters + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = {'phase': np.arange(1, n_clusters + 1), 'pixels': pixels[1:],
+                 'fraction': pixels[1:] / max(pixels[1:].sum(), 1)}
+        for name, element_sums in zip(names, sums):
+            table[f'{name}_mean'] = element_sums[1:] / pixels[1:]
+    return labels, pd.DataFrame(table)
+
+def transect_points(vertices, width=1, step=1.0):
+    """Sample positions along a polyline of (x, y) vertices in pixel coordinates.
+
+    Returns (distance, x, y, rows, cols): the distance along the line and the
+    centre position of each sample, step pixels apart, and (width, samples)
+    coordinates of the parallel lines that are averaged across the width.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    segments = np.diff(vertices, axis=0)
+    lengths = np.hypot(segments[:, 0], segments[:, 1])
+    keep = lengths > 0
+    starts, segments, lengths = vertices[:-1][keep], segments[keep], lengths[keep]
+    if not len(lengths):
+        raise ValueError("The transect has no length.")
+    ends = np.cumsum(lengths)
+    distance = np.minimum(np.arange(0, ends[-1] + step / 2, step), ends[-1])
+    index = np.minimum(np.searchsorted(ends, distance, side='right'), len(ends) - 1)
+    along = (distance - (ends[index] - lengths[index]))[:, None] * (segments[index] / lengths[index, None])
+    x, y = starts[index, 0] + along[:, 0], starts[index, 1] + along[:, 1]
+    # Parallel lines are offset along the normal (-dy, dx) of their segment
+    normal = segments[index] / lengths[index, None]
+    offsets = (np.arange(max(int(width), 1)) - (max(int(width), 1) - 1) / 2)[:, None]
+    return distance, x, y, y[None] + offsets * normal[:, 0], x[None] - offsets * normal[:, 1]
+
+def spline_coefficients(mat):
+    """Cubic spline coefficients of a map for sample_profile, with empty (NaN) cells as 0."""
+    return ndimage.spline_filter(_nan_filled(np.asarray(mat))[0], order=3, output=working_dtype(mat))
+
+def sample_profile(mat, rows, cols, coefficients=None):
+    """Values of mat at (rows, cols), averaged over the first axis (the transect width).
+
+    With coefficients from spline_coefficients the map is sampled by cubic
+    splines; otherwise it is interpolated linearly, reading only the pixels
+    next to the points, which suits memory-mapped maps. Points outside the
+    map or nearest to an empty cell are left out of the average.
+    """
+    n_rows, n_cols = mat.shape[:2]
+    inside = (rows > -0.5) & (rows < n_rows - 0.5) & (cols > -0.5) & (cols < n_cols - 0.5)
+    nearest = np.asarray(mat[np.clip(np.rint(rows).astype(int), 0, n_rows - 1),
+                             np.clip(np.rint(cols).astype(int), 0, n_cols - 1)], dtype=float)
+    valid = inside & ~np.isnan(nearest)
+    if coefficients is not None:
+        values = ndimage.map_coordinates(coefficients, [rows, cols], order=3, mode='mirror', prefilter=False)
+    else:
+        values = ndimage.map_coordinates(mat, [rows, cols], order=1, mode='nearest', output=float)
+        # Next to an empty cell linear interpolation is undefined; the nearest value stands in
+        values = np.where(np.isnan(values), nearest, values)
+    counts = valid.sum(axis=0)
+    sums = np.where(valid, values, 0).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def phase_correlation(reference, moving, max_size=1024, upsample=20):
+    """Estimate the shift that brings moving onto reference by FFT phase correlation.
+
+    The maps are compared over the centre of their common top-left region, at
+    most max_size pixels square. The integer correlation peak is refined to
+    1/upsample pixel by evaluating the inverse transform on a fine grid around
+    it (matrix-multiply DFT), which is far cheaper than upsampling everything.
+    Returns (dy, dx, peak) such that moving[r - dy, c - dx] matches
+    reference[r, c]; peak (0-1) measures how distinct the match is.
+    """
+    rows = min(reference.shape[0], moving.shape[0])
+    cols = min(reference.shape[1], moving.shape[1])
+    h, w = min(rows, max_size), min(cols, max_size)
+    r0, c0 = (rows - h) // 2, (cols - w) // 2
+    window = np.outer(np.hanning(h), np.hanning(w)) if h > 2 and w > 2 else np.ones((h, w))
+
+    def prepare(mat):
+        tile = np.array(mat[r0:r0 + h, c0:c0 + w], dtype=float)
+        tile[np.isnan(tile)] = 0
+        return (tile - tile.mean()) * window
+
+    cross = np.fft.fft2(prepare(reference)) * np.conj(np.fft.fft2(prepare(moving)))
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.ifft2(cross).real
+    peak_r, peak_c = np.unravel_index(np.argmax(corr), corr.shape)
+    peak = float(corr[peak_r, peak_c])
+    # Peaks past the middle wrap around to negative shifts
+    dy = peak_r - h if peak_r > h / 2 else peak_r
+    dx = peak_c - w if peak_c > w / 2 else peak_c
+
+    offsets = np.arange(-upsample, upsample + 1) / upsample
+    row_kernel = np.exp(2j * np.pi * np.outer(dy + offsets, np.fft.fftfreq(h)))
+    col_kernel = np.exp(2j * np.pi * np.outer(np.fft.fftfreq(w), dx + offsets))
+    fine = (row_kernel @ cross @ col_kernel).real
+    fine_r, fine_c = np.unravel_index(np.argmax(fine), fine.shape)
+    return float(dy + offsets[fine_r]), float(dx + offsets[fine_c]), peak
+
+def resample_bilinear(mat, rows, cols):
+    """Sample mat at fractional row and column coordinates (a separable grid) by bilinear interpolation."""
+    mat = np.asarray(mat, dtype=working_dtype(mat))
+    r0 = np.clip(np.floor(rows).astype(int), 0, mat.shape[0] - 1)
+    c0 = np.clip(np.floor(cols).astype(int), 0, mat.shape[1] - 1)
+    r1 = np.minimum(r0 + 1, mat.shape[0] - 1)
+    c1 = np.minimum(c0 + 1, mat.shape[1] - 1)
+    fr = (rows - r0)[:, None].astype(mat.dtype)
+    fc = (cols - c0)[None, :].astype(mat.dtype)
+    top = mat[np.ix_(r0, c0)] * (1 - fc) + mat[np.ix_(r0, c1)] * fc
+    bottom = mat[np.ix_(r1, c0)] * (1 - fc) + mat[np.ix_(r1, c1)] * fc
+    return top * (1 - fr) + bottom * fr
+
+# Estimated shifts closer than this to whole pixels are rounded, so aligned maps are not needlessly blurred
+SUBPIXEL_TOLERANCE = 0.05
+
+def align_channels(mats, register=True):
+    """Bring channels with different shapes or offsets onto one common pixel grid.
+
+    mats maps channel names to matrices, or None for unloaded channels; the
+    first loaded channel is the reference. With register, the shift of every
+    other channel is estimated with phase_correlation, otherwise all channels
+    are taken to share their top-left corner. Each channel is then cropped to
+    the region covered by all of them, and resampled bilinearly when its shift
+    is fractional. Returns (aligned matrices, shifts).
+    """
+    names = [name for name, mat in mats.items() if mat is not None]
+    reference = mats[names[0]]
+    shifts = {}
+    for name in names:
+        dy, dx = phase_correlation(reference, mats[name])[:2] if register and name != names[0] else (0.0, 0.0)
+        shifts[name] = tuple(round(v) if abs(v - round(v)) < SUBPIXEL_TOLERANCE else v for v in (dy, dx))
+
+    # Part of the reference grid that every channel covers, including its interpolation neighbours
+    top = max(int(np.ceil(shifts[n][0])) for n in names)
+    left = max(int(np.ceil(shifts[n][1])) for n in names)
+    bottom = min(int(np.floor(shifts[n][0] + mats[n].shape[0] - 1)) + 1 for n in names)
+    right = min(int(np.floor(shifts[n][1] + mats[n].shape[1] - 1)) + 1 for n in names)
+    if bottom <= top or right <= left:
+        raise ValueError("The channels do not overlap once aligned.")
+
+    aligned = dict.fromkeys(mats)
+    for name in names:
+        mat = mats[name]
+        dy, dx = shifts[name]
+        if float(dy).is_integer() and float(dx).is_integer():
+            r0, c0 = top - int(dy), left - int(dx)
+            region = (slice(r0, r0 + bottom - top), slice(c0, c0 + right - left))
+            # Keep the original array when nothing is cropped, so its cached derived maps stay valid
+            aligned[name] = mat if mat[region].shape == mat.shape else mat[region]
+        else:
+            aligned[name] = resample_bilinear(mat, np.arange(top, bottom) - dy, np.arange(left, right) - dx)
+    return aligned, shifts
+
+# Maps whose float64 size exceeds this are opened memory-mapped instead of loaded into RAM
+OUT_OF_CORE_BYTES = 1024 ** 3
+# Working memory allowed per tile when streaming through an out-of-core map
+TILE_BUDGET_BYTES = 64 * 1024 ** 2
+# Pyramid levels are halved until the largest side fits in this many pixels
+PYRAMID_MIN_SIZE = 256
+# Out-of-core maps loaded as RGB channels use the finest pyramid level within this size
+RGB_OVERVIEW_SIZE = 4096
+
+def matrix_nbytes_on_load(path):
+    """Estimate the float64 size of a matrix file once loaded."""
+    if path.endswith('.npy'):
+        # Mapping only reads the header
+        return int(np.prod(np.load(path, mmap_mode='r').shape)) * 8
+    # Text exports take at least about as many bytes per value as float64
+    return os.path.getsize(path)
+
+def is_out_of_core_file(path):
+    """Return True if a matrix file is too large to be loaded into memory."""
+    return not path.endswith('.xlsx') and matrix_nbytes_on_load(path) > OUT_OF_CORE_BYTES
+
+def is_out_of_core(mat):
+    """Return True for memory-mapped matrices, which must be processed tile by tile."""
+    return isinstance(mat, np.memmap)
+
+def iter_tiles(mat, budget_bytes=None):
+    """Yield row-band slices of mat, each needing at most budget_bytes of float64 working memory."""
+    budget_bytes = budget_bytes or TILE_BUDGET_BYTES
+    rows = mat.shape[0]
+    row_bytes = max(int(np.prod(mat.shape[1:])) * 8, 1)
+    step = max(budget_bytes // row_bytes, 1)
+    for start in range(0, rows, step):
+        yield slice(start, min(start + step, rows))
+
+def stream_csv_to_binary(path, out_path, budget_bytes=None):
+    """Convert a large CSV export to NumPy binary format without loading it at once.
+
+    Matches read_matrix_file: non-numeric cells become NaN and all-empty rows and
+    columns are dropped. The file is read three times (row count, non-empty
+    columns, data) so only one chunk is ever held in memory. Like load_matrix
+    the output type is chosen by StorageCheck; returns the reason it is
+    float64, or None.
+    """
+    budget_bytes = budget_bytes or TILE_BUDGET_BYTES
+    with open(path) as f:
+        n_cols = len(f.readline().split(','))
+    chunk_rows = max(budget_bytes // (max(n_cols, 1) * 8), 1)
+
+    def chunks():
+        for chunk in pd.read_csv(path, header=None, chunksize=chunk_rows):
+            chunk = chunk.apply(pd.to_numeric, errors='coerce')
+            yield chunk.to_numpy(dtype=float)
+
+    n_rows = 0
+    col_mask = None
+    # The storage check rides along with the row and column count
+    check = StorageCheck()
+    nan_cols = None
+    for chunk in chunks():
+        valid = ~np.isnan(chunk)
+        kept = valid.any(axis=1)
+        n_rows += int(kept.sum())
+        col_mask = valid.any(axis=0) if col_mask is None else col_mask | valid.any(axis=0)
+        check.add(chunk[kept])
+        # Only NaN in the columns that are kept are empty cells of the map
+        holes = ~valid[kept].all(axis=0)
+        nan_cols = holes if nan_cols is None else nan_cols | holes
+    if not n_rows:
+        raise ValueError("The file contains no numeric values.")
+    check.empty = bool((nan_cols & col_mask).any())
+    dtype, reason = check.result()
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(n_rows, int(col_mask.sum())))
+    row = 0
+    for chunk in chunks():
+        chunk = chunk[~np.isnan(chunk).all(axis=1)][:, col_mask]
+        out[row:row + len(chunk)] = chunk
+        row += len(chunk)
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    return reason
+
+def open_out_of_core(path, notes=None):
+    """Open a large .npy or .csv matrix file as a read-only memory map.
+
+    .npy files are mapped as they are; CSV files are converted as in
+    stream_csv_to_binary, appending any precision note to notes.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    cache_path = cached_matrix_path(path)
+    if not os.path.exists(cache_path):
+        reason = stream_csv_to_binary(path, cache_path)
+        if reason and notes is not None:
+            notes.append(reason)
+    return np.load(cache_path, mmap_mode='r')
+
+def tiled_stats(mat, budget_bytes=None):
+    """Return min, max, mean and count of the non-NaN values, streaming tile by tile."""
+    lo, hi, total, count = np.inf, -np.inf, 0.0, 0
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.asarray(mat[rows], dtype=float)
+        valid = tile[~np.isnan(tile)]
+        if valid.size:
+            lo = min(lo, valid.min())
+            hi = max(hi, valid.max())
+            total += valid.sum()
+            count += valid.size
+    if not count:
+        return {'min': np.nan, 'max': np.nan, 'mean': np.nan, 'count': 0}
+    return {'min': float(lo), 'max': float(hi), 'mean': float(total / count), 'count': count}
+
+def tiled_histogram(mat, bins=50, value_range=None, budget_bytes=None):
+    """np.histogram over the non-NaN values of mat, accumulated tile by tile.
+
+    bins is a bin count or an array of bin edges.
+    """
+    if np.ndim(bins):
+        edges = np.asarray(bins, dtype=float)
+        hist = np.zeros(len(edges) - 1, dtype=np.int64)
+        for rows in iter_tiles(mat, budget_bytes):
+            tile = np.asarray(mat[rows], dtype=float)
+            hist += np.histogram(tile[~np.isnan(tile)], bins=edges)[0]
+        return hist, edges
+    if value_range is None:
+        stats = tiled_stats(mat, budget_bytes)
+        value_range = (stats['min'], stats['max'])
+    if not np.all(np.isfinite(value_range)):
+        return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+    edges = np.histogram_bin_edges([], bins=bins, range=value_range)
+    hist = np.zeros(bins, dtype=np.int64)
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.asarray(mat[rows], dtype=float)
+        hist += np.histogram(tile[~np.isnan(tile)], bins=edges)[0]
+    return hist, edges
+
+def tiled_percentiles(mat, percentiles, budget_bytes=None, bins=65536):
+    """Exact percentiles (linear interpolation, like np.nanpercentile) with bounded memory.
+
+    A fine histogram locates the bin holding each required rank, then only the
+    values inside those bins are collected and sorted.
+    """
+    percentiles = np.atleast_1d(np.asarray(percentiles, dtype=float))
+    hist, edges = tiled_histogram(mat, bins, budget_bytes=budget_bytes)
+    count = int(hist.sum())
+    if not count:
+        return np.full(percentiles.shape, np.nan)
+    positions = percentiles / 100.0 * (count - 1)
+    ranks = np.unique(np.concatenate([np.floor(positions), np.ceil(positions)]).astype(np.int64))
+    cumulative = np.cumsum(hist)
+    rank_bins = np.searchsorted(cumulative, ranks, side='right')
+    wanted = np.unique(rank_bins)
+
+    # Collect the values that fall into the bins containing the wanted ranks
+    collected = {b: [] for b in wanted}
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.asarray(mat[rows], dtype=float)
+        tile = tile[~np.isnan(tile)]
+        tile_bins = np.clip(np.searchsorted(edges, tile, side='right') - 1, 0, bins - 1)
+        for b in wanted:
+            collected[b].append(tile[tile_bins == b])
+    values = {}
+    for b in wanted:
+        in_bin = np.sort(np.concatenate(collected[b]))
+        first_rank = cumulative[b] - hist[b]
+        for rank, rank_bin in zip(ranks, rank_bins):
+            if rank_bin == b:
+                values[rank] = in_bin[rank - first_rank]
+
+    result = []
+    for pos in positions:
+        lower, upper = values[int(np.floor(pos))], values[int(np.ceil(pos))]
+        result.append(lower + (upper - lower) * (pos - np.floor(pos)))
+    return np.array(result)
+
+def tiled_apply_expression(mat, expression, out_path, budget_bytes=None):
+    """Apply a Map Math expression tile by tile, writing the result to a .npy file.
+
+    Returns the result opened as a read-only memory map.
+    """
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(mat), shape=mat.shape)
+    for rows in iter_tiles(mat, budget_bytes):
+        out[rows] = apply_expression(mat[rows], expression)
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    return np.load(out_path, mmap_mode='r')
+
+# Map algebra: arithmetic on the element maps of one sample
+MAP_ALGEBRA_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+                         ast.Pow: np.power}
+# Functions allowed as np.<name>(...): name -> (ufunc, number of arguments)
+MAP_ALGEBRA_FUNCTIONS = {**{name: (getattr(np, name), 1) for name in ['sqrt', 'log', 'log10', 'exp', 'abs']},
+                         **{name: (getattr(np, name), 2) for name in ['minimum', 'maximum']}}
+
+class MapExpression:
+    """A map algebra expression such as 'Zn / Ca' or '(Fe + Mn) / S', compiled to a graph.
+
+    Names refer to the element maps of one sample, matched like the rest of
+    the viewer does ('Zn' finds 'Zn66'), and 'total' is the sum of all of
+    them. Building the expression only parses it: every distinct
+    subexpression becomes one node, so repeated parts are computed once.
+    evaluate() then runs the whole graph over the maps tile by tile, in a
+    single pass over the inputs.
+    """
+
+    def __init__(self, expression, elements):
+        self.expression = expression
+        self.elements = list(elements)
+        self.nodes = []    # (operation, *arguments), arguments of earlier nodes given by index
+        self._index = {}   # node -> its index, to share common subexpressions
+        self.inputs = []   # element labels read, in node order
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Invalid expression: {e.msg}") from None
+        self.root = self._build(tree.body)
+        self.key = self._canonical(self.root)
+
+    def _node(self, *node):
+        if node not in self._index:
+            self._index[node] = len(self.nodes)
+            self.nodes.append(node)
+            if node[0] == 'map':
+                self.inputs.append(node[1])
+        return self._index[node]
+
+    def _call(self, name, *args):
+        # Calls on constants alone are folded, so every call node works on map tiles
+        if all(self.nodes[arg][0] == 'const' for arg in args):
+            with np.errstate(all='ignore'):
+                return self._node('const', float(getattr(np, name)(*[self.nodes[arg][1] for arg in args])))
+        return self._node('call', name, *args)
+
+    def _build(self, tree):
+        if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float)):
+            return self._node('const', float(tree.value))
+        if isinstance(tree, ast.Name):
+            if tree.id == 'total':
+                if not self.elements:
+                    raise ValueError("The sample has no element maps to total.")
+                labels = sorted(self.elements, key=natural_sort_key)
+                index = self._node('map', labels[0])
+                for label in labels[1:]:
+                    index = self._call('add', index, self._node('map', label))
+                return index
+            label = match_element(tree.id, self.elements)
+            if label is None:
+                raise ValueError(f"The sample has no {tree.id} map.")
+            return self._node('map', label)
+        if isinstance(tree, ast.BinOp) and type(tree.op) in MAP_ALGEBRA_OPERATORS:
+            return self._call(MAP_ALGEBRA_OPERATORS[type(tree.op)].__name__, self._build(tree.left), self._build(tree.right))
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.USub, ast.UAdd)):
+            operand = self._build(tree.operand)
+            return self._call('negative', operand) if isinstance(tree.op, ast.USub) else operand
+        if (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Attribute) and isinstance(tree.func.value, ast.Name)
+                and tree.func.value.id == 'np' and tree.func.attr in MAP_ALGEBRA_FUNCTIONS and not tree.keywords):
+            func, arity = MAP_ALGEBRA_FUNCTIONS[tree.func.attr]
+            if len(tree.args) != arity:
+                raise ValueError(f"np.{tree.func.attr} takes {arity} argument{'s' if arity > 1 else ''}, "
+                                 f"not {len(tree.args)}.")
+            return self._call(func.__name__, *[self._build(a) for a in tree.args])
+        raise ValueError(f"Unsupported expression: {ast.unparse(tree)}")
+
+    def _canonical(self, index):
+        node = self.nodes[index]
+        if node[0] == 'const':
+            return repr(node[1])
+        if node[0] == 'map':
+            return node[1]
+        return f"{node[1]}({', '.join(self._canonical(i) for i in node[2:])})"
+
+    def evaluate(self, maps, out_path=None, budget_bytes=None):
+        """Evaluate the expression over maps ({element label: matrix}).
+
+        Returns a float matrix, written to out_path and opened as a read-only
+        memory map when out_path is given. Divisions by zero and other
+        undefined results are empty (NaN) cells.
+        """
+        mats = [maps[label] for label in self.inputs]
+        shape = mats[0].shape if mats else None
+        if any(mat.shape != shape for mat in mats):
+            raise ValueError("The maps in the expression have different shapes: "
+                             + ", ".join(f"{label} {maps[label].shape}" for label in self.inputs))
+        if shape is None:
+            raise ValueError("The expression does not use any element map.")
+        # A node's value is freed, or its buffer reused for the result, after its last use
+        last_use = {}
+        for index, node in enumerate(self.nodes):
+            for arg in node[2:] if node[0] == 'call' else ():
+                last_use[arg] = index
+        if out_path:
+            tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(*mats), shape=shape)
+        else:
+            out = np.empty(shape, dtype=working_dtype(*mats))
+        # Every node may hold a tile-sized intermediate at once
+        budget_bytes = (budget_bytes or TILE_BUDGET_BYTES) // max(len(self.nodes), 1)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for rows in iter_tiles(mats[0], budget_bytes):
+                values, owned = {}, set()
+                for index, node in enumerate(self.nodes):
+                    if node[0] == 'const':
+                        values[index] = node[1]
+                    elif node[0] == 'map':
+                        values[index] = np.asarray(maps[node[1]][rows], dtype=float)
+                    else:
+                        args = node[2:]
+                        func = getattr(np, node[1])
+                        # Write into a dying intermediate instead of allocating a new tile
+                        reuse = next((a for a in args if a in owned and last_use[a] == index), None)
+                        if reuse is not None:
+                            values[index] = func(*[values[a] for a in args], out=values[reuse])
+                        else:
+                            values[index] = func(*[values[a] for a in args])
+                        owned.add(index)
+                        for arg in set(args):
+                            if last_use[arg] == index:
+                                values.pop(arg, None)
+                                owned.discard(arg)
+                result = values[self.root]
+                out[rows] = result
+                out[rows][~np.isfinite(out[rows])] = np.nan
+        if out_path:
+            out.flush()
+            del out
+            os.replace(tmp_path, out_path)
+            return np.load(out_path, mmap_mode='r')
+        return out
+
+def downsample_mean(mat, out=None, budget_bytes=None):
+    """Halve both dimensions of mat by NaN-aware 2x2 block means, streaming tile by tile."""
+    rows, cols = mat.shape
+    out_shape = ((rows + 1) // 2, (cols + 1) // 2)
+    if out is None:
+        out = np.empty(out_shape, dtype=working_dtype(mat))
+    # Tiles must cover an even number of source rows
+    step = max((budget_bytes or TILE_BUDGET_BYTES) // (max(cols, 1) * 8 * 4) * 2, 2)
+    for start in range(0, rows, step):
+        tile = np.array(mat[start:start + step], dtype=float)
+        pad_rows, pad_cols = tile.shape[0] % 2, cols % 2
+        if pad_rows or pad_cols:
+            tile = np.pad(tile, ((0, pad_rows), (0, pad_cols)), constant_values=np.nan)
+        blocks = tile.reshape(tile.shape[0] // 2, 2, tile.shape[1] // 2, 2)
+        valid = ~np.isnan(blocks)
+        counts = valid.sum(axis=(1, 3))
+        sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[start // 2:start // 2 + blocks.shape[0]] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return out
+
+def block_mean(mat, factor):
+    """Average factor x factor blocks of a 2D array without NaN, repeating edge pixels to fill the last blocks."""
+    if factor <= 1:
+        return mat
+    pad_rows, pad_cols = -mat.shape[0] % factor, -mat.shape[1] % factor
+    if pad_rows or pad_cols:
+        mat = np.pad(mat, ((0, pad_rows), (0, pad_cols)), mode='edge')
+    blocks = mat.reshape(mat.shape[0] // factor, factor, mat.shape[1] // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def build_pyramid(mat, cache_prefix=None, budget_bytes=None):
+    """Return [mat, mat/2, mat/4, ...] down to PYRAMID_MIN_SIZE, built tile by tile.
+
+    Levels too large for the tile budget are written as memory-mapped .npy files
+    named '<cache_prefix>_L<level>.npy' and reused on the next call.
+    """
+    budget_bytes = budget_bytes or TILE_BUDGET_BYTES
+    levels = [mat]
+    while max(levels[-1].shape) > PYRAMID_MIN_SIZE:
+        prev = levels[-1]
+        shape = ((prev.shape[0] + 1) // 2, (prev.shape[1] + 1) // 2)
+        level_path = f"{cache_prefix}_L{len(levels)}.npy" if cache_prefix else None
+        if level_path and os.path.exists(level_path):
+            levels.append(np.load(level_path, mmap_mode='r'))
+            continue
+        if level_path and shape[0] * shape[1] * 8 > budget_bytes:
+            tmp_path = f"{level_path}.{os.getpid()}.tmp.npy"
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(prev), shape=shape)
+            downsample_mean(prev, out, budget_bytes)
+            out.flush()
+            del out
+            os.replace(tmp_path, level_path)
+            levels.append(np.load(level_path, mmap_mode='r'))
+        else:
+            levels.append(downsample_mean(prev, budget_bytes=budget_bytes))
+    return levels
+
+def pyramid_window(levels, window, target_pixels):
+    """Pick the coarsest pyramid level that still shows window at target_pixels resolution.
+
+    window is (row0, row1, col0, col1) in full-resolution pixels. Returns
+    (data, extent) where data is a float copy of just the visible region and
+    extent places it in full-resolution pixel coordinates for imshow.
+    """
+    r0, r1, c0, c1 = window
+    span = max(r1 - r0, c1 - c0)
+    level = int(np.clip(np.floor(np.log2(max(span / max(target_pixels, 1), 1))), 0, len(levels) - 1))
+    scale = 2 ** level
+    data = levels[level]
+    lr0, lc0 = r0 // scale, c0 // scale
+    lr1 = min(-(-r1 // scale), data.shape[0])
+    lc1 = min(-(-c1 // scale), data.shape[1])
+    region = np.array(data[lr0:lr1, lc0:lc1], dtype=float)
+    extent = [lc0 * scale - 0.5, lc1 * scale - 0.5, lr1 * scale - 0.5, lr0 * scale - 0.5]
+    return region, extent
+
+def pyramid_cache_prefix(mat):
+    """Cache file prefix for the pyramid levels of a memory-mapped matrix."""
+    return cached_matrix_path(mat.filename)[:-len('.npy')]
+
+def overview_level(levels, max_size):
+    """Return the finest pyramid level whose largest side fits in max_size pixels."""
+    return next((level for level in levels if max(level.shape) <= max_size), levels[-1])
+
+def load_view_matrix(path, notes=None):
+    """Load a matrix for the Element Viewer, memory-mapped if it is too large for RAM."""
+    return open_out_of_core(path, notes) if is_out_of_core_file(path) else load_matrix(path, notes)
+
+def load_channel_matrix(path, notes=None):
+    """Load a matrix for an RGB channel; the overlay is composited in memory, so large maps use a pyramid overview."""
+    if is_out_of_core_file(path):
+        big = open_out_of_core(path, notes)
+        return np.array(overview_level(build_pyramid(big, pyramid_cache_prefix(big)), RGB_OVERVIEW_SIZE))
+    return load_matrix(path, notes)
+
+def matrix_range(mat):
+    """Return (nanmin, nanmax), streaming tile by tile for out-of-core matrices."""
+    if is_out_of_core(mat):
+        stats = tiled_stats(mat)
+        return stats['min'], stats['max']
+    return np.nanmin(mat), np.nanmax(mat)
+
+# Filtered, transformed and otherwise derived arrays are cached in memory up to this many bytes
+DERIVED_CACHE_BYTES = 512 * 1024 ** 2
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by the total size of its values.
+
+    Memory-mapped values are counted as free since their data lives on disk.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def value_nbytes(value):
+        if is_out_of_core(value):
+            return 0
+        return int(getattr(value, 'nbytes', 0))
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key][0]
+
+    def put(self, key, value, nbytes=None):
+        nbytes = self.value_nbytes(value) if nbytes is None else nbytes
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self._items) > 1:
+            _, (_, old_nbytes) = self._items.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Change the budget, evicting entries if it shrank."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, nbytes = self._items.pop(key)
+            self.nbytes -= nbytes
+            return value
+
+    def keys(self):
+        with self._lock:
+            return list(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def stats(self):
+        """Return a consistent snapshot of the entry count, size, budget and hit counters."""
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.nbytes, 'budget': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+_generation_counter = itertools.count(1)
+_generations = {}
+_generations_lock = threading.RLock()
+
+def matrix_generation(mat):
+    """Return a number identifying the matrix object mat, for use in cache keys.
+
+    Matrices are never modified in place (Map Math and reloads produce new
+    arrays), so a new array always gets a new generation. Numbers are never
+    reused, unlike id(), even after the array is freed.
+    """
+    key = id(mat)
+    # Frames are computed on worker threads too; reentrant because forget() can run during a collection
+    with _generations_lock:
+        entry = _generations.get(key)
+        if entry is not None and entry[0]() is mat:
+            return entry[1]
+
+        def forget(ref, key=key):
+            with _generations_lock:
+                if _generations.get(key, (None,))[0] is ref:
+                    del _generations[key]
+
+        generation = next(_generation_counter)
+        _generations[key] = (weakref.ref(mat, forget), generation)
+        return generation
+
+# RAM allowed for the matrices loaded by both tabs together
+MATRIX_STORE_BYTES = 2 * 1024 ** 3
+
+class MatrixStore:
+    """Matrices loaded from files, shared by both tabs under one memory budget.
+
+    Matrices are keyed by source identity (absolute path, modification time and
+    size), so a file opened in both tabs, or swapped out and back in, is read
+    once. They are handed out read-only, so every holder can share one array
+    and derived-map caches keyed by matrix generation stay valid. When the
+    budget is exceeded the least recently used matrices are dropped; they
+    reload quickly from the binary cache the next time they are asked for.
+    Files that had to stay in double precision are listed in precision
+    (absolute path -> reason). Threads asking for a file that is already
+    being loaded wait for that load instead of reading it again.
+    """
+
+    def __init__(self, max_bytes=MATRIX_STORE_BYTES):
+        self.cache = LRUCache(max_bytes)
+        self.reloads = 0
+        self.precision = {}
+        self._seen = set()
+        self._loading = {}  # key -> Future of a load in progress
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def source_key(path, overview=False):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        # Out-of-core files loaded as RGB channels are a pyramid overview, not the map itself
+        kind = 'overview' if overview and is_out_of_core_file(path) else 'full'
+        return (path, st.st_mtime_ns, st.st_size, kind)
+
+    def get(self, path, overview=False):
+        """Return the read-only matrix of a file, loading it on a miss.
+
+        With overview, out-of-core files give the in-memory overview used for
+        RGB channels (load_channel_matrix) instead of a memory map.
+        """
+        key = self.source_key(path, overview)
+        mat = self.cache.get(key)
+        if mat is not None:
+            return mat
+        with self._lock:
+            future = self._loading.get(key)
+            # A load that finished after the miss above has put its matrix in the cache
+            if future is None and key in self.cache:
+                future = Future()
+                future.set_result(self.cache.get(key))
+            owner = future is None
+            if owner:
+                future = self._loading[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            notes = []
+            mat = load_channel_matrix(path, notes) if key[3] == 'overview' else load_view_matrix(path, notes)
+            mat.flags.writeable = False
+            with self._lock:
+                if notes:
+                    self.precision[key[0]] = notes[0]
+                if key in self._seen:
+                    self.reloads += 1
+                self._seen.add(key)
+            self.cache.put(key, mat)
+            future.set_result(mat)
+            return mat
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def precision_loss(self, path):
+        """Why a file's map had to stay in double precision, or None."""
+        with self._lock:
+            return self.precision.get(os.path.abspath(path))
+
+    def discard(self, path):
+        """Forget every stored version of a file, e.g. after it changed on disk."""
+        path = os.path.abspath(path)
+        for key in self.cache.keys():
+            if key[0] == path:
+                self.cache.pop(key)
+        # The next load reads a new file, not a reload of a dropped one
+        with self._lock:
+            self._seen = {key for key in self._seen if key[0] != path}
+            self.precision.pop(path, None)
+
+    def stats(self):
+        cache = self.cache.stats()
+        with self._lock:
+            reloads = self.reloads
+        return {'matrices': cache['entries'], 'bytes': cache['bytes'], 'budget': cache['budget'],
+                'hits': cache['hits'], 'misses': cache['misses'], 'evictions': cache['evictions'],
+                'reloads': reloads}
+
+def _nan_filled(tile):
+    """Return tile with NaN replaced by 0 (how empty cells are displayed), and the NaN mask."""
+    nan = np.isnan(tile)
+    return np.where(nan, 0.0, tile), nan
+
+def median_denoise(tile, size):
+    """Median filter over a size x size window."""
+    filled, nan = _nan_filled(tile)
+    out = ndimage.median_filter(filled, size=size, mode='nearest')
+    out[nan] = np.nan
+    return out
+
+def gaussian_denoise(tile, size):
+    """Gaussian smoothing with sigma = size / 4, normalised so empty cells do not darken their neighbours."""
+    sigma = size / 4.0
+    filled, nan = _nan_filled(tile)
+    weights = ndimage.gaussian_filter((~nan).astype(float), sigma, mode='nearest')
+    out = ndimage.gaussian_filter(filled, sigma, mode='nearest')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out /= weights
+    out[nan] = np.nan
+    return out
+
+def bilateral_denoise(tile, size, sigma_range):
+    """Edge-preserving smoothing: neighbours are weighted by distance and by how close their value is.
+
+    sigma_range is in data units; neighbours differing by much more are ignored,
+    so grain boundaries stay sharp while shot noise inside a phase is averaged out.
+    """
+    radius = size // 2
+    sigma_space = max(size / 3.0, 0.5)
+    filled, nan = _nan_filled(tile)
+    rows, cols = filled.shape
+    padded = np.pad(filled, radius, mode='edge')
+    padded_valid = np.pad(~nan, radius, mode='edge')
+    total = np.zeros_like(filled)
+    weight_sum = np.zeros_like(filled)
+    inv_range = 1.0 / (2.0 * max(sigma_range, 1e-12) ** 2)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            window = (slice(radius + dy, radius + dy + rows), slice(radius + dx, radius + dx + cols))
+            shifted = padded[window]
+            weight = np.exp(-(dy * dy + dx * dx) / (2.0 * sigma_space ** 2) - (shifted - filled) ** 2 * inv_range)
+            weight *= padded_valid[window]
+            total += weight * shifted
+            weight_sum += weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = total / weight_sum
+    out[nan] = np.nan
+    return out
+
+def hot_pixel_removal(tile, size, threshold=5.0):
+    """Replace isolated spikes with the local median.
+
+    A pixel is a spike when it exceeds the median of its size x size window by
+    more than threshold robust standard deviations (1.4826 x the local median
+    absolute deviation).
+    """
+    filled, nan = _nan_filled(tile)
+    median = ndimage.median_filter(filled, size=size, mode='nearest')
+    mad = ndimage.median_filter(np.abs(filled - median), size=size, mode='nearest')
+    out = np.where(filled - median > threshold * 1.4826 * mad, median, filled)
+    out[nan] = np.nan
+    return out
+
+# Filter name -> rows of overlap each chunk needs on either side for a given window size
+DENOISE_FILTERS = {
+    'Median': lambda size: size // 2,
+    'Gaussian': lambda size: size,
+    'Edge-preserving': lambda size: size // 2,
+    'Hot-pixel removal': lambda size: 2 * (size // 2),
+}
+# The filters hold several float64 copies of a chunk at once
+FILTER_WORK_COPIES = 8
+
+def robust_spread(mat, max_samples=1_000_000):
+    """Return the 1st-99th percentile spread of mat, estimated from an evenly strided sample."""
+    step = max(int(np.sqrt(mat.size / max_samples)), 1)
+    sample = np.asarray(mat[::step, ::step], dtype=float)
+    sample = sample[~np.isnan(sample)]
+    if not sample.size:
+        return 1.0
+    lo, hi = np.percentile(sample, [1, 99])
+    return float(hi - lo) or 1.0
+
+def denoise_tile(tile, name, size, sigma_range=None):
+    """Apply the named denoising filter to one in-memory tile."""
+    if name == 'Median':
+        return median_denoise(tile, size)
+    if name == 'Gaussian':
+        return gaussian_denoise(tile, size)
+    if name == 'Edge-preserving':
+        return bilateral_denoise(tile, size, sigma_range)
+    if name == 'Hot-pixel removal':
+        return hot_pixel_removal(tile, size)
+    raise ValueError(f"Unknown filter '{name}'.")
+
+def denoise_matrix(mat, name, size, out_path=None, budget_bytes=None):
+    """Apply a denoising filter to mat in row chunks with overlap, so memory stays bounded.
+
+    Each chunk is read together with enough neighbouring rows for the filter
+    window, filtered, and trimmed back, so the result is identical to filtering
+    the whole map at once. With out_path the result is written there as a .npy
+    file and returned as a read-only memory map.
+    """
+    if name not in DENOISE_FILTERS:
+        raise ValueError(f"Unknown filter '{name}'.")
+    size = max(int(size), 1)
+    halo = DENOISE_FILTERS[name](size)
+    # Edge-preserving weights must use the same value scale in every chunk
+    sigma_range = 0.1 * robust_spread(mat) if name == 'Edge-preserving' else None
+    rows = mat.shape[0]
+    if out_path:
+        tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(mat), shape=mat.shape)
+    else:
+        out = np.empty(mat.shape, dtype=working_dtype(mat))
+    for band in iter_tiles(mat, (budget_bytes or TILE_BUDGET_BYTES) // FILTER_WORK_COPIES):
+        start, stop = max(band.start - halo, 0), min(band.stop + halo, rows)
+        tile = np.array(mat[start:stop], dtype=float)
+        filtered = denoise_tile(tile, name, size, sigma_range)
+        out[band] = filtered[band.start - start:band.stop - start]
+    if out_path:
+        out.flush()
+        del out
+        os.replace(tmp_path, out_path)
+        return np.load(out_path, mmap_mode='r')
+    return out
+
+def derived_cache_path(mat, name, param):
+    """Cache file for a filtered or transformed copy of a memory-mapped matrix."""
+    tag = re.sub(r'\W+', '-', name.lower())
+    return f"{cached_matrix_path(mat.filename)[:-len('.npy')]}_{tag}{param}.npy"
+
+# Display transforms: name -> (forward(x, p), inverse(y, p), default parameter). All are
+# monotonic, odd and map 0 to 0, so limits and colorbars can be shown in original units.
+DISPLAY_TRANSFORMS = {
+    'Linear': (lambda x, p: x, lambda y, p: y, 1.0),
+    # p is the value below which the scale turns linear, so zeros stay finite
+    'Log': (lambda x, p: np.sign(x) * np.log10(1 + np.abs(x) / p),
+            lambda y, p: np.sign(y) * p * (10 ** np.abs(y) - 1), 1.0),
+    # p is the softening: linear well below p, logarithmic well above
+    'Asinh': (lambda x, p: np.arcsinh(x / p), lambda y, p: p * np.sinh(y), 1.0),
+    # Display gamma: p > 1 brightens faint signal
+    'Gamma': (lambda x, p: np.sign(x) * np.abs(x) ** (1 / p), lambda y, p: np.sign(y) * np.abs(y) ** p, 2.2),
+    'Power': (lambda x, p: np.sign(x) * np.abs(x) ** p, lambda y, p: np.sign(y) * np.abs(y) ** (1 / p), 2.0),
+}
+
+def display_transform(name, param):
+    """Return (forward, inverse) functions of one value or array for a display transform."""
+    if name not in DISPLAY_TRANSFORMS:
+        raise ValueError(f"Unknown transform '{name}'.")
+    if not param > 0:
+        raise ValueError("The transform parameter must be positive.")
+
+    def bind(func):
+        def apply(values):
+            with np.errstate(all='ignore'):
+                return func(np.asarray(values, dtype=float), param)
+        return apply
+
+    forward, inverse, _ = DISPLAY_TRANSFORMS[name]
+    return bind(forward), bind(inverse)
+
+def transform_matrix(mat, name, param, out_path=None, budget_bytes=None):
+    """Apply a display transform to mat tile by tile; NaN stays NaN.
+
+    With out_path the result is written there as a .npy file and returned as a
+    read-only memory map.
+    """
+    forward = display_transform(name, param)[0]
+    if out_path:
+        tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(mat), shape=mat.shape)
+    else:
+        out = np.empty(mat.shape, dtype=working_dtype(mat))
+    for rows in iter_tiles(mat, budget_bytes):
+        out[rows] = forward(mat[rows])
+    if out_path:
+        out.flush()
+        del out
+        os.replace(tmp_path, out_path)
+        return np.load(out_path, mmap_mode='r')
+    return out
+
+# Display transforms that depend on the map's own histogram: name -> default parameter.
+# 'Equalize' spreads the values evenly over the colormap by their rank in the whole map
+# (the parameter is unused); 'CLAHE' equalizes each region of the map, the parameter
+# limiting local contrast to that many times the contrast of the global equalization.
+EQUALIZATIONS = {'Equalize': 1.0, 'CLAHE': 3.0}
+
+# Every transform a view offers: name -> default parameter
+VIEW_TRANSFORMS = {**{name: spec[2] for name, spec in DISPLAY_TRANSFORMS.items()}, **EQUALIZATIONS}
+
+class EqualizationTiles:
+    """Histograms of a map over a grid of tiles, for histogram equalization and CLAHE.
+
+    The bin edges are quantiles of the whole map, so a heavy-tailed map spreads
+    over all bins instead of piling into the lowest few. The histograms are
+    counted once per map; the mapping for any clip limit is derived from them.
+    For in-memory maps the position of every pixel among the bins is kept as
+    well, so remapping with another clip limit needs no search.
+    """
+
+    GRID = 8
+    BINS = 1024
+
+    def __init__(self, edges, counts, row_bounds, col_bounds, positions=None):
+        self.edges = edges  # Increasing bin edges, from the exact minimum to the exact maximum
+        self.counts = counts  # Pixels per (tile row, tile column, bin)
+        self.row_bounds = row_bounds
+        self.col_bounds = col_bounds
+        self.positions = positions  # Bin index plus the fraction of the way through the bin, or None
+        totals = counts.sum(axis=(0, 1))
+        # Fraction of the map below each edge, which is the global equalization
+        self.cdf = np.concatenate([[0.0], np.cumsum(totals) / max(int(totals.sum()), 1)])
+        self.nbytes = counts.nbytes + edges.nbytes + (positions.nbytes if positions is not None else 0)
+
+    @classmethod
+    def from_matrix(cls, mat, grid=None, n_bins=None, budget_bytes=None):
+        """Count the tile histograms of mat in two streaming passes; NaN is left out."""
+        grid = grid or cls.GRID
+        n_bins = n_bins or cls.BINS
+        sketch = sketch_matrix(mat, budget_bytes)
+        if not sketch.count:
+            raise ValueError("The map contains no values.")
+        # Tied quantiles (e.g. a field of zeros) collapse into one bin
+        edges = np.unique(sketch.percentiles(np.linspace(0, 100, n_bins + 1)))
+        if len(edges) < 2:
+            edges = np.array([edges[0], edges[0] + 1.0])
+        row_bounds = np.linspace(0, mat.shape[0], min(grid, mat.shape[0]) + 1).astype(int)
+        col_bounds = np.linspace(0, mat.shape[1], min(grid, mat.shape[1]) + 1).astype(int)
+        row_tile = np.repeat(np.arange(len(row_bounds) - 1), np.diff(row_bounds))
+        col_tile = np.repeat(np.arange(len(col_bounds) - 1), np.diff(col_bounds))
+        n_tile_cols, nb = len(col_bounds) - 1, len(edges) - 1
+        counts = np.zeros((len(row_bounds) - 1) * n_tile_cols * nb, dtype=np.int64)
+        positions = None if is_out_of_core(mat) else np.empty(mat.shape, dtype=np.float32)
+        for rows in iter_tiles(mat, budget_bytes):
+            values = np.asarray(mat[rows], dtype=float)
+            position = cls.bin_positions(edges, values)
+            valid = ~np.isnan(values)
+            cell = (row_tile[rows, None] * n_tile_cols + col_tile) * nb + np.where(valid, position, 0).astype(np.int32)
+            counts += np.bincount(cell[valid], minlength=counts.size)
+            if positions is not None:
+                positions[rows] = position
+        return cls(edges, counts.reshape(-1, n_tile_cols, nb), row_bounds, col_bounds, positions)
+
+    @staticmethod
+    def bin_positions(edges, values):
+        """Bin index plus the fraction of the way through the bin of each value, as float32; NaN stays NaN."""
+        bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+        with np.errstate(invalid='ignore'):
+            fraction = np.clip((values - edges[bins]) / (edges[bins + 1] - edges[bins]), 0, 1)
+        return (bins + fraction).astype(np.float32)
+
+    def functions(self):
+        """Return (forward, inverse) of the global equalization, mapping values onto 0-1 by rank."""
+        def forward(values):
+            values = np.asarray(values, dtype=float)
+            return np.where(np.isnan(values), np.nan, np.interp(values, self.edges, self.cdf))
+
+        def inverse(values):
+            values = np.asarray(values, dtype=float)
+            return np.where(np.isnan(values), np.nan, np.interp(values, self.cdf, self.edges))
+
+        return forward, inverse
+
+    def tile_cdfs(self, clip_limit):
+        """Return each tile's fraction of pixels below each edge after contrast limiting.
+
+        A bin may hold at most clip_limit times the share the global histogram
+        gives it, and the clipped excess is spread back in those same shares.
+        """
+        counts = self.counts.astype(float)
+        totals = counts.sum(axis=2, keepdims=True)
+        share = np.diff(self.cdf)
+        clipped = np.minimum(counts, clip_limit * totals * share)
+        clipped += (totals - clipped.sum(axis=2, keepdims=True)) * share
+        cdfs = np.cumsum(clipped, axis=2) / np.maximum(totals, 1)
+        # Tiles without values follow the global equalization
+        cdfs[totals[..., 0] == 0] = self.cdf[1:]
+        return np.concatenate([np.zeros(cdfs.shape[:2] + (1,)), cdfs], axis=2)
+
+    def equalize(self, mat, clip_limit=None, out_path=None, budget_bytes=None):
+        """Map mat onto 0-1 tile by tile; NaN stays NaN.
+
+        Without clip_limit every value maps through the global equalization.
+        With it each pixel blends the mappings of the four nearest tile centres
+        bilinearly (CLAHE), so no tile seams show. mat must be the map the
+        histograms were counted from. With out_path the result is written there
+        as a .npy file and returned as a read-only memory map.
+        """
+        if out_path:
+            tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(mat), shape=mat.shape)
+        else:
+            out = np.empty(mat.shape, dtype=working_dtype(mat))
+        if clip_limit is None:
+            cdfs = self.cdf[None, None].astype(np.float32)
+            (r0, r1, wy), (c0, c1, wx) = [(np.zeros(n, dtype=np.int32),) * 2 + (np.zeros(n, dtype=np.float32),)
+                                          for n in mat.shape]
+        else:
+            cdfs = self.tile_cdfs(clip_limit).astype(np.float32)
+            (r0, r1, wy), (c0, c1, wx) = (self.tile_weights(bounds, size) for bounds, size
+                                          in ((self.row_bounds, mat.shape[0]), (self.col_bounds, mat.shape[1])))
+        n_tile_cols, stride = cdfs.shape[1], cdfs.shape[2]
+        # Each table holds the value at a bin's lower edge and the rise across the bin
+        slopes = np.diff(cdfs, axis=2, append=cdfs[..., -1:]).ravel()
+        cdfs = cdfs.ravel()
+        # Offsets from a pixel's first tile to the next one along a column or along a row
+        col_step = ((c1 - c0) * stride).astype(np.int32)
+        for rows in iter_tiles(mat, budget_bytes):
+            if self.positions is not None:
+                position = self.positions[rows]
+            else:
+                position = self.bin_positions(self.edges, np.asarray(mat[rows], dtype=float))
+            missing = np.isnan(position)
+            bins = np.where(missing, 0, position).astype(np.int32)
+            fraction = position - bins
+            first = ((r0[rows] * n_tile_cols)[:, None] + c0) * stride + bins
+            row_step = ((r1[rows] - r0[rows]) * n_tile_cols * stride)[:, None]
+
+            def mapped(index):
+                return cdfs[index] + fraction * slopes[index]
+
+            # With clip_limit each pixel blends the mappings of its four nearest tile centres
+            top = mapped(first)
+            if clip_limit is not None:
+                top += wx * (mapped(first + col_step) - top)
+                bottom = mapped(first + row_step)
+                bottom += wx * (mapped(first + row_step + col_step) - bottom)
+                top += wy[rows, None] * (bottom - top)
+            top[missing] = np.nan
+            out[rows] = top
+        if out_path:
+            out.flush()
+            del out
+            os.replace(tmp_path, out_path)
+            return np.load(out_path, mmap_mode='r')
+        return out
+
+    @staticmethod
+    def tile_weights(bounds, size):
+        # Neighbouring tile centres of every row (or column) and the weight of the second one
+        centres = (bounds[:-1] + bounds[1:] - 1) / 2
+        position = np.interp(np.arange(size), centres, np.arange(len(centres)))
+        first = np.floor(position).astype(np.int32)
+        return first, np.minimum(first + 1, len(centres) - 1), (position - first).astype(np.float32)
+
+# Entries in a colormap lookup table, the last one reserved for NaN; at most 256 uses uint8 indices
+LUT_SIZE = 4096
+
+def quantize_levels(mat, lo, hi, lut_size=LUT_SIZE, budget_bytes=None):
+    """Quantize mat into integer level indices for lookup-table rendering.
+
+    Values in [lo, hi] map linearly onto 0 .. lut_size - 2 (values outside are
+    clipped) and NaN maps to lut_size - 1, so empty cells need no separate pass.
+    Works tile by tile, returning uint8 indices for tables of up to 256 entries
+    and uint16 otherwise.
+    """
+    top = lut_size - 2
+    scale = top / (hi - lo) if hi > lo else 0.0
+    out = np.empty(mat.shape, dtype=np.uint8 if lut_size <= 256 else np.uint16)
+    for rows in iter_tiles(mat, budget_bytes):
+        scaled = (np.asarray(mat[rows], dtype=float) - lo) * scale
+        np.clip(scaled, 0, top, out=scaled)
+        np.rint(scaled, out=scaled)
+        scaled[np.isnan(scaled)] = lut_size - 1
+        out[rows] = scaled
+    return out
+
+def level_values(lo, hi, lut_size=LUT_SIZE):
+    """Data value represented by each quantized level (excluding the NaN entry)."""
+    return np.linspace(lo, hi, lut_size - 1) if hi > lo else np.full(lut_size - 1, float(lo))
+
+def build_colormap_lut(cmap, lo, hi, vmin, vmax, nan_rgba=None, lut_size=LUT_SIZE):
+    """Return the RGBA (uint8) lookup table for levels quantized over [lo, hi], drawn with limits vmin-vmax.
+
+    nan_rgba is the colour of NaN pixels as an RGBA tuple of floats, or None to
+    draw them like a value of zero.
+    """
+    cmap = plt.get_cmap(cmap)
+    values = level_values(lo, hi, lut_size)
+    span = vmax - vmin if vmax > vmin else 1.0
+    lut = np.empty((lut_size, 4), dtype=np.uint8)
+    lut[:-1] = cmap(np.clip((values - vmin) / span, 0, 1), bytes=True)
+    if nan_rgba is None:
+        lut[-1] = cmap(float(np.clip((0 - vmin) / span, 0, 1)), bytes=True)
+    else:
+        lut[-1] = np.round(np.asarray(nan_rgba) * 255)
+    return lut
+
+# Calibration models: ordinary least squares, or weighted by 1/concentration^2 (constant relative error)
+CALIBRATION_MODELS = ['Linear', 'Weighted (1/c\u00b2)']
+
+def element_symbol(label):
+    """Reduce an element label like 'Zn66' or '66Zn' to its symbol, 'Zn'."""
+    return re.sub(r'[^A-Za-z]', '', label)
+
+def match_element(label, names):
+    """Return the entry of names matching an element label, exactly or by symbol, or None."""
+    if label in names:
+        return label
+    symbol = element_symbol(label)
+    return next((name for name in names if element_symbol(str(name)) == symbol), None)
+
+def read_certified_values(path):
+    """Read a table of certified concentrations (ppm): one row per reference material, one column per element."""
+    df = pd.read_excel(path, index_col=0) if path.lower().endswith(('.xlsx', '.xls')) else pd.read_csv(path, index_col=0)
+    df.index = [str(name).strip() for name in df.index]
+    df.columns = [str(name).strip() for name in df.columns]
+    return df.apply(pd.to_numeric, errors='coerce')
+
+def parse_roi(text):
+    """Parse an ROI like '10:50, 20:80' (rows, then columns) into (r0, r1, c0, c1); blank means the whole map."""
+    text = text.strip()
+    if not text:
+        return None
+    match = re.fullmatch(r'(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)', text)
+    if not match:
+        raise ValueError("Enter the ROI as 'row0:row1, col0:col1'.")
+    r0, r1, c0, c1 = (int(v) for v in match.groups())
+    if r1 <= r0 or c1 <= c0:
+        raise ValueError("The ROI end must be after its start.")
+    return r0, r1, c0, c1
+
+def roi_mean(mat, roi=None, budget_bytes=None):
+    """Mean of the non-NaN values of mat inside roi (r0, r1, c0, c1), or of the whole map."""
+    if roi is not None:
+        r0, r1, c0, c1 = roi
+        mat = mat[r0:r1, c0:c1]
+    total, n = 0.0, 0
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.asarray(mat[rows], dtype=float)
+        valid = ~np.isnan(tile)
+        total += float(tile[valid].sum())
+        n += int(valid.sum())
+    if not n:
+        raise ValueError("The region contains no values.")
+    return total / n
+
+def fit_calibration(signal, concentration, weighted=False, through_zero=False):
+    """Fit concentration = slope * signal + intercept by (weighted) least squares.
+
+    Weighted fits use 1/concentration^2, so every standard counts by its
+    relative error. A single standard always gives a line through zero.
+    Returns a dict with slope, intercept, r2 and n.
+    """
+    x = np.asarray(signal, dtype=float)
+    y = np.asarray(concentration, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if not len(x):
+        raise ValueError("No standards with both a signal and a certified value.")
+    if weighted and np.any(y > 0):
+        w = 1.0 / np.maximum(y, y[y > 0].min()) ** 2
+    else:
+        w = np.ones_like(y)
+    if through_zero or len(x) == 1:
+        slope = float((w * x * y).sum() / (w * x * x).sum())
+        intercept = 0.0
+    else:
+        xm, ym = (w * x).sum() / w.sum(), (w * y).sum() / w.sum()
+        slope = float((w * (x - xm) * (y - ym)).sum() / (w * (x - xm) ** 2).sum())
+        intercept = float(ym - slope * xm)
+    residual = (w * (y - slope * x - intercept) ** 2).sum()
+    spread = (w * (y - (w * y).sum() / w.sum()) ** 2).sum()
+    r2 = float(1 - residual / spread) if spread > 0 else float('nan')
+    return {'slope': slope, 'intercept': intercept, 'r2': r2, 'n': int(len(x))}
+
+class Calibration:
+    """CPS-to-ppm calibration lines for a set of elements, fitted on reference materials.
+
+    With an internal standard the lines relate signal ratios to concentration
+    ratios (element / internal standard), and applying them needs the internal
+    standard's map and its concentration in the sample.
+    """
+
+    def __init__(self, fits, model='Linear', through_zero=False, internal_standard=None, standards=()):
+        self.fits = fits  # Element -> fit_calibration() result plus its 'points' [(signal, concentration, standard)]
+        self.model = model
+        self.through_zero = through_zero
+        self.internal_standard = internal_standard
+        self.standards = list(standards)
+
+    def fit_for(self, element):
+        """Return the fit for an element label, matched exactly or by symbol, or None."""
+        name = match_element(element, self.fits)
+        return self.fits[name] if name is not None else None
+
+    def to_dict(self):
+        return {'fits': self.fits, 'model': self.model, 'through_zero': self.through_zero,
+                'internal_standard': self.internal_standard, 'standards': self.standards}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['fits'], data.get('model', 'Linear'), data.get('through_zero', False),
+                   data.get('internal_standard'), data.get('standards', ()))
+
+def calibrate_standards(standards, certified, model='Linear', through_zero=False, internal_standard=None,
+                        rois=None, signal=None):
+    """Fit a Calibration from reference material maps.
+
+    standards maps each reference material name to {element: matrix file};
+    certified is read_certified_values() output and rois maps names to an
+    ROI (default: the whole map). signal(path, roi) returns the mean CPS of a
+    map and defaults to loading it with load_channel_matrix. Elements without
+    a certified value in any standard are left out.
+    """
+    rois = rois or {}
+    signal = signal or (lambda path, roi: roi_mean(load_channel_matrix(path), roi))
+    points = {}
+    # Reference material names are matched ignoring case, spaces and separators ('NIST 610' = 'nist_610')
+    plain = lambda name: re.sub(r'[\s_-]', '', str(name)).lower()
+    rows = {plain(row_name): row_name for row_name in certified.index}
+    for name, maps in standards.items():
+        row_name = rows.get(plain(name))
+        if row_name is None:
+            continue
+        values = certified.loc[row_name]
+        internal = internal_label = None
+        if internal_standard:
+            internal_label = match_element(internal_standard, maps)
+            column = match_element(internal_standard, values.index)
+            if internal_label is None or column is None or not values[column] > 0:
+                continue
+            internal = (signal(maps[internal_label], rois.get(name)), float(values[column]))
+        for element, path in maps.items():
+            column = match_element(element, values.index)
+            if column is None or not np.isfinite(values[column]) or element == internal_label:
+                continue
+            x, y = signal(path, rois.get(name)), float(values[column])
+            if internal:
+                x, y = x / internal[0], y / internal[1]
+            points.setdefault(element, []).append((x, y, name))
+    weighted = model != 'Linear'
+    fits = {}
+    for element, element_points in points.items():
+        fit = fit_calibration([p[0] for p in element_points], [p[1] for p in element_points], weighted, through_zero)
+        fits[element] = dict(fit, points=element_points)
+    return Calibration(fits, model, through_zero, internal_standard, standards)
+
+def quantify_matrix(mat, fit, internal=None, internal_ppm=None, out_path=None, budget_bytes=None):
+    """Convert a CPS map to ppm with a calibration fit, tile by tile.
+
+    Only non-empty cells (values > 0) are converted, as in Map Math. With an
+    internal standard map the result is (slope * mat / internal + intercept) *
+    internal_ppm, with NaN where the internal standard has no signal. Each
+    tile is converted in place in a single working buffer. With out_path
+    the result is written there as a .npy file and returned as a read-only
+    memory map.
+    """
+    if internal is not None and internal.shape != mat.shape:
+        raise ValueError(f"The internal standard map has shape {internal.shape}, not {mat.shape}.")
+    scale, offset = fit['slope'], fit['intercept']
+    if internal is not None:
+        scale, offset = scale * internal_ppm, offset * internal_ppm
+    if out_path:
+        tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=working_dtype(mat), shape=mat.shape)
+    else:
+        out = np.empty(mat.shape, dtype=working_dtype(mat))
+    for rows in iter_tiles(mat, budget_bytes):
+        tile = np.array(mat[rows], dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            non_empty = tile > 0
+            if internal is not None:
+                reference = np.asarray(internal[rows], dtype=float)
+                np.divide(tile, reference, out=tile, where=non_empty)
+                tile[non_empty & ~(reference > 0)] = np.nan
+            np.multiply(tile, scale, out=tile, where=non_empty)
+            np.add(tile, offset, out=tile, where=non_empty)
+        out[rows] = tile
+    if out_path:
+        out.flush()
+        del out
+        os.replace(tmp_path, out_path)
+        return np.load(out_path, mmap_mode='r')
+    return out
+
+def group_sample_maps(paths):
+    """Group matrix files by sample: {sample: {element: path}}."""
+    samples = {}
+    for path in paths:
+        file_name = os.path.basename(path)
+        samples.setdefault(parse_dataset_root(file_name), {})[parse_element_name(file_name)] = path
+    return samples
+
+def sibling_element_path(path, element):
+    """Return the map of element from the same sample and directory as path, or None."""
+    maps = group_sample_maps(list_matrix_files(os.path.dirname(os.path.abspath(path))))
+    maps = maps.get(parse_dataset_root(os.path.basename(path)), {})
+    label = match_element(element, maps)
+    return maps[label] if label is not None else None
+
+def calibration_expression(fit):
+    """The Map Math expression equivalent to applying fit without an internal standard."""
+    return f"x * {fit['slope']!r} + {fit['intercept']!r}"
+
+class ValueSketch:
+    """Mergeable quantile sketch of map values with a fixed relative accuracy.
+
+    Magnitudes fall into logarithmic buckets, each GAMMA times wider than the
+    one before, so sketches of different files share their buckets and merge
+    by adding counts. Quantiles come out within about (GAMMA - 1) / 2 of the
+    exact values (0.5%), using a few hundred kilobytes however many values
+    were added. Exact min, max and count are kept alongside.
+    """
+
+    GAMMA = 1.01
+    # Magnitudes outside this range are counted in the lowest or highest bucket
+    MIN_MAGNITUDE, MAX_MAGNITUDE = 1e-12, 1e15
+
+    def __init__(self):
+        self._offset = int(np.floor(np.log(self.MIN_MAGNITUDE) / np.log(self.GAMMA)))
+        size = int(np.ceil(np.log(self.MAX_MAGNITUDE) / np.log(self.GAMMA))) - self._offset + 1
+        self.positive = np.zeros(size, dtype=np.int64)
+        self.negative = np.zeros(size, dtype=np.int64)
+        self.zeros = 0
+        self.count = 0
+        self.min, self.max = np.inf, -np.inf
+
+    def add(self, values):
+        """Add the non-NaN values of an array."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        magnitude = np.abs(values)
+        small = magnitude < self.MIN_MAGNITUDE
+        self.zeros += int(np.count_nonzero(small))
+        for buckets, selected in ((self.positive, (values > 0) & ~small), (self.negative, (values < 0) & ~small)):
+            if selected.any():
+                index = np.ceil(np.log(magnitude[selected]) / np.log(self.GAMMA)).astype(np.int64) - self._offset
+                buckets += np.bincount(np.clip(index, 0, len(buckets) - 1), minlength=len(buckets))
+
+    def merge(self, other):
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def percentiles(self, percentiles):
+        """Approximate np.nanpercentile of everything added; NaN if nothing was."""
+        percentiles = np.atleast_1d(np.asarray(percentiles, dtype=float))
+        if not self.count:
+            return np.full(percentiles.shape, np.nan)
+        # Every bucket stands for the midpoint of its range, ordered from the most negative value up
+        exponents = np.arange(len(self.positive)) + self._offset
+        centres = 2 * self.GAMMA ** exponents / (self.GAMMA + 1)
+        values = np.concatenate([-centres[::-1], [0.0], centres])
+        counts = np.concatenate([self.negative[::-1], [self.zeros], self.positive])
+        ranks = percentiles / 100.0 * (self.count - 1)
+        result = values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+        # The extremes are known exactly
+        result[percentiles <= 0] = self.min
+        result[percentiles >= 100] = self.max
+        return np.clip(result, self.min, self.max)
+
+def sketch_matrix(mat, budget_bytes=None):
+    """ValueSketch of a matrix, read tile by tile."""
+    sketch = ValueSketch()
+    for rows in iter_tiles(mat, budget_bytes):
+        sketch.add(mat[rows])
+    return sketch
+
+def sketch_matrix_file(path, budget_bytes=None):
+    """ValueSketch of one matrix file, read tile by tile; runs in a worker process."""
+    return sketch_matrix(load_view_matrix(path), budget_bytes)
+
+def percentile_key(q):
+    """Column name of a percentile in element_scaling results, e.g. 'p99' or 'p99.5'."""
+    return f"p{float(q):g}"
+
+def element_scaling(paths, percentiles=(1.0, 99.0), max_workers=None, progress=None, cancel_event=None):
+    """Statistics of every element over many matrix files, for shared colour limits.
+
+    Each file is summarized by a ValueSketch in its own worker process and the
+    sketches of one element are merged, so no two maps are ever in memory
+    together. Returns a dict with 'elements', {element: {'files', 'count',
+    'min', 'max', 'p1', 'p99', ...}} with one 'p' entry per requested
+    percentile, and 'failed', a list of (path, error) for files that could
+    not be read. progress(done, total, path) is called as files finish; a
+    set cancel_event stops the run and returns None.
+    """
+    by_element = {}
+    for path in paths:
+        by_element.setdefault(parse_element_name(os.path.basename(path)), []).append(path)
+    sketches = {element: ValueSketch() for element in by_element}
+    files = {element: 0 for element in by_element}
+    failed = []
+    with ProcessPoolExecutor(max_workers=min(len(paths), max_workers or os.cpu_count() or 1) or 1) as pool:
+        futures = {pool.submit(sketch_matrix_file, path): (element, path)
+                   for element, element_paths in by_element.items() for path in element_paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            if cancel_event is not None and cancel_event.is_set():
+                for pending in futures:
+                    pending.cancel()
+                return None
+            element, path = futures[future]
+            try:
+                sketches[element].merge(future.result())
+                files[element] += 1
+            except Exception as e:
+                # One unreadable file leaves the others' statistics intact
+                failed.append((path, str(e)))
+            if progress:
+                progress(done, len(futures), path)
+    result = {}
+    for element, sketch in sketches.items():
+        if not files[element]:
+            continue
+        stats = {'files': files[element], 'count': sketch.count,
+                 'min': sketch.min if sketch.count else np.nan, 'max': sketch.max if sketch.count else np.nan}
+        for q, value in zip(percentiles, sketch.percentiles(percentiles)):
+            stats[percentile_key(q)] = float(value)
+        result[element] = stats
+    return {'elements': result, 'failed': failed}
+
+# Montage scaling modes: how each element's colour limits are chosen from its own data,
+# or from the statistics of the element over all samples (see element_scaling)
+MONTAGE_SCALINGS = ['Min-max', '99th percentile', 'Log', 'Shared limits']
+# Which statistics of element_scaling become the shared limits
+SHARED_LIMITS = ['Min-max', 'Percentiles']
+
+def downsample_to(mat, max_size):
+    """Shrink mat so its largest side is max_size pixels; returns (matrix, factor).
+
+    Halves with downsample_mean while the map is at least twice too large,
+    then samples the remaining reduction (less than 2x) from that level.
+    """
+    full_size = max(mat.shape)
+    while max(mat.shape) >= 2 * max_size:
+        mat = downsample_mean(mat)
+    mat = np.asarray(mat, dtype=working_dtype(mat))
+    if max(mat.shape) > max_size:
+        scale = max_size / max(mat.shape)
+        rows = (np.arange(max(int(mat.shape[0] * scale), 1)) / scale).astype(int)
+        cols = (np.arange(max(int(mat.shape[1] * scale), 1)) / scale).astype(int)
+        mat = mat[np.ix_(rows, cols)]
+    return mat, full_size / max(mat.shape)
+
+def render_montage_tile(path, cmap, scaling, tile_pixels, limits=None):
+    """Rasterize one element map for the montage from downsampled data.
+
+    Runs in a worker process. Returns (rgba, (vmin, vmax), factor) where rgba
+    is a uint8 image whose largest side is at most tile_pixels, the limits are
+    in original units and factor is the downsampling applied. limits, if
+    given, are used instead of limits from the map's own data.
+    """
+    small, factor = downsample_to(load_view_matrix(path), tile_pixels)
+    name = 'Log' if scaling == 'Log' else 'Linear'
+    forward, inverse = display_transform(name, DISPLAY_TRANSFORMS[name][2])
+    valid = small[~np.isnan(small)]
+    if not valid.size:
+        raise ValueError("The map contains no values.")
+    if limits is not None:
+        vmin, vmax = map(float, limits)
+    elif scaling == '99th percentile':
+        vmin, vmax = float(valid.min()), float(np.percentile(valid, 99))
+    else:
+        vmin, vmax = float(valid.min()), float(valid.max())
+    lo, hi = float(forward(vmin)), float(forward(vmax))
+    lut = build_colormap_lut(cmap, lo, hi, lo, hi)
+    return lut[quantize_levels(forward(small), lo, hi)], (vmin, vmax), factor
+
+def layout_montage(tiles, tile_pixels, columns=None, label_pixels=24, gap=8, footer_pixels=0):
+    """Composite montage tiles into one RGBA image on a white background.
+
+    Tiles are centred in a grid of tile_pixels cells with a label band above
+    each, and footer_pixels of free space below the grid. Returns (image,
+    origins) where origins holds the (row, col) of each cell's top-left corner,
+    for placing labels.
+    """
+    columns = columns or int(np.ceil(np.sqrt(len(tiles))))
+    rows = int(np.ceil(len(tiles) / columns))
+    cell_h, cell_w = tile_pixels + label_pixels + gap, tile_pixels + gap
+    image = np.full((rows * cell_h + gap + footer_pixels, columns * cell_w + gap, 4), 255, dtype=np.uint8)
+    origins = []
+    for i, tile in enumerate(tiles):
+        r0 = (i // columns) * cell_h + gap
+        c0 = (i % columns) * cell_w + gap
+        origins.append((r0, c0))
+        top = r0 + label_pixels + (tile_pixels - tile.shape[0]) // 2
+        left = c0 + (tile_pixels - tile.shape[1]) // 2
+        image[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+    return image, origins
+
+SESSION_EXTENSION = '.muadsession'
+SESSION_FORMAT_VERSION = 1
+
+def binary_backing_path(mat, source=None):
+    """Return an existing .npy file holding exactly mat, or None.
+
+    source is the file mat was loaded from unchanged, if any.
+    """
+    path = None
+    if is_out_of_core(mat):
+        path = os.path.abspath(mat.filename)
+    elif source and os.path.exists(source):
+        path = os.path.abspath(source) if source.endswith('.npy') else cached_matrix_path(source)
+    if path is None or not os.path.exists(path):
+        return None
+    # Guard against overview levels and other derived arrays
+    if np.load(path, mmap_mode='r').shape != mat.shape:
+        return None
+    return path
+
+def save_session_file(path, state, matrices):
+    """Write a session file.
+
+    state is the JSON-serialisable view state; matrices maps slot names to
+    (matrix, source path or None). Matrices are stored as references to their
+    .npy files on disk, and embedded in a '<session>_data' directory next to the
+    session file when no such file exists or their source file has moved.
+    """
+    data_dir = os.path.splitext(path)[0] + "_data"
+    refs = {}
+    for slot, (mat, source) in matrices.items():
+        if mat is None:
+            continue
+        ref = {'source': os.path.abspath(source) if source else None, 'binary': None, 'embedded': None,
+               'shape': list(mat.shape)}
+        binary = binary_backing_path(mat, source)
+        embedded_path = os.path.join(data_dir, f"{slot}.npy")
+        if binary is not None and os.path.abspath(binary) == os.path.abspath(embedded_path):
+            # Saving over the same session, the embedded copy is already there
+            ref['embedded'] = os.path.basename(embedded_path)
+        elif binary is not None and (source is None or os.path.exists(source)):
+            ref['binary'] = binary
+        else:
+            save_matrix_binary(embedded_path, mat)
+            ref['binary'] = binary
+            ref['embedded'] = os.path.basename(embedded_path)
+        refs[slot] = ref
+
+    state = dict(state, format='muaddata-session', version=SESSION_FORMAT_VERSION, matrices=refs)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+def load_session_file(path):
+    """Read a session file and return its state dict."""
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('format') != 'muaddata-session':
+        raise ValueError("Not a Muad'Data session file.")
+    if state.get('version', 0) > SESSION_FORMAT_VERSION:
+        raise ValueError("The session was written by a newer version of Muad'Data.")
+    return state
+
+def resolve_session_matrix(state, slot, session_path):
+    """Load a session matrix like a normal open, or return None if it is not in the session.
+
+    Tries the referenced binary file, then the embedded copy, then reloads the
+    source file. Only maps above the out-of-core threshold are memory-mapped.
+    """
+    ref = state.get('matrices', {}).get(slot)
+    if ref is None:
+        return None
+    candidates = []
+    if ref.get('binary'):
+        candidates.append(ref['binary'])
+    if ref.get('embedded'):
+        candidates.append(os.path.join(os.path.splitext(session_path)[0] + "_data", ref['embedded']))
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            # Mapping only reads the header
+            if list(np.load(candidate, mmap_mode='r').shape) == ref['shape']:
+                return load_view_matrix(candidate)
+    source = ref.get('source')
+    if source and os.path.exists(source):
+        mat = load_view_matrix(source)
+        if list(mat.shape) == ref['shape']:
+            return mat
+    raise FileNotFoundError(f"Could not find the data for '{slot}' (source: {source}).")
+
+class DatasetCatalog:
+    """Index of ingested element maps by dataset (sample) name and element."""
+
+    def __init__(self):
+        self.entries = {}  # path -> entry dict
+        self.lock = threading.Lock()
+
+    def add(self, path, info):
+        file_name = os.path.basename(path)
+        entry = dict(info, path=path, dataset=parse_dataset_root(file_name), element=parse_element_name(file_name))
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def remove(self, path):
+        with self.lock:
+            return self.entries.pop(path, None)
+
+    def datasets(self):
+        with self.lock:
+            return sorted({e['dataset'] for e in self.entries.values()})
+
+    def elements(self, dataset):
+        """Return {element: entry} for one dataset."""
+        with self.lock:
+            return {e['element']: e for e in self.entries.values() if e['dataset'] == dataset}
+
+    def all_entries(self):
+        with self.lock:
+            return sorted(self.entries.values(), key=lambda e: (e['dataset'], e['element']))
+
+def _ingest_matrix_file(path):
+    # Runs in a worker process: parse into the binary cache and return summary information only
+    if is_out_of_core_file(path):
+        stats = tiled_stats(open_out_of_core(path))
+        shape = np.load(path if path.endswith('.npy') else cached_matrix_path(path), mmap_mode='r').shape
+        min_val, max_val = stats['min'], stats['max']
+    else:
+        mat = load_matrix(path)
+        shape = mat.shape
+        min_val, max_val = matrix_range(mat)
+    st = os.stat(path)
+    return {'shape': tuple(shape), 'min': float(min_val), 'max': float(max_val),
+            'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+class _Inotify:
+    """Minimal ctypes wrapper around Linux inotify for one directory."""
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed")
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return a list of (name, deleted) events."""
+        import select
+        import struct
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            _, mask, _, name_len = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + name_len].rstrip(b'\0')
+            offset += 16 + name_len
+            if name:
+                events.append((os.fsdecode(name), bool(mask & (self.IN_DELETE | self.IN_MOVED_FROM))))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher:
+    """Watch a directory and ingest new or changed matrix files in the background.
+
+    Changes are detected with inotify where available, otherwise by polling.
+    A file is only ingested once its size and modification time have stayed the
+    same for settle_seconds, so half-written exports are not read. At most
+    max_workers files are parsed at once; the rest wait in a queue. Results are
+    put on self.events as ('ingested', path, info), ('failed', path, error)
+    or ('removed', path, None) for the GUI to pick up.
+    """
+
+    def __init__(self, directory, settle_seconds=2.0, poll_interval=1.0, max_workers=2, retries=3):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.max_workers = max_workers
+        self.retries = retries
+        self.events = queue.Queue()
+        self.mode = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._ingested = {}  # path -> (mtime_ns, size) of the version already ingested
+        self._pending = {}   # path -> [(mtime_ns, size), last change time, failed attempts]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _is_matrix_file(self, name):
+        return name.lower().endswith(MATRIX_EXTENSIONS) and not name.startswith('~$') and not name.startswith('.')
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _scan(self):
+        """Mark every matrix file whose signature differs from the ingested one as pending."""
+        seen = set()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and self._is_matrix_file(entry.name):
+                    seen.add(entry.path)
+                    self._touch(entry.path)
+        for path in list(self._ingested):
+            if path not in seen:
+                self._removed(path)
+
+    def _touch(self, path):
+        signature = self._signature(path)
+        if signature is None or signature == self._ingested.get(path):
+            return
+        pending = self._pending.get(path)
+        if pending is None or pending[0] != signature:
+            attempts = pending[2] if pending else 0
+            self._pending[path] = [signature, time.monotonic(), attempts]
+
+    def _removed(self, path):
+        self._pending.pop(path, None)
+        if self._ingested.pop(path, None) is not None:
+            self.events.put(('removed', path, None))
+
+    def _run(self):
+        try:
+            notifier = _Inotify(self.directory)
+            self.mode = 'inotify'
+        except (OSError, AttributeError):
+            notifier = None
+            self.mode = 'polling'
+        self._scan()
+
+        in_flight = {}
+        last_poll = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self._stop.is_set():
+                # Spin faster while files are being parsed so finished workers are refilled promptly
+                wait = 0.02 if in_flight else 0.25
+                if notifier is not None:
+                    for name, deleted in notifier.read(wait):
+                        if self._is_matrix_file(name):
+                            path = os.path.join(self.directory, name)
+                            if deleted:
+                                self._removed(path)
+                            else:
+                                self._touch(path)
+                else:
+                    self._stop.wait(wait)
+                if notifier is None and time.monotonic() - last_poll >= self.poll_interval:
+                    self._scan()
+                    last_poll = time.monotonic()
+
+                # Re-check pending files: any change restarts the settle timer
+                now = time.monotonic()
+                ready = []
+                for path, pending in list(self._pending.items()):
+                    if path in in_flight.values():
+                        continue
+                    signature = self._signature(path)
+                    if signature is None:
+                        self._removed(path)
+                    elif signature != pending[0]:
+                        pending[0], pending[1] = signature, now
+                    elif now - pending[1] >= self.settle_seconds:
+                        ready.append(path)
+
+                for path in sorted(ready, key=lambda p: self._pending[p][1]):
+                    if len(in_flight) >= self.max_workers:
+                        break
+                    in_flight[executor.submit(_ingest_matrix_file, path)] = path
+
+                for future in [f for f in in_flight if f.done()]:
+                    path = in_flight.pop(future)
+                    pending = self._pending.get(path)
+                    try:
+                        info = future.result()
+                    except Exception as e:
+                        # Possibly still being written; retry after another settle period
+                        if pending is not None:
+                            pending[1] = time.monotonic()
+                            pending[2] += 1
+                            if pending[2] >= self.retries:
+                                self._pending.pop(path, None)
+                                self._ingested[path] = pending[0]
+                                self.events.put(('failed', path, str(e)))
+                        continue
+                    signature = (info['mtime_ns'], info['size'])
+                    if pending is not None and pending[0] == signature:
+                        self._pending.pop(path)
+                    self._ingested[path] = signature
+                    self.events.put(('ingested', path, info))
+            for future in in_flight:
+                future.cancel()
+        if notifier is not None:
+            notifier.close()
+
+# Tile server: square tiles of this many pixels, z = 0 being the coarsest pyramid level
+TILE_SIZE = 256
+# Rendered PNG tiles are cached in memory up to this many bytes
+TILE_CACHE_BYTES = 256 * 1024 ** 2
+
+def encode_png(rgba, compress_level=1):
+    """Encode an RGBA uint8 image (rows, cols, 4) as PNG bytes."""
+    rows, cols = rgba.shape[:2]
+    raw = np.empty((rows, cols * 4 + 1), dtype=np.uint8)
+    raw[:, 0] = 0  # No per-row filter
+    raw[:, 1:] = rgba.reshape(rows, -1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', cols, rows, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), compress_level)) + chunk(b'IEND', b''))
+
+TILE_VIEWER_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Muad'Data tiles</title>
+<style>body{font-family:Arial,sans-serif;margin:0}#bar{padding:6px;background:#eee}
+#view{position:absolute;top:40px;bottom:0;left:0;right:0;overflow:auto;background:#222}
+#view img{position:absolute;image-rendering:pixelated}</style></head>
+<body><div id="bar"><select id="map"></select> Colormap <input id="cmap" value="viridis" size="8">
+Min <input id="min" size="6"> Max <input id="max" size="6">
+<button onclick="zoom(-1)">-</button><button onclick="zoom(1)">+</button> <span id="info"></span></div>
+<div id="view"><div id="plane" style="position:relative"></div></div>
+<script>
+let maps = {}, z = 0;
+const $ = id => document.getElementById(id);
+function draw() {
+  const m = maps[$('map').value], plane = $('plane'), t = m.tile_size;
+  z = Math.max(0, Math.min(z, m.zoom_levels - 1));
+  const scale = 2 ** (m.zoom_levels - 1 - z), rows = Math.ceil(m.shape[0] / scale), cols = Math.ceil(m.shape[1] / scale);
+  plane.innerHTML = ''; plane.style.width = cols + 'px'; plane.style.height = rows + 'px';
+  const q = new URLSearchParams({cmap: $('cmap').value});
+  if ($('min').value) q.set('min', $('min').value);
+  if ($('max').value) q.set('max', $('max').value);
+  for (let y = 0; y * t < rows; y++) for (let x = 0; x * t < cols; x++) {
+    const img = new Image(); img.style.left = x * t + 'px'; img.style.top = y * t + 'px';
+    img.src = `/tiles/${encodeURIComponent(m.name)}/${z}/${x}/${y}.png?${q}`; plane.appendChild(img);
+  }
+  $('info').textContent = `zoom ${z} / ${m.zoom_levels - 1}, range ${m.range[0].toPrecision(4)} - ${m.range[1].toPrecision(4)}`;
+}
+function zoom(d) { z += d; draw(); }
+fetch('/maps').then(r => r.json()).then(list => {
+  for (const m of list) { maps[m.name] = m; $('map').add(new Option(m.name, m.name)); }
+  if (list.length) draw();
+});
+for (const id of ['map', 'cmap', 'min', 'max']) $(id).onchange = draw;
+</script></body></html>
+"""
+
+class TileServer:
+    """Serve element maps over HTTP as z/x/y PNG tiles.
+
+    Each map gets a pyramid (memory-mapped for out-of-core maps); zoom level z
+    is pyramid level len(levels) - 1 - z, so z = 0 shows the whole map in one
+    tile. Tiles are rendered through the colormap lookup table by a thread
+    pool and cached as PNG bytes in a memory-bounded LRU cache. Identical
+    requests arriving while a tile is being rendered share one render.
+
+    Endpoints: '/' (a minimal browser viewer), '/maps', '/stats' and
+    '/tiles/<map>/<z>/<x>/<y>.png?cmap=viridis&min=0&max=100&transform=Log&param=1'.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, cache_bytes=TILE_CACHE_BYTES, workers=None):
+        self.host, self.port = host, port
+        self.maps = {}
+        self.cache = LRUCache(cache_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1))
+        self.rendered = 0  # guarded by _lock: tiles render on the worker threads
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.httpd = None
+
+    def add_map(self, path):
+        """Load a matrix file and build its pyramid; returns the map name used in tile URLs."""
+        mat = load_view_matrix(path)
+        levels = build_pyramid(mat, pyramid_cache_prefix(mat) if is_out_of_core(mat) else None)
+        stem = name = os.path.splitext(os.path.basename(path))[0]
+        suffix = 1
+        while name in self.maps:
+            suffix += 1
+            name = f"{stem}-{suffix}"
+        self.maps[name] = {'path': os.path.abspath(path), 'levels': levels,
+                           'range': tuple(float(v) for v in matrix_range(mat))}
+        return name
+
+    def map_info(self):
+        return [{'name': name, 'shape': list(entry['levels'][0].shape), 'zoom_levels': len(entry['levels']),
+                 'range': list(entry['range']), 'tile_size': TILE_SIZE} for name, entry in self.maps.items()]
+
+    def stats(self):
+        cache = self.cache.stats()
+        with self._lock:
+            rendered = self.rendered
+        return {'tiles_rendered': rendered, 'cache_hits': cache['hits'], 'cache_misses': cache['misses'],
+                'cache_evictions': cache['evictions'], 'cache_bytes': cache['bytes'], 'cached_tiles': cache['entries']}
+
+    def render_tile(self, name, z, x, y, cmap, vmin, vmax, transform, param):
+        """Render one tile to PNG bytes; raises KeyError for tiles outside the map."""
+        levels = self.maps[name]['levels']
+        level = len(levels) - 1 - z
+        if not 0 <= level < len(levels) or x < 0 or y < 0:
+            raise KeyError((z, x, y))
+        data = levels[level]
+        r0, c0 = y * TILE_SIZE, x * TILE_SIZE
+        if r0 >= data.shape[0] or c0 >= data.shape[1]:
+            raise KeyError((z, x, y))
+        forward = display_transform(transform, param)[0]
+        lo, hi = (float(v) for v in forward(self.maps[name]['range']))
+        lut = build_colormap_lut(cmap, lo, hi, float(forward(vmin)), float(forward(vmax)), nan_rgba=(0, 0, 0, 0))
+        region = forward(data[r0:r0 + TILE_SIZE, c0:c0 + TILE_SIZE])
+        # Edge tiles are padded with transparent pixels
+        rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        rgba[:region.shape[0], :region.shape[1]] = lut[quantize_levels(region, lo, hi)]
+        with self._lock:
+            self.rendered += 1
+        return encode_png(rgba)
+
+    def tile(self, name, z, x, y, cmap='viridis', vmin=None, vmax=None, transform='Linear', param=None):
+        """Return the PNG bytes of a tile, from the cache or rendered on the worker pool."""
+        if name not in self.maps:
+            raise KeyError(name)
+        if cmap not in plt.colormaps():
+            raise ValueError(f"Unknown colormap '{cmap}'.")
+        if transform not in DISPLAY_TRANSFORMS:
+            raise ValueError(f"Unknown transform '{transform}'.")
+        lo, hi = self.maps[name]['range']
+        key = (name, z, x, y, cmap, lo if vmin is None else vmin, hi if vmax is None else vmax,
+               transform, DISPLAY_TRANSFORMS[transform][2] if param is None else param)
+        png = self.cache.get(key)
+        if png is not None:
+            return png
+        with self._lock:
+            future = self._pending.get(key)
+            submitted = future is None
+            if submitted:
+                future = self.executor.submit(self.render_tile, *key)
+                self._pending[key] = future
+        # A render that already finished runs the callback here, so it must not hold _lock
+        if submitted:
+            future.add_done_callback(lambda f, key=key: self._finish(key, f))
+        return future.result()
+
+    def _finish(self, key, future):
+        if future.exception() is None:
+            png = future.result()
+            self.cache.put(key, png, len(png))
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def serve_forever(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _TileRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.tiles = self
+        self.port = self.httpd.server_address[1]
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.executor.shutdown(wait=False)
+
+    def shutdown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+
+class _TileRequestHandler(BaseHTTPRequestHandler):
+    server_version = "MuadData"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/')]
+        tiles = self.server.tiles
+        try:
+            if url.path == '/':
+                self.reply(200, 'text/html; charset=utf-8', TILE_VIEWER_HTML.encode())
+            elif parts == ['maps']:
+                self.reply(200, 'application/json', json.dumps(tiles.map_info()).encode())
+            elif parts == ['stats']:
+                self.reply(200, 'application/json', json.dumps(tiles.stats()).encode())
+            elif len(parts) == 5 and parts[0] == 'tiles' and parts[4].endswith('.png'):
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-len('.png')])
+                numbers = {k: float(query[k]) if k in query else None for k in ('min', 'max', 'param')}
+                png = tiles.tile(parts[1], z, x, y, query.get('cmap', 'viridis'), numbers['min'], numbers['max'],
+                                 query.get('transform', 'Linear'), numbers['param'])
+                self.reply(200, 'image/png', png, cache=True)
+            else:
+                self.reply(404, 'text/plain', b'Not found')
+        except KeyError:
+            self.reply(404, 'text/plain', b'No such tile')
+        except ValueError as e:
+            self.reply(400, 'text/plain', str(e).encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def reply(self, status, content_type, body, cache=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cache:
+            self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_tile_server(paths, host='127.0.0.1', port=8765, cache_mb=TILE_CACHE_BYTES // 1024 ** 2, workers=None):
+    """Load the matrix files (or directories of them) in paths and serve their tiles until interrupted."""
+    server = TileServer(host, port, cache_mb * 1024 ** 2, workers)
+    for path in paths:
+        for file_path in list_matrix_files(path) if os.path.isdir(path) else [path]:
+            print(f"Loading {file_path} as '{server.add_map(file_path)}'")
+    if not server.maps:
+        raise SystemExit("No matrix files to serve.")
+    print(f"Serving {len(server.maps)} maps on http://{host}:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+class ChannelComposer:
+    """Running sum of the tinted channel contributions of the RGB overlay.
+
+    Every channel's scaled map and colour weights are kept next to the sum,
+    so a change to one channel (its maximum, colour or data) adds the
+    difference between its new and old contribution and leaves the other
+    channels alone. Worker threads and the Tk thread share a composer
+    through its lock.
+    """
+
+    # Subtracting and adding contributions slowly accumulates rounding error
+    REBUILD_EVERY = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> (key, scaled map, colour weights)
+        self.percentiles = {}  # channel -> (data key, 99th percentile) for normalized scaling
+        self.total = None
+        self.grid = None
+        self.updates = 0
+
+    def reset(self, grid, shape):
+        """Forget all channels unless the sum is already for grid (any hashable description of the pixel grid)."""
+        if grid != self.grid:
+            self.channels = {}
+            self.total = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+            self.grid = grid
+
+    def key(self, channel):
+        """The key the channel was last composed with, or None."""
+        entry = self.channels.get(channel)
+        return entry[0] if entry is not None else None
+
+    def scaled(self, channel):
+        entry = self.channels.get(channel)
+        return entry[1] if entry is not None else None
+
+    def update(self, channel, key, scaled, weights):
+        """Replace a channel's contribution; scaled=None removes the channel."""
+        old = self.channels.pop(channel, None)
+        if scaled is not None:
+            self.channels[channel] = (key, scaled, weights)
+        self.updates += 1
+        if self.updates % self.REBUILD_EVERY == 0:
+            self.total.fill(0)
+            for _, mat, wts in self.channels.values():
+                self._add(mat, wts)
+            return
+        if old is not None and scaled is not None and old[1] is scaled:
+            # Only the colour changed
+            self._add(scaled, tuple(new - prev for new, prev in zip(weights, old[2])))
+        elif old is not None and scaled is not None and old[2] == weights:
+            # Only the scaling or data changed: one difference, then one pass per colour component
+            self._add(scaled - old[1], weights)
+        else:
+            if old is not None:
+                self._add(old[1], tuple(-w for w in old[2]))
+            if scaled is not None:
+                self._add(scaled, weights)
+
+    def _add(self, mat, weights):
+        for i, weight in enumerate(weights):
+            if weight:
+                self.total[..., i] += mat * np.float32(weight)
+
+    def image(self):
+        """The composed overlay as 8-bit RGB."""
+        rgb = np.clip(self.total, 0, 1)
+        rgb *= 255
+        rgb += 0.5
+        return rgb.astype(np.uint8)
@@ -7,6 +7,26 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import os
 import re
+import queue
+import hashlib
+import threading
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from muad_data_core import (MATRIX_FILETYPES, CACHE_DIR, STORAGE_DTYPE, save_matrix_binary, decimal_values,
+    parse_element_name, parse_dataset_root, validate_expression, apply_expression, list_matrix_files, natural_sort_key,
+    parse_expression_table, plan_batch_math, run_batch_math, list_line_scan_files, ingest_line_scans,
+    density_histogram, correlation_coefficients, otsu_threshold, segment_objects, SEGMENT_TABLE_ROWS,
+    object_statistics, CLUSTER_SCALINGS, memmap_matrix_file, feature_statistics, fit_phase_model, assign_phases,
+    transect_points, spline_coefficients, sample_profile, align_channels, is_out_of_core, tiled_histogram,
+    tiled_apply_expression, MapExpression, block_mean, build_pyramid, pyramid_window, pyramid_cache_prefix,
+    load_view_matrix, matrix_range, DERIVED_CACHE_BYTES, LRUCache, matrix_generation, MatrixStore, DENOISE_FILTERS,
+    denoise_matrix, derived_cache_path, display_transform, transform_matrix, EQUALIZATIONS, VIEW_TRANSFORMS,
+    EqualizationTiles, LUT_SIZE, quantize_levels, build_colormap_lut, CALIBRATION_MODELS, match_element,
+    read_certified_values, parse_roi, roi_mean, Calibration, calibrate_standards, quantify_matrix, group_sample_maps,
+    sibling_element_path, calibration_expression, sketch_matrix, percentile_key, element_scaling, MONTAGE_SCALINGS,
+    SHARED_LIMITS, render_montage_tile, layout_montage, SESSION_EXTENSION, save_session_file, load_session_file,
+    resolve_session_matrix, DatasetCatalog, DirectoryWatcher, TILE_CACHE_BYTES, run_tile_server, ChannelComposer)
 
 class MathExpressionDialog:
     def __init__(self, parent, title="Enter Mathematical Expression"):
@@ -99,8 +119,7 @@ class MathExpressionDialog:
         # Validate expression
         try:
             # Test with a sample value
-            x = 1.0
-            eval(expression, {"__builtins__": {}}, {"x": x, "np": np})
+            validate_expression(expression)
             self.result = expression
             self.dialog.destroy()
         except Exception as e:
@@ -109,6 +128,2670 @@ class MathExpressionDialog:
     def cancel(self):
         self.dialog.destroy()
 
+class BatchMathDialog:
+    def __init__(self, parent, title="Batch Map Math"):
+        self.parent = parent
+        self.input_dir = tk.StringVar()
+        self.output_dir = tk.StringVar()
+        self.workers = tk.IntVar(value=os.cpu_count() or 1)
+        self.progress_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title(title)
+        self.dialog.geometry("560x560")
+        self.dialog.transient(parent)
+        self.dialog.geometry("+%d+%d" % (parent.winfo_rootx() + 50, parent.winfo_rooty() + 50))
+        self.build_dialog()
+
+    def build_dialog(self):
+        main_frame = tk.Frame(self.dialog, padx=20, pady=20)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        tk.Label(main_frame, text="Batch Map Math", font=("Arial", 14, "bold")).pack(pady=(0, 10))
+
+        # Input and output directories
+        for label, var, command in [("Input directory:", self.input_dir, self.browse_input),
+                                    ("Output directory:", self.output_dir, self.browse_output)]:
+            tk.Label(main_frame, text=label, font=("Arial", 12)).pack(anchor='w')
+            row = tk.Frame(main_frame)
+            row.pack(fill=tk.X, pady=(2, 8))
+            tk.Entry(row, textvariable=var, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+            tk.Button(row, text="Browse", command=command, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        tk.Label(main_frame, text="Expression for all files (using 'x'):", font=("Arial", 12)).pack(anchor='w')
+        self.expression_entry = tk.Entry(main_frame, font=("Arial", 12))
+        self.expression_entry.pack(fill=tk.X, pady=(2, 8))
+        self.expression_entry.insert(0, "x * 0.001")
+
+        tk.Label(main_frame, text="Per-element expressions (optional, one 'Element: expression' per line):",
+                 font=("Arial", 11), justify=tk.LEFT).pack(anchor='w')
+        self.table_text = tk.Text(main_frame, height=6, font=("Arial", 11))
+        self.table_text.pack(fill=tk.BOTH, expand=True, pady=(2, 8))
+
+        workers_row = tk.Frame(main_frame)
+        workers_row.pack(fill=tk.X)
+        tk.Label(workers_row, text="Worker processes:", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Spinbox(workers_row, from_=1, to=max(os.cpu_count() or 1, 1), textvariable=self.workers, width=5,
+                   font=("Arial", 12)).pack(side=tk.LEFT, padx=(5, 0))
+
+        self.progress_bar = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.progress_bar.pack(fill=tk.X, pady=(15, 5))
+        self.status_label = tk.Label(main_frame, text="Idle", font=("Arial", 10, "italic"), anchor='w', justify=tk.LEFT, wraplength=500)
+        self.status_label.pack(fill=tk.X)
+
+        button_frame = tk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(15, 0))
+        self.start_btn = tk.Button(button_frame, text="Run Batch", command=self.start,
+                                   font=("Arial", 12, "bold"), bg="#4CAF50", fg="white", padx=20)
+        self.start_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        tk.Button(button_frame, text="Close", command=self.close, font=("Arial", 12), padx=20).pack(side=tk.RIGHT)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse_input(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps")
+        if directory:
+            self.input_dir.set(directory)
+            if not self.output_dir.get():
+                self.output_dir.set(os.path.join(directory, "math"))
+
+    def browse_output(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select output directory")
+        if directory:
+            self.output_dir.set(directory)
+
+    def start(self):
+        input_dir = self.input_dir.get().strip()
+        output_dir = self.output_dir.get().strip()
+        if not os.path.isdir(input_dir):
+            messagebox.showerror("Error", "Please select an existing input directory.", parent=self.dialog)
+            return
+        if not output_dir:
+            messagebox.showerror("Error", "Please select an output directory.", parent=self.dialog)
+            return
+
+        expression = self.expression_entry.get().strip()
+        try:
+            if expression:
+                validate_expression(expression)
+            expression_table = parse_expression_table(self.table_text.get("1.0", tk.END))
+        except Exception as e:
+            messagebox.showerror("Invalid Expression", f"The expression contains an error:\n{str(e)}", parent=self.dialog)
+            return
+
+        jobs = plan_batch_math(list_matrix_files(input_dir), expression, expression_table, output_dir)
+        if not jobs:
+            messagebox.showwarning("No Files", "No matrix files with a matching expression were found.", parent=self.dialog)
+            return
+
+        self.cancel_event.clear()
+        self.start_btn.config(state=tk.DISABLED)
+        self.progress_bar.config(maximum=len(jobs), value=0)
+        self.status_label.config(text=f"Processing {len(jobs)} file(s)...")
+        self.worker_thread = threading.Thread(target=self.run_jobs, args=(jobs, output_dir, max(self.workers.get(), 1)), daemon=True)
+        self.worker_thread.start()
+        self.poll_progress()
+
+    def run_jobs(self, jobs, output_dir, workers):
+        # Runs on a background thread; results are handed to Tk through the queue
+        try:
+            summary = run_batch_math(jobs, output_dir, max_workers=workers,
+                                     progress=lambda done, total, msg: self.progress_queue.put(('progress', done, total, msg)),
+                                     cancel_event=self.cancel_event)
+            self.progress_queue.put(('finished', summary))
+        except Exception as e:
+            self.progress_queue.put(('error', str(e)))
+
+    def poll_progress(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            while True:
+                item = self.progress_queue.get_nowait()
+                if item[0] == 'progress':
+                    _, done, total, message = item
+                    self.progress_bar.config(value=done)
+                    self.status_label.config(text=f"{done}/{total}: {message}")
+                elif item[0] == 'finished':
+                    summary = item[1]
+                    self.start_btn.config(state=tk.NORMAL)
+                    text = (f"Finished: {len(summary['done'])} processed, {len(summary['skipped'])} already up to date, "
+                            f"{len(summary['failed'])} failed.")
+                    if summary['failed']:
+                        text += "\n" + "\n".join(f"{os.path.basename(src)}: {err}" for src, err in summary['failed'][:5])
+                    self.status_label.config(text=text)
+                    return
+                elif item[0] == 'error':
+                    self.start_btn.config(state=tk.NORMAL)
+                    self.status_label.config(text="Batch failed")
+                    messagebox.showerror("Error", f"Batch Map Math failed:\n{item[1]}", parent=self.dialog)
+                    return
+        except queue.Empty:
+            pass
+        self.dialog.after(100, self.poll_progress)
+
+    def close(self):
+        if self.worker_thread is not None and self.worker_thread.is_alive():
+            if not messagebox.askyesno("Batch Running", "Stop after the files currently being processed?\n"
+                                       "Finished files are kept and the batch can be resumed later.", parent=self.dialog):
+                return
+            self.cancel_event.set()
+        self.dialog.destroy()
+
+class MapAlgebraDialog:
+    """Evaluate expressions across the element maps of one sample, e.g. 'Zn / Ca' or 'Cu / total'."""
+
+    EXAMPLES = ["Zn / Ca", "(Fe + Mn) / S", "Cu / total"]
+
+    def __init__(self, app, title="Map Algebra"):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.sample = tk.StringVar()
+        self.samples = {}  # Sample -> {element: matrix file}
+        self.result_queue = queue.Queue()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("560x560")
+        self.dialog.transient(app.root)
+        self.dialog.geometry("+%d+%d" % (app.root.winfo_rootx() + 50, app.root.winfo_rooty() + 50))
+        self.build_dialog()
+        # Start from the sample already open in the viewer
+        source = app.single_source_path or next((app.rgb_sources[ch] for ch in 'RGB' if app.rgb_sources[ch]), None)
+        if source:
+            self.set_directory(os.path.dirname(os.path.abspath(source)), parse_dataset_root(os.path.basename(source)))
+
+    def build_dialog(self):
+        main_frame = tk.Frame(self.dialog, padx=20, pady=20)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        tk.Label(main_frame, text="Map Algebra", font=("Arial", 14, "bold")).pack(pady=(0, 10))
+
+        tk.Label(main_frame, text="Sample directory:", font=("Arial", 12)).pack(anchor='w')
+        row = tk.Frame(main_frame)
+        row.pack(fill=tk.X, pady=(2, 8))
+        tk.Entry(row, textvariable=self.directory, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(row, text="Browse", command=self.browse, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        row = tk.Frame(main_frame)
+        row.pack(fill=tk.X)
+        tk.Label(row, text="Sample:", font=("Arial", 12)).pack(side=tk.LEFT)
+        self.sample_combo = ttk.Combobox(row, textvariable=self.sample, state='readonly', width=24)
+        self.sample_combo.pack(side=tk.LEFT, padx=(5, 0))
+        self.sample_combo.bind("<<ComboboxSelected>>", lambda e: self.show_elements())
+
+        tk.Label(main_frame, text="Elements (double-click to insert):", font=("Arial", 12)).pack(anchor='w', pady=(8, 0))
+        self.element_list = tk.Listbox(main_frame, height=6, font=("Arial", 11))
+        self.element_list.pack(fill=tk.X, pady=(2, 8))
+        self.element_list.bind("<Double-Button-1>", lambda e: self.insert_element())
+
+        tk.Label(main_frame, text="Expression (element names, 'total', + - * / **, np.sqrt/log/log10/exp/abs/minimum/maximum):",
+                 font=("Arial", 11), wraplength=500, justify=tk.LEFT).pack(anchor='w')
+        self.expression_entry = tk.Entry(main_frame, font=("Arial", 12))
+        self.expression_entry.pack(fill=tk.X, pady=(5, 5))
+        self.expression_entry.insert(0, self.EXAMPLES[0])
+        examples = tk.Frame(main_frame)
+        examples.pack(fill=tk.X)
+        for expr in self.EXAMPLES:
+            tk.Button(examples, text=expr, command=lambda e=expr: self.expression_entry.delete(0, tk.END) or self.expression_entry.insert(0, e),
+                      font=("Arial", 10)).pack(side=tk.LEFT, padx=(0, 5), pady=2)
+
+        self.status_label = tk.Label(main_frame, text="", font=("Arial", 10, "italic"), anchor='w', justify=tk.LEFT, wraplength=500)
+        self.status_label.pack(fill=tk.X, pady=(10, 0))
+
+        # The derived map goes straight to either tab
+        open_row = tk.Frame(main_frame)
+        open_row.pack(fill=tk.X, pady=(10, 0))
+        self.buttons = [tk.Button(open_row, text="Open in Element Viewer", command=lambda: self.evaluate('single'), font=("Arial", 10))]
+        for ch in 'RGB':
+            self.buttons.append(tk.Button(open_row, text=f"Load as {ch}", command=lambda c=ch: self.evaluate(c), font=("Arial", 10)))
+        for i, button in enumerate(self.buttons):
+            button.pack(side=tk.LEFT, padx=(5 if i else 0, 0))
+
+        button_frame = tk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(15, 0))
+        tk.Button(button_frame, text="Close", command=self.dialog.destroy, font=("Arial", 12), padx=20).pack(side=tk.RIGHT)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps")
+        if directory:
+            self.set_directory(directory)
+
+    def set_directory(self, directory, sample=None):
+        self.directory.set(directory)
+        self.samples = group_sample_maps(list_matrix_files(directory))
+        names = sorted(self.samples, key=natural_sort_key)
+        self.sample_combo.config(values=names)
+        self.sample.set(sample if sample in self.samples else next(iter(names), ''))
+        self.show_elements()
+
+    def show_elements(self):
+        self.element_list.delete(0, tk.END)
+        self.element_list.insert(tk.END, *sorted(self.samples.get(self.sample.get(), {}), key=natural_sort_key))
+
+    def insert_element(self):
+        selection = self.element_list.curselection()
+        if selection:
+            self.expression_entry.insert(tk.INSERT, self.element_list.get(selection[0]))
+
+    def evaluate(self, destination):
+        paths = self.samples.get(self.sample.get())
+        if not paths:
+            messagebox.showwarning("No Data", "Please select a directory with element maps.", parent=self.dialog)
+            return
+        try:
+            expression = MapExpression(self.expression_entry.get(), paths)
+        except ValueError as e:
+            messagebox.showerror("Invalid Expression", str(e), parent=self.dialog)
+            return
+        for button in self.buttons:
+            button.config(state=tk.DISABLED)
+        self.status_label.config(text=f"Evaluating {expression.expression.strip()}...")
+        # RGB channels of out-of-core maps are overviews, so the derived channel is computed from those
+        self.worker_thread = threading.Thread(target=self.run_evaluate, args=(expression, paths, destination), daemon=True)
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_evaluate(self, expression, paths, destination):
+        # Runs on a background thread; results are handed to Tk through the queue
+        try:
+            mat = self.app.map_algebra_result(expression, paths, overview=destination != 'single')
+            self.result_queue.put(('done', expression, destination, mat))
+        except Exception as e:
+            self.result_queue.put(('error', str(e)))
+
+    def poll_result(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            item = self.result_queue.get_nowait()
+        except queue.Empty:
+            self.dialog.after(50, self.poll_result)
+            return
+        for button in self.buttons:
+            button.config(state=tk.NORMAL)
+        if item[0] == 'error':
+            self.status_label.config(text="")
+            messagebox.showerror("Evaluation Error", f"Error evaluating expression:\n{item[1]}", parent=self.dialog)
+            return
+        _, expression, destination, mat = item
+        name = expression.expression.strip()
+        sample = self.sample.get()
+        if destination == 'single':
+            self.app.set_single_matrix(mat, f"{sample} {name}")
+        else:
+            self.app.set_rgb_channel(destination, mat, name, sample)
+        self.status_label.config(text=f"{sample} {name}: shape {mat.shape}")
+
+class LineScanDialog:
+    """Build element maps from raw time-resolved line exports."""
+
+    def __init__(self, app, title="Ingest Line Scans"):
+        self.app = app
+        self.input_dir = tk.StringVar()
+        self.output_dir = tk.StringVar()
+        self.sample = tk.StringVar()
+        self.spot_size = tk.DoubleVar(value=5.0)
+        self.scan_speed = tk.DoubleVar(value=20.0)
+        self.blank_seconds = tk.DoubleVar(value=15.0)
+        self.start_seconds = tk.DoubleVar(value=15.0)
+        self.n_pixels = tk.IntVar(value=0)
+        self.workers = tk.IntVar(value=os.cpu_count() or 1)
+        self.result = tk.StringVar()
+        self.outputs = {}
+        self.progress_queue = queue.Queue()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("560x640")
+        self.dialog.transient(app.root)
+        self.dialog.geometry("+%d+%d" % (app.root.winfo_rootx() + 50, app.root.winfo_rooty() + 50))
+        self.build_dialog()
+
+    def build_dialog(self):
+        main_frame = tk.Frame(self.dialog, padx=20, pady=20)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        tk.Label(main_frame, text="Ingest Line Scans", font=("Arial", 14, "bold")).pack(pady=(0, 10))
+
+        for label, var, command in [("Line files directory (one file per line):", self.input_dir, self.browse_input),
+                                    ("Output directory:", self.output_dir, self.browse_output)]:
+            tk.Label(main_frame, text=label, font=("Arial", 12)).pack(anchor='w')
+            row = tk.Frame(main_frame)
+            row.pack(fill=tk.X, pady=(2, 8))
+            tk.Entry(row, textvariable=var, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+            tk.Button(row, text="Browse", command=command, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        params = tk.Frame(main_frame)
+        params.pack(fill=tk.X)
+        for r, (label, var) in enumerate([("Sample name:", self.sample),
+                                          ("Spot size (\u00b5m):", self.spot_size),
+                                          ("Scan speed (\u00b5m/s):", self.scan_speed),
+                                          ("Gas blank, first (s):", self.blank_seconds),
+                                          ("Laser on at (s):", self.start_seconds),
+                                          ("Pixels per line (0 = longest line):", self.n_pixels),
+                                          ("Worker processes:", self.workers)]):
+            tk.Label(params, text=label, font=("Arial", 12)).grid(row=r, column=0, sticky='w', pady=2)
+            tk.Entry(params, textvariable=var, width=14, font=("Arial", 11)).grid(row=r, column=1, sticky='w', padx=(5, 0), pady=2)
+
+        self.progress_bar = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.progress_bar.pack(fill=tk.X, pady=(15, 5))
+        self.status_label = tk.Label(main_frame, text="Idle", font=("Arial", 10, "italic"), anchor='w', justify=tk.LEFT, wraplength=500)
+        self.status_label.pack(fill=tk.X)
+
+        # Finished maps can be opened straight away in either tab
+        result_row = tk.Frame(main_frame)
+        result_row.pack(fill=tk.X, pady=(10, 0))
+        tk.Label(result_row, text="Map:", font=("Arial", 12)).pack(side=tk.LEFT)
+        self.result_combo = ttk.Combobox(result_row, textvariable=self.result, state='readonly', width=24)
+        self.result_combo.pack(side=tk.LEFT, padx=(5, 0))
+        open_row = tk.Frame(main_frame)
+        open_row.pack(fill=tk.X, pady=(5, 0))
+        tk.Button(open_row, text="Open in Element Viewer", command=self.open_single, font=("Arial", 10)).pack(side=tk.LEFT)
+        for ch in 'RGB':
+            tk.Button(open_row, text=f"Load as {ch}", command=lambda c=ch: self.open_rgb(c), font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        button_frame = tk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(15, 0))
+        self.start_btn = tk.Button(button_frame, text="Build Maps", command=self.start,
+                                   font=("Arial", 12, "bold"), bg="#4CAF50", fg="white", padx=20)
+        self.start_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        tk.Button(button_frame, text="Close", command=self.close, font=("Arial", 12), padx=20).pack(side=tk.RIGHT)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse_input(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of raw line files")
+        if directory:
+            self.input_dir.set(directory)
+            if not self.sample.get():
+                self.sample.set(os.path.basename(os.path.normpath(directory)))
+            if not self.output_dir.get():
+                self.output_dir.set(os.path.join(directory, "maps"))
+
+    def browse_output(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select output directory")
+        if directory:
+            self.output_dir.set(directory)
+
+    def start(self):
+        input_dir = self.input_dir.get().strip()
+        output_dir = self.output_dir.get().strip()
+        if not os.path.isdir(input_dir):
+            messagebox.showerror("Error", "Please select an existing line files directory.", parent=self.dialog)
+            return
+        if not output_dir:
+            messagebox.showerror("Error", "Please select an output directory.", parent=self.dialog)
+            return
+        try:
+            spot_size, scan_speed = self.spot_size.get(), self.scan_speed.get()
+            blank_seconds, start_seconds = self.blank_seconds.get(), self.start_seconds.get()
+            n_pixels, workers = self.n_pixels.get(), max(self.workers.get(), 1)
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Invalid Value", "Please enter numbers for the scan parameters.", parent=self.dialog)
+            return
+        if spot_size <= 0 or scan_speed <= 0:
+            messagebox.showerror("Invalid Value", "Spot size and scan speed must be greater than 0.", parent=self.dialog)
+            return
+        paths = list_line_scan_files(input_dir)
+        if not paths:
+            messagebox.showwarning("No Files", "No raw line files (.csv, .txt) were found.", parent=self.dialog)
+            return
+
+        self.start_btn.config(state=tk.DISABLED)
+        self.progress_bar.config(maximum=len(paths), value=0)
+        self.status_label.config(text=f"Binning {len(paths)} line(s) at {spot_size / scan_speed * 1000:.0f} ms per pixel...")
+        kwargs = dict(spot_size=spot_size, scan_speed=scan_speed, blank_seconds=blank_seconds, start_seconds=start_seconds,
+                      n_pixels=n_pixels or None, max_workers=workers,
+                      progress=lambda done, total, msg: self.progress_queue.put(('progress', done, total, msg)))
+        self.worker_thread = threading.Thread(target=self.run_ingest, args=(paths, output_dir, self.sample.get()),
+                                              kwargs=kwargs, daemon=True)
+        self.worker_thread.start()
+        self.poll_progress()
+
+    def run_ingest(self, paths, output_dir, sample, **kwargs):
+        # Runs on a background thread; results are handed to Tk through the queue
+        try:
+            self.progress_queue.put(('finished', ingest_line_scans(paths, output_dir, sample, **kwargs)))
+        except Exception as e:
+            self.progress_queue.put(('error', str(e)))
+
+    def poll_progress(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            while True:
+                item = self.progress_queue.get_nowait()
+                if item[0] == 'progress':
+                    _, done, total, message = item
+                    self.progress_bar.config(value=done)
+                    self.status_label.config(text=f"{done}/{total}: {message}")
+                elif item[0] == 'finished':
+                    outputs = item[1]
+                    self.start_btn.config(state=tk.NORMAL)
+                    self.outputs = {parse_element_name(os.path.basename(path)): path for path in outputs}
+                    self.result_combo.config(values=list(self.outputs))
+                    self.result.set(next(iter(self.outputs), ''))
+                    self.status_label.config(text=f"Finished: {len(outputs)} map(s) written to {os.path.dirname(outputs[0])}")
+                    return
+                elif item[0] == 'error':
+                    self.start_btn.config(state=tk.NORMAL)
+                    self.status_label.config(text="Ingestion failed")
+                    messagebox.showerror("Error", f"Line scan ingestion failed:\n{item[1]}", parent=self.dialog)
+                    return
+        except queue.Empty:
+            pass
+        self.dialog.after(100, self.poll_progress)
+
+    def selected_output(self):
+        path = self.outputs.get(self.result.get())
+        if path is None:
+            messagebox.showwarning("No Map", "Build the maps first.", parent=self.dialog)
+        return path
+
+    def open_single(self):
+        path = self.selected_output()
+        if path:
+            self.app.load_single_file(path)
+
+    def open_rgb(self, channel):
+        path = self.selected_output()
+        if path:
+            self.app.load_rgb_file(channel, path)
+
+    def close(self):
+        if self.worker_thread is not None and self.worker_thread.is_alive():
+            if not messagebox.askyesno("Ingestion Running", "Close the dialog? The maps are still written when the current run finishes.",
+                                       parent=self.dialog):
+                return
+        self.dialog.destroy()
+
+class WatchDialog:
+    def __init__(self, app, title="Watch Directory"):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.watcher = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("640x460")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        self.refresh_catalog()
+
+    def build_dialog(self):
+        main_frame = tk.Frame(self.dialog, padx=15, pady=15)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        row = tk.Frame(main_frame)
+        row.pack(fill=tk.X)
+        tk.Label(row, text="Directory:", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Entry(row, textvariable=self.directory, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        tk.Button(row, text="Browse", command=self.browse, font=("Arial", 10)).pack(side=tk.LEFT)
+        self.start_btn = tk.Button(row, text="Start", command=self.toggle, font=("Arial", 11, "bold"), width=6)
+        self.start_btn.pack(side=tk.LEFT, padx=(5, 0))
+
+        self.status_label = tk.Label(main_frame, text="Not watching", font=("Arial", 10, "italic"), anchor='w')
+        self.status_label.pack(fill=tk.X, pady=(8, 4))
+
+        columns = ("dataset", "element", "shape", "range", "file")
+        self.tree = ttk.Treeview(main_frame, columns=columns, show='headings', height=14)
+        for col, text, width in [("dataset", "Dataset", 100), ("element", "Element", 70), ("shape", "Shape", 90),
+                                 ("range", "Range", 140), ("file", "File", 220)]:
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor='w')
+        self.tree.pack(fill=tk.BOTH, expand=True)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory to watch")
+        if directory:
+            self.directory.set(directory)
+
+    def toggle(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+            self.start_btn.config(text="Start")
+            self.status_label.config(text="Not watching")
+            return
+        directory = self.directory.get().strip()
+        if not os.path.isdir(directory):
+            messagebox.showerror("Error", "Please select an existing directory.", parent=self.dialog)
+            return
+        self.watcher = DirectoryWatcher(directory)
+        self.watcher.start()
+        self.start_btn.config(text="Stop")
+        self.status_label.config(text=f"Watching {directory}")
+        self.poll_events()
+
+    def poll_events(self):
+        if self.watcher is None or not self.dialog.winfo_exists():
+            return
+        changed = False
+        try:
+            # Bounded batch per tick keeps Tk responsive when hundreds of files land at once
+            for _ in range(200):
+                kind, path, info = self.watcher.events.get_nowait()
+                changed = True
+                if kind == 'ingested':
+                    self.app.catalog.add(path, info)
+                    self.app.refresh_watched_file(path)
+                    self.status_label.config(text=f"Ingested {os.path.basename(path)}")
+                elif kind == 'removed':
+                    self.app.catalog.remove(path)
+                elif kind == 'failed':
+                    self.status_label.config(text=f"Could not read {os.path.basename(path)}: {info}")
+        except queue.Empty:
+            pass
+        if changed:
+            self.refresh_catalog()
+        if self.watcher is not None and self.watcher.mode:
+            self.dialog.title(f"Watch Directory ({self.watcher.mode})")
+        self.dialog.after(200, self.poll_events)
+
+    def refresh_catalog(self):
+        self.tree.delete(*self.tree.get_children())
+        for entry in self.app.catalog.all_entries():
+            shape = "x".join(str(n) for n in entry['shape'])
+            value_range = f"{entry['min']:.4g} - {entry['max']:.4g}"
+            self.tree.insert('', tk.END, values=(entry['dataset'], entry['element'], shape, value_range,
+                                                 os.path.basename(entry['path'])))
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.dialog.destroy()
+
+class MontageDialog:
+    """Small multiples of every element map of one sample, rasterized in parallel."""
+
+    def __init__(self, app):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.sample = tk.StringVar()
+        self.colormap = tk.StringVar(value='viridis')
+        self.scaling = tk.StringVar(value='99th percentile')
+        self.tile_pixels = tk.IntVar(value=256)
+        self.columns = tk.IntVar(value=0)
+        self.samples = {}    # Sample name -> its matrix files
+        self.settings = {}   # Matrix file -> [colormap, scaling]
+        self.montage = None  # (image, origins, labels, downsampling factor) of the last render
+        self.result_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title("Element Montage")
+        self.dialog.geometry("1150x720")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.LEFT, fill=tk.Y)
+
+        tk.Label(control_frame, text="Directory:", font=("Arial", 12)).pack(anchor='w')
+        row = tk.Frame(control_frame)
+        row.pack(fill=tk.X, pady=(2, 8))
+        tk.Entry(row, textvariable=self.directory, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(row, text="Browse", command=self.browse, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        tk.Label(control_frame, text="Sample:", font=("Arial", 12)).pack(anchor='w')
+        self.sample_menu = ttk.Combobox(control_frame, textvariable=self.sample, state='readonly', font=("Arial", 11))
+        self.sample_menu.pack(fill=tk.X, pady=(2, 8))
+        self.sample_menu.bind("<<ComboboxSelected>>", lambda e: self.show_elements())
+
+        size_row = tk.Frame(control_frame)
+        size_row.pack(fill=tk.X, pady=(0, 8))
+        tk.Label(size_row, text="Tile size:", font=("Arial", 11)).pack(side=tk.LEFT)
+        tk.Spinbox(size_row, from_=64, to=1024, increment=64, textvariable=self.tile_pixels, width=5,
+                   font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 10))
+        tk.Label(size_row, text="Columns (0 = auto):", font=("Arial", 11)).pack(side=tk.LEFT)
+        tk.Spinbox(size_row, from_=0, to=20, textvariable=self.columns, width=3, font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 0))
+
+        self.tree = ttk.Treeview(control_frame, columns=('element', 'colormap', 'scaling'), show='headings', height=14)
+        for column, width in (('element', 90), ('colormap', 90), ('scaling', 110)):
+            self.tree.heading(column, text=column.capitalize())
+            self.tree.column(column, width=width)
+        self.tree.pack(fill=tk.BOTH, expand=True)
+
+        # Per-element settings apply to the selected rows
+        settings_row = tk.Frame(control_frame)
+        settings_row.pack(fill=tk.X, pady=(5, 0))
+        ttk.Combobox(settings_row, textvariable=self.colormap, values=plt.colormaps(), width=10,
+                     font=("Arial", 11)).pack(side=tk.LEFT)
+        ttk.Combobox(settings_row, textvariable=self.scaling, values=MONTAGE_SCALINGS, state='readonly', width=13,
+                     font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 0))
+        tk.Button(control_frame, text="Apply to Selected", command=self.apply_settings, font=("Arial", 11)).pack(fill=tk.X, pady=(5, 0))
+
+        self.progress_bar = ttk.Progressbar(control_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.progress_bar.pack(fill=tk.X, pady=(10, 2))
+        self.status_label = tk.Label(control_frame, text="Choose a directory of element maps.", font=("Arial", 10, "italic"),
+                                     anchor='w', justify=tk.LEFT, wraplength=300)
+        self.status_label.pack(fill=tk.X)
+
+        button_frame = tk.Frame(control_frame)
+        button_frame.pack(fill=tk.X, pady=(10, 0))
+        self.render_btn = tk.Button(button_frame, text="Render", command=self.start, font=("Arial", 12, "bold"),
+                                    bg="#4CAF50", fg="white", padx=10)
+        self.render_btn.pack(side=tk.LEFT)
+        tk.Button(button_frame, text="Export PNG", command=self.export, font=("Arial", 12), padx=10).pack(side=tk.LEFT, padx=(5, 0))
+        tk.Button(button_frame, text="Close", command=self.close, font=("Arial", 12), padx=10).pack(side=tk.RIGHT)
+
+        self.figure, self.ax = plt.subplots(constrained_layout=True)
+        self.ax.axis('off')
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.dialog)
+        self.canvas.get_tk_widget().pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps")
+        if not directory:
+            return
+        self.directory.set(directory)
+        self.samples = {}
+        for path in sorted(list_matrix_files(directory), key=natural_sort_key):
+            self.samples.setdefault(parse_dataset_root(os.path.basename(path)), []).append(path)
+        self.sample_menu.config(values=sorted(self.samples))
+        if self.samples:
+            self.sample.set(sorted(self.samples)[0])
+            self.show_elements()
+        else:
+            self.status_label.config(text="No matrix files found in this directory.")
+
+    def show_elements(self):
+        self.tree.delete(*self.tree.get_children())
+        for path in self.samples.get(self.sample.get(), []):
+            settings = self.settings.setdefault(path, [self.colormap.get(), self.scaling.get()])
+            self.tree.insert('', tk.END, iid=path, values=(parse_element_name(os.path.basename(path)), *settings))
+        self.status_label.config(text=f"{len(self.tree.get_children())} element maps")
+
+    def apply_settings(self):
+        if self.colormap.get() not in plt.colormaps():
+            messagebox.showerror("Error", f"Unknown colormap '{self.colormap.get()}'.", parent=self.dialog)
+            return
+        for path in self.tree.selection():
+            self.settings[path] = [self.colormap.get(), self.scaling.get()]
+            self.tree.item(path, values=(parse_element_name(os.path.basename(path)), *self.settings[path]))
+
+    def start(self):
+        paths = self.samples.get(self.sample.get(), [])
+        if not paths:
+            messagebox.showwarning("No Data", "Choose a directory and sample first.", parent=self.dialog)
+            return
+        if self.worker_thread is not None and self.worker_thread.is_alive():
+            return
+        try:
+            tile_pixels = min(max(int(self.tile_pixels.get()), 32), 2048)
+        except (tk.TclError, ValueError):
+            tile_pixels = 256
+        jobs, unshared = [], []
+        for path in paths:
+            cmap, scaling = self.settings[path]
+            limits = None
+            if scaling == 'Shared limits':
+                element = parse_element_name(os.path.basename(path))
+                limits = self.app.shared_limits(element)
+                if limits is None:
+                    # Falls back to the map's own range
+                    unshared.append(element)
+            jobs.append((path, cmap, scaling, limits))
+        self.cancel_event.clear()
+        self.render_btn.config(state=tk.DISABLED)
+        self.progress_bar.config(maximum=len(jobs), value=0)
+        text = f"Rendering {len(jobs)} element maps..."
+        if unshared:
+            text += f"\nNo shared limits for {', '.join(unshared)}; using their own range."
+        self.status_label.config(text=text)
+        self.worker_thread = threading.Thread(target=self.run_jobs, args=(jobs, tile_pixels), daemon=True)
+        self.worker_thread.start()
+        self.poll_results(jobs, tile_pixels)
+
+    def run_jobs(self, jobs, tile_pixels):
+        # Runs on a background thread; every tile is rasterized in its own process
+        results = [None] * len(jobs)
+        with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(render_montage_tile, path, cmap, scaling, tile_pixels, limits): i
+                       for i, (path, cmap, scaling, limits) in enumerate(jobs)}
+            for done, future in enumerate(as_completed(futures), 1):
+                if self.cancel_event.is_set():
+                    for pending in futures:
+                        pending.cancel()
+                    return
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = e
+                self.result_queue.put(('progress', done))
+        self.result_queue.put(('finished', results))
+
+    def poll_results(self, jobs, tile_pixels):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            while True:
+                item = self.result_queue.get_nowait()
+                if item[0] == 'progress':
+                    self.progress_bar.config(value=item[1])
+                else:
+                    self.render_btn.config(state=tk.NORMAL)
+                    self.show_montage(jobs, item[1], tile_pixels)
+                    return
+        except queue.Empty:
+            pass
+        self.dialog.after(50, self.poll_results, jobs, tile_pixels)
+
+    def show_montage(self, jobs, results, tile_pixels):
+        tiles, labels, failed = [], [], []
+        factor = 1
+        for (path, *_), result in zip(jobs, results):
+            name = parse_element_name(os.path.basename(path))
+            if isinstance(result, Exception):
+                failed.append(f"{os.path.basename(path)}: {result}")
+                continue
+            rgba, (vmin, vmax), tile_factor = result
+            factor = tile_factor if not tiles else factor
+            tiles.append(rgba)
+            labels.append(f"{name}  {vmin:.3g} - {vmax:.3g}")
+        if not tiles:
+            self.status_label.config(text="Nothing could be rendered.\n" + "\n".join(failed[:5]))
+            return
+        try:
+            columns = max(int(self.columns.get()), 0) or None
+        except (tk.TclError, ValueError):
+            columns = None
+        image, origins = layout_montage(tiles, tile_pixels, columns, footer_pixels=30)
+        self.montage = (image, origins, labels, factor)
+        self.draw_montage(self.ax, fontsize=7)
+        self.canvas.draw()
+        text = f"{len(tiles)} element maps"
+        if failed:
+            text += f", {len(failed)} failed:\n" + "\n".join(failed[:5])
+        self.status_label.config(text=text)
+
+    def draw_montage(self, ax, fontsize):
+        image, origins, labels, factor = self.montage
+        ax.clear()
+        ax.imshow(image, interpolation='nearest')
+        ax.axis('off')
+        for (r0, c0), label in zip(origins, labels):
+            ax.text(c0, r0 + 2, label, fontsize=fontsize, va='top', ha='left', fontname='Arial')
+        # One scale bar for all tiles, in the pixels of the downsampled maps
+        try:
+            bar_length = self.app.scale_length.get() / self.app.pixel_size.get() / factor
+        except (tk.TclError, ZeroDivisionError):
+            return
+        y_pos = image.shape[0] - 15
+        ax.plot([8, 8 + bar_length], [y_pos, y_pos], color='black', lw=2, solid_capstyle='butt')
+        ax.text(8 + bar_length + 6, y_pos, f"{self.app.scale_length.get():g} µm", fontsize=fontsize,
+                ha='left', va='center', fontname='Arial')
+
+    def export(self):
+        if self.montage is None:
+            messagebox.showwarning("No Montage", "Render the montage first.", parent=self.dialog)
+            return
+        path = filedialog.asksaveasfilename(parent=self.dialog, defaultextension=".png", filetypes=[("PNG", "*.png")],
+                                            initialfile=f"{self.sample.get()}_montage.png")
+        if not path:
+            return
+        # One image pixel per montage pixel
+        image = self.montage[0]
+        figure = plt.figure(figsize=(image.shape[1] / 100, image.shape[0] / 100), dpi=100)
+        try:
+            self.draw_montage(figure.add_axes([0, 0, 1, 1]), fontsize=9)
+            figure.savefig(path, dpi=100)
+        except Exception as e:
+            messagebox.showerror("Save Error", f"Failed to save the montage:\n{str(e)}", parent=self.dialog)
+        finally:
+            plt.close(figure)
+
+    def close(self):
+        self.cancel_event.set()
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class SegmentationDialog:
+    """Threshold the Element Viewer map into objects and measure them in every loaded element."""
+
+    def __init__(self, app, title="Segment Objects"):
+        self.app = app
+        self.mode = tk.StringVar(value='Current min/max')
+        self.connectivity = tk.StringVar(value='8')
+        self.min_area = tk.IntVar(value=1)
+        self.extra_maps = {}  # Element name -> matrix file measured in addition to the loaded maps
+        self.labels = None
+        self.count = 0
+        self.table = None
+        self.sort_column = 'area_px'
+        self.sort_descending = True
+        self._box_artist = None
+        self.result_queue = queue.Queue()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("1150x700")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.TOP, fill=tk.X)
+
+        tk.Label(control_frame, text="Threshold:", font=("Arial", 12)).pack(side=tk.LEFT)
+        ttk.Combobox(control_frame, textvariable=self.mode, values=['Current min/max', 'Otsu'], width=15,
+                     state='readonly', font=("Arial", 11)).pack(side=tk.LEFT, padx=(2, 10))
+        tk.Label(control_frame, text="Connectivity:", font=("Arial", 12)).pack(side=tk.LEFT)
+        ttk.Combobox(control_frame, textvariable=self.connectivity, values=['8', '4'], width=3,
+                     state='readonly', font=("Arial", 11)).pack(side=tk.LEFT, padx=(2, 10))
+        tk.Label(control_frame, text="Min area (px):", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Spinbox(control_frame, from_=1, to=100000, textvariable=self.min_area, width=6,
+                   font=("Arial", 11)).pack(side=tk.LEFT, padx=(2, 10))
+        self.segment_btn = tk.Button(control_frame, text="Segment", command=self.start, font=("Arial", 12, "bold"),
+                                     bg="#4CAF50", fg="white", padx=10)
+        self.segment_btn.pack(side=tk.LEFT)
+        tk.Button(control_frame, text="Export Table...", command=self.export, font=("Arial", 11)).pack(side=tk.RIGHT)
+        tk.Button(control_frame, text="Add Maps...", command=self.add_maps, font=("Arial", 11)).pack(side=tk.RIGHT, padx=(0, 5))
+
+        self.status_label = tk.Label(self.dialog, text="", font=("Arial", 11), anchor='w', justify=tk.LEFT, wraplength=1100)
+        self.status_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0, 10))
+
+        table_frame = tk.Frame(self.dialog)
+        table_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=(0, 10))
+        self.tree = ttk.Treeview(table_frame, show='headings', selectmode='browse')
+        scroll_y = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        scroll_x = ttk.Scrollbar(table_frame, orient=tk.HORIZONTAL, command=self.tree.xview)
+        self.tree.configure(yscrollcommand=scroll_y.set, xscrollcommand=scroll_x.set)
+        scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+        scroll_x.pack(side=tk.BOTTOM, fill=tk.X)
+        self.tree.pack(fill=tk.BOTH, expand=True)
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+
+        self.figure, self.ax = plt.subplots(figsize=(5, 5), constrained_layout=True)
+        self.ax.axis('off')
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.dialog)
+        self.canvas.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+        self.status_label.config(text=f"Maps measured: {', '.join(self.measured_maps()[0]) or 'none'}")
+
+    def add_maps(self):
+        paths = filedialog.askopenfilenames(parent=self.dialog, filetypes=MATRIX_FILETYPES)
+        for path in paths:
+            name = parse_element_name(os.path.basename(path))
+            if name == 'Unknown':
+                name = os.path.splitext(os.path.basename(path))[0]
+            self.extra_maps[name] = path
+        if paths:
+            maps, skipped = self.measured_maps()
+            text = f"Maps measured: {', '.join(maps)}"
+            if skipped:
+                text += f"    Skipped (different shape): {', '.join(skipped)}"
+            self.status_label.config(text=text)
+
+    def measured_maps(self):
+        """Return ({name: matrix} for every map on the segmented grid, [names skipped for their shape])."""
+        app = self.app
+        if app.single_matrix is None:
+            return {}, []
+        name = parse_element_name(app.single_file_name or '')
+        maps = {name if name != 'Unknown' else 'Map': app.single_matrix}
+        seen = set()
+        if app.single_source_path and not app.is_matrix_modified():
+            seen.add(os.path.abspath(app.single_source_path))
+        # RGB channels may be shown as overviews, so they are measured at full resolution
+        sources = [(app.channel_element(ch), app.rgb_sources[ch]) for ch in 'RGB' if app.rgb_sources[ch]]
+        skipped = []
+        for name, path in sources + list(self.extra_maps.items()):
+            if os.path.abspath(path) in seen:
+                continue
+            seen.add(os.path.abspath(path))
+            mat = app.matrix_store.get(path)
+            if mat.shape != app.single_matrix.shape:
+                skipped.append(name)
+                continue
+            while name in maps:
+                name += "'"
+            maps[name] = mat
+        return maps, skipped
+
+    def start(self):
+        mat = self.app.single_matrix
+        if mat is None:
+            messagebox.showwarning("No Data", "Please load a matrix file first.", parent=self.dialog)
+            return
+        try:
+            min_area = max(int(self.min_area.get()), 1)
+        except (tk.TclError, ValueError):
+            min_area = 1
+        try:
+            maps, skipped = self.measured_maps()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load the maps to measure:\n{str(e)}", parent=self.dialog)
+            return
+        limits = (self.app.single_min.get(), self.app.single_max.get()) if self.mode.get() == 'Current min/max' else None
+        self.segment_btn.config(state=tk.DISABLED)
+        self.status_label.config(text=f"Segmenting and measuring {len(maps)} map(s)...")
+        self.worker_thread = threading.Thread(
+            target=self.run_segmentation, daemon=True,
+            args=(mat, limits, int(self.connectivity.get()), min_area, maps, skipped, self.app.pixel_size.get()))
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_segmentation(self, mat, limits, connectivity, min_area, maps, skipped, pixel_size):
+        # Runs on a background thread; results are handed to Tk through the queue
+        try:
+            start = time.time()
+            lo, hi = limits if limits is not None else (otsu_threshold(mat), np.inf)
+            labels, count = segment_objects(mat, lo, hi, connectivity, min_area)
+            table = object_statistics(labels, count, maps, pixel_size)
+            self.result_queue.put(('finished', labels, count, table, (lo, hi), list(maps), skipped, time.time() - start))
+        except Exception as e:
+            self.result_queue.put(('error', str(e)))
+
+    def poll_result(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            item = self.result_queue.get_nowait()
+        except queue.Empty:
+            self.dialog.after(50, self.poll_result)
+            return
+        self.segment_btn.config(state=tk.NORMAL)
+        if item[0] == 'error':
+            self.status_label.config(text="Segmentation failed")
+            messagebox.showerror("Error", f"Segmentation failed:\n{item[1]}", parent=self.dialog)
+            return
+        _, self.labels, self.count, self.table, (lo, hi), names, skipped, elapsed = item
+        threshold = f"{lo:.4g} to {hi:.4g}" if np.isfinite(hi) else f"Otsu, at least {lo:.4g}"
+        text = f"{self.count} objects    Threshold: {threshold}    Measured: {', '.join(names)}    ({elapsed:.2f} s)"
+        if skipped:
+            text += f"\nSkipped (different shape): {', '.join(skipped)}"
+        if self.count > SEGMENT_TABLE_ROWS:
+            text += f"\nThe table lists {SEGMENT_TABLE_ROWS} objects at a time; the export contains all of them."
+        self.status_label.config(text=text)
+        self.draw_labels()
+        self.tree.config(columns=list(self.table.columns))
+        for column in self.table.columns:
+            self.tree.heading(column, text=column, command=lambda c=column: self.sort_by(c))
+            self.tree.column(column, width=90, anchor='e', stretch=False)
+        self.show_table()
+
+    def draw_labels(self):
+        rows, cols = self.labels.shape
+        step = max(-(-max(rows, cols) // 1024), 1)
+        small = self.labels[::step, ::step]
+        # Neighbouring objects get unrelated colors from a fixed shuffled palette
+        palette = np.random.default_rng(0).integers(60, 256, (256, 4)).astype(np.uint8)
+        palette[:, 3] = 255
+        palette[0] = (0, 0, 0, 255)
+        index = np.where(small > 0, (small - 1) % 255 + 1, 0)
+        self.ax.clear()
+        self._box_artist = None
+        self.ax.imshow(palette[index], extent=(-0.5, cols - 0.5, rows - 0.5, -0.5), interpolation='nearest')
+        self.ax.set_title(f"{self.count} objects", fontsize=10)
+        self.ax.axis('off')
+        self.canvas.draw()
+
+    def sort_by(self, column):
+        if column == self.sort_column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column, self.sort_descending = column, True
+        self.show_table()
+
+    def show_table(self):
+        if self.table is None:
+            return
+        rows = self.table.sort_values(self.sort_column, ascending=not self.sort_descending, kind='stable').head(SEGMENT_TABLE_ROWS)
+        self.tree.delete(*self.tree.get_children())
+        for record in rows.itertuples(index=False):
+            self.tree.insert('', tk.END, iid=str(record[0]), values=[f"{v:.4g}" if isinstance(v, float) else v for v in record])
+
+    def on_select(self, event=None):
+        from matplotlib.patches import Rectangle
+
+        selection = self.tree.selection()
+        if not selection or self.table is None:
+            return
+        obj = self.table.iloc[int(selection[0]) - 1]
+        if self._box_artist is not None:
+            self._box_artist.remove()
+        # Padded so single-pixel objects stay visible on large maps
+        pad = max(self.labels.shape) / 200
+        self._box_artist = Rectangle((obj['col_min'] - 0.5 - pad, obj['row_min'] - 0.5 - pad),
+                                     obj['col_max'] - obj['col_min'] + 1 + 2 * pad, obj['row_max'] - obj['row_min'] + 1 + 2 * pad,
+                                     fill=False, edgecolor='white', linewidth=1.5)
+        self.ax.add_patch(self._box_artist)
+        self.canvas.draw_idle()
+
+    def export(self):
+        if self.table is None:
+            messagebox.showwarning("No Objects", "Segment the map first.", parent=self.dialog)
+            return
+        path = filedialog.asksaveasfilename(parent=self.dialog, defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if path:
+            try:
+                self.table.to_csv(path, index=False)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to export the object table:\n{str(e)}", parent=self.dialog)
+
+    def close(self):
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class TransectDialog:
+    """Intensity profiles of every loaded element along a line drawn on the Element Viewer or RGB overlay."""
+
+    def __init__(self, app, view, title="Line Profile"):
+        self.app = app
+        self.view = view  # 'single' or 'rgb'
+        self.ax = app.single_ax if view == 'single' else app.rgb_ax
+        self.canvas = app.single_canvas if view == 'single' else app.rgb_canvas
+        self.width = tk.IntVar(value=1)
+        self.scale_each = tk.IntVar(value=0)
+        self.vertices = []
+        self.table = None
+        self._line = None
+        self._drag = None        # Index of the vertex being dragged
+        self._background = None  # Map canvas without the line, restored while dragging
+        self._profile_lines = {}
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(f"{title} - {'Element Viewer' if view == 'single' else 'RGB Overlay'}")
+        self.dialog.geometry("760x520")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        app.view_overlays[view].append(self.draw_line)
+        self._connections = [self.canvas.mpl_connect('button_press_event', self.on_press),
+                             self.canvas.mpl_connect('motion_notify_event', self.on_motion),
+                             self.canvas.mpl_connect('button_release_event', self.on_release)]
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.TOP, fill=tk.X)
+        tk.Label(control_frame, text="Width (px):", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Spinbox(control_frame, from_=1, to=501, increment=2, textvariable=self.width, width=5, font=("Arial", 11),
+                   command=self.update_profile).pack(side=tk.LEFT, padx=(2, 10))
+        tk.Checkbutton(control_frame, text="Scale each to its maximum", variable=self.scale_each,
+                       command=self.update_profile, font=("Arial", 11)).pack(side=tk.LEFT)
+        tk.Button(control_frame, text="Export Table...", command=self.export, font=("Arial", 11)).pack(side=tk.RIGHT)
+        tk.Button(control_frame, text="Clear", command=self.clear, font=("Arial", 11)).pack(side=tk.RIGHT, padx=(0, 5))
+
+        self.status_label = tk.Label(self.dialog, text="Click on the map to add points, drag a point to move it, "
+                                     "right-click to remove the last point.", font=("Arial", 11), anchor='w')
+        self.status_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0, 10))
+
+        self.figure, self.profile_ax = plt.subplots(figsize=(6, 4), constrained_layout=True)
+        self.profile_canvas = FigureCanvasTkAgg(self.figure, master=self.dialog)
+        self.profile_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def draw_line(self, ax):
+        # Called again whenever the view is redrawn from scratch
+        self._line = None
+        if self.vertices:
+            xs, ys = zip(*self.vertices)
+            self._line = ax.plot(xs, ys, '-o', color='white', markeredgecolor='black', linewidth=1.5, markersize=5,
+                                 scalex=False, scaley=False)[0]
+
+    def redraw_line(self):
+        if self._line is not None:
+            try:
+                self._line.remove()
+            except ValueError:
+                pass
+        self.draw_line(self.ax)
+        self.canvas.draw_idle()
+
+    def vertex_at(self, event):
+        if not self.vertices:
+            return None
+        points = self.ax.transData.transform(self.vertices)
+        distance = np.hypot(points[:, 0] - event.x, points[:, 1] - event.y)
+        index = int(np.argmin(distance))
+        return index if distance[index] <= 8 else None
+
+    def on_press(self, event):
+        if event.inaxes is not self.ax or event.xdata is None:
+            return
+        if event.button == 3:
+            if self.vertices:
+                self.vertices.pop()
+                self.redraw_line()
+                self.update_profile()
+            return
+        if event.button != 1:
+            return
+        self._drag = self.vertex_at(event)
+        if self._drag is None:
+            self.vertices.append((event.xdata, event.ydata))
+            self._drag = len(self.vertices) - 1
+            self.redraw_line()
+        if self._line is None:
+            return
+        # Blit only the line while it is dragged; the map underneath is drawn once
+        self._line.set_animated(True)
+        self.canvas.draw()
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.blit_line()
+        self.update_profile()
+
+    def on_motion(self, event):
+        if self._drag is None or event.inaxes is not self.ax or event.xdata is None:
+            return
+        self.vertices[self._drag] = (event.xdata, event.ydata)
+        self.blit_line()
+        self.update_profile()
+
+    def on_release(self, event):
+        if self._drag is None:
+            return
+        self._drag = None
+        self._background = None
+        if self._line is not None:
+            self._line.set_animated(False)
+        self.canvas.draw_idle()
+
+    def blit_line(self):
+        if self._line is None or self._background is None:
+            return
+        xs, ys = zip(*self.vertices)
+        self._line.set_data(xs, ys)
+        self.canvas.restore_region(self._background)
+        self.ax.draw_artist(self._line)
+        self.canvas.blit(self.ax.bbox)
+
+    def update_profile(self):
+        """Sample every map along the line and redraw the profile plot."""
+        if not self.dialog.winfo_exists():
+            return  # Spline coefficients finished after the dialog was closed
+        if len(self.vertices) < 2:
+            self.table = None
+            self.profile_ax.clear()
+            self._profile_lines = {}
+            self.profile_canvas.draw_idle()
+            return
+        try:
+            width = max(int(self.width.get()), 1)
+        except (tk.TclError, ValueError):
+            width = 1
+        try:
+            distance, x, y, rows, cols = transect_points(self.vertices, width)
+        except ValueError:
+            return
+        table = {'distance_px': distance, 'distance_um': distance * self.app.pixel_size.get(), 'x': x, 'y': y}
+        for name, mat in self.app.view_maps(self.view).items():
+            # Cubic on cached coefficients; linear until they are ready, and for memory-mapped maps
+            coefficients = self.app.spline_coefficients(mat, self.update_profile)
+            table[name] = sample_profile(mat, rows, cols, coefficients)
+        self.table = pd.DataFrame(table)
+        self.plot_profile()
+
+    def plot_profile(self):
+        names = list(self.table.columns[4:])
+        if list(self._profile_lines) != names:
+            self.profile_ax.clear()
+            self._profile_lines = {name: self.profile_ax.plot([], [], linewidth=1, label=name)[0] for name in names}
+            self.profile_ax.set_xlabel("Distance (µm)")
+            if names:
+                self.profile_ax.legend(fontsize=9)
+        distance = self.table['distance_um'].to_numpy()
+        scale_each = self.scale_each.get()
+        for name, line in self._profile_lines.items():
+            values = self.table[name].to_numpy()
+            if scale_each:
+                peak = np.nanmax(np.abs(values)) if np.isfinite(values).any() else 0
+                values = values / peak if peak else values
+            line.set_data(distance, values)
+        self.profile_ax.set_ylabel("Fraction of maximum" if scale_each else "Value")
+        self.profile_ax.relim()
+        self.profile_ax.autoscale_view()
+        self.profile_canvas.draw_idle()
+
+    def clear(self):
+        self.vertices = []
+        self.redraw_line()
+        self.update_profile()
+
+    def export(self):
+        if self.table is None:
+            messagebox.showwarning("No Profile", "Draw a line on the map first.", parent=self.dialog)
+            return
+        path = filedialog.asksaveasfilename(parent=self.dialog, defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if path:
+            try:
+                self.table.to_csv(path, index=False)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to export the profile table:\n{str(e)}", parent=self.dialog)
+
+    def close(self):
+        for cid in self._connections:
+            self.canvas.mpl_disconnect(cid)
+        if self.draw_line in self.app.view_overlays[self.view]:
+            self.app.view_overlays[self.view].remove(self.draw_line)
+        self.vertices = []
+        self.redraw_line()
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+COMPARISON_MODES = ['Element across samples', 'Elements of one sample']
+COMPARISON_LIMITS = ['Same percentiles', 'Same values']
+MAX_COMPARISON_PANES = 6
+
+class ComparisonDialog:
+    """Up to six maps side by side with linked zoom, pan, limits and cursor.
+
+    All panes are drawn in one scheduled frame, from the same pyramids and
+    quantized levels the Element Viewer caches, so a map already on screen
+    there costs nothing extra here.
+    """
+
+    def __init__(self, app, title="Compare Maps"):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.mode = tk.StringVar(value=COMPARISON_MODES[0])
+        self.choice = tk.StringVar()
+        self.colormap = tk.StringVar(value=app.single_colormap.get())
+        self.limit_mode = tk.StringVar(value=COMPARISON_LIMITS[0])
+        self.low = tk.StringVar(value='0.5')
+        self.high = tk.StringVar(value='99.5')
+        self.transform = tk.StringVar(value='Linear')
+        self.transform_param = tk.DoubleVar(value=1.0)
+        self.samples = {}     # Sample -> {element: matrix file}
+        self.candidates = []  # (label, matrix file) offered in the list
+        self.panes = []       # {'label', 'matrix', 'ax', 'image', 'cursor'} per shown map
+        self.grid = (1, 1)    # Rows and columns of panes
+        self.window = None    # Shared (row0, row1, col0, col1), None for everything
+        self.limits = []      # Limits of each pane in the last frame
+        self._pan = None
+        self._background = None
+        self.view_name = f"compare-{id(self)}"
+        self.executor = ThreadPoolExecutor(max_workers=min(MAX_COMPARISON_PANES, os.cpu_count() or 1))
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("1300x760")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        app.renderer.register(self.view_name, self.prepare_frame, self.compute_frame, self.blit_frame,
+                              visible=lambda: bool(self.dialog.winfo_exists()))
+        source = app.single_source_path or next((app.rgb_sources[ch] for ch in 'RGB' if app.rgb_sources[ch]), None)
+        if source:
+            self.set_directory(os.path.dirname(os.path.abspath(source)), parse_element_name(os.path.basename(source)))
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.LEFT, fill=tk.Y)
+
+        tk.Label(control_frame, text="Directory:", font=("Arial", 12)).pack(anchor='w')
+        row = tk.Frame(control_frame)
+        row.pack(fill=tk.X, pady=(2, 8))
+        tk.Entry(row, textvariable=self.directory, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(row, text="Browse", command=self.browse, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        mode_menu = ttk.Combobox(control_frame, textvariable=self.mode, values=COMPARISON_MODES, state='readonly', font=("Arial", 11))
+        mode_menu.pack(fill=tk.X, pady=(0, 4))
+        mode_menu.bind("<<ComboboxSelected>>", lambda e: self.show_choices())
+        self.choice_menu = ttk.Combobox(control_frame, textvariable=self.choice, state='readonly', font=("Arial", 11))
+        self.choice_menu.pack(fill=tk.X, pady=(0, 4))
+        self.choice_menu.bind("<<ComboboxSelected>>", lambda e: self.show_candidates())
+        self.candidate_list = tk.Listbox(control_frame, selectmode=tk.EXTENDED, height=8, font=("Arial", 11), exportselection=False)
+        self.candidate_list.pack(fill=tk.X)
+        tk.Button(control_frame, text="Show Selected", command=self.show_selected, font=("Arial", 12, "bold"),
+                  bg="#4CAF50", fg="white").pack(fill=tk.X, pady=(5, 10))
+
+        tk.Label(control_frame, text="Colormap", font=("Arial", 13)).pack()
+        colormap_menu = ttk.Combobox(control_frame, textvariable=self.colormap, values=plt.colormaps(), font=("Arial", 12))
+        colormap_menu.pack(fill=tk.X)
+        colormap_menu.bind("<<ComboboxSelected>>", lambda e: self.redraw())
+
+        tk.Label(control_frame, text="Limits", font=("Arial", 13)).pack(pady=(10, 0))
+        limit_menu = ttk.Combobox(control_frame, textvariable=self.limit_mode, values=COMPARISON_LIMITS, state='readonly', font=("Arial", 12))
+        limit_menu.pack(fill=tk.X)
+        limit_menu.bind("<<ComboboxSelected>>", lambda e: self.on_limit_mode())
+        row = tk.Frame(control_frame)
+        row.pack(fill=tk.X, pady=(2, 0))
+        for text, var in (("Low:", self.low), ("High:", self.high)):
+            tk.Label(row, text=text, font=("Arial", 11)).pack(side=tk.LEFT)
+            entry = tk.Entry(row, textvariable=var, width=9, font=("Arial", 11))
+            entry.pack(side=tk.LEFT, padx=(2, 8))
+            entry.bind("<Return>", lambda e: self.redraw())
+
+        self.app.build_transform_controls(control_frame, self.transform, self.transform_param, self.redraw)
+        tk.Button(control_frame, text="Reset Zoom", command=self.reset_zoom, font=("Arial", 11)).pack(fill=tk.X, pady=(10, 0))
+        tk.Button(control_frame, text="Close", command=self.close, font=("Arial", 11)).pack(fill=tk.X, pady=(5, 0))
+
+        right = tk.Frame(self.dialog)
+        right.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.cursor_label = tk.Label(right, text="Scroll to zoom and drag to pan; every pane follows.",
+                                     font=("Arial", 10), anchor='w', justify=tk.LEFT)
+        self.cursor_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0, 5))
+        self.figure = plt.figure(constrained_layout=True)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=right)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.canvas.mpl_connect('scroll_event', self.on_scroll)
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('button_release_event', self.on_release)
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps")
+        if directory:
+            self.set_directory(directory)
+
+    def set_directory(self, directory, choice=None):
+        self.directory.set(directory)
+        self.samples = group_sample_maps(list_matrix_files(directory))
+        self.show_choices(choice)
+
+    def show_choices(self, choice=None):
+        if self.mode.get() == COMPARISON_MODES[0]:
+            choices = sorted({element for maps in self.samples.values() for element in maps}, key=natural_sort_key)
+        else:
+            choices = sorted(self.samples, key=natural_sort_key)
+        self.choice_menu.config(values=choices)
+        self.choice.set(choice if choice in choices else next(iter(choices), ''))
+        self.show_candidates()
+
+    def show_candidates(self):
+        choice = self.choice.get()
+        if self.mode.get() == COMPARISON_MODES[0]:
+            self.candidates = [(sample, maps[choice]) for sample, maps in self.samples.items() if choice in maps]
+        else:
+            self.candidates = list(self.samples.get(choice, {}).items())
+        self.candidates.sort(key=lambda candidate: natural_sort_key(candidate[0]))
+        self.candidate_list.delete(0, tk.END)
+        self.candidate_list.insert(tk.END, *(label for label, _ in self.candidates))
+        for i in range(min(len(self.candidates), MAX_COMPARISON_PANES)):
+            self.candidate_list.selection_set(i)
+
+    def show_selected(self):
+        selected = [self.candidates[i] for i in self.candidate_list.curselection()]
+        if not 2 <= len(selected) <= MAX_COMPARISON_PANES:
+            messagebox.showwarning("Compare Maps", f"Select between 2 and {MAX_COMPARISON_PANES} maps.", parent=self.dialog)
+            return
+        matrices = []
+        for label, path in selected:
+            try:
+                matrices.append((label, self.app.matrix_store.get(path)))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load {os.path.basename(path)}:\n{str(e)}", parent=self.dialog)
+                return
+        self.figure.clear()
+        columns = 2 if len(matrices) in (2, 4) else 3
+        rows = -(-len(matrices) // columns)
+        axes = self.figure.subplots(rows, columns, squeeze=False).ravel()
+        for ax in axes:
+            ax.axis('off')
+        self.panes = [{'label': label, 'matrix': mat, 'ax': ax, 'image': None, 'cursor': None}
+                      for (label, mat), ax in zip(matrices, axes)]
+        self.grid = (rows, columns)
+        self.window = None
+        self.limits = []
+        self.redraw()
+
+    def full_window(self):
+        return (0, max(pane['matrix'].shape[0] for pane in self.panes), 0, max(pane['matrix'].shape[1] for pane in self.panes))
+
+    def redraw(self):
+        """Redraw every pane; a burst of calls produces a single frame."""
+        if self.view_name in self.app.renderer.views:  # Background jobs may finish after the dialog closed
+            self.app.renderer.request(self.view_name)
+
+    def reset_zoom(self):
+        self.window = None
+        self.redraw()
+
+    def on_limit_mode(self):
+        # Switching modes starts from the limits on screen, so the panes do not jump
+        if self.limit_mode.get() == COMPARISON_LIMITS[1] and self.limits:
+            self.low.set(f"{min(lo for lo, _ in self.limits):.6g}")
+            self.high.set(f"{max(hi for _, hi in self.limits):.6g}")
+        elif self.limit_mode.get() == COMPARISON_LIMITS[0]:
+            self.low.set('0.5')
+            self.high.set('99.5')
+        self.redraw()
+
+    def prepare_frame(self):
+        # Tk thread: snapshot the panes and settings the frame is drawn from
+        if not self.panes:
+            return None
+        name, param = self.app.display_transform(self.transform, self.transform_param)
+        percentiles = self.limit_mode.get() == COMPARISON_LIMITS[0]
+        try:
+            limits = (float(self.low.get()), float(self.high.get()))
+        except ValueError:
+            limits = (0.5, 99.5) if percentiles else None
+        if percentiles:
+            limits = tuple(float(np.clip(limit, 0, 100)) for limit in limits)
+        widget = self.canvas.get_tk_widget()
+        rows, columns = self.grid
+        return {'panes': [(pane['matrix'],) + self.app.prepare_transform(pane['matrix'], name, param, self.redraw)
+                          for pane in self.panes],
+                'window': self.window or self.full_window(), 'limit_mode': self.limit_mode.get(), 'limits': limits,
+                'target_pixels': max(widget.winfo_width() // columns, widget.winfo_height() // rows, 256),
+                'colormap': self.colormap.get(), 'nan_rgba': self.app.nan_rgba()}
+
+    def compute_frame(self, state, cancelled):
+        # Worker thread: the panes are computed side by side; each pane's first frame (statistics,
+        # transform, quantization) is the slow one and panes share nothing but the caches
+        images = list(self.executor.map(lambda layer: self.pane_image(state, layer, cancelled), state['panes']))
+        return None if cancelled() else dict(state, images=images)
+
+    def pane_image(self, state, layer, cancelled):
+        """(image, extent, limits) of one pane, quantized and coloured like the Element Viewer; None for an empty map."""
+        app = self.app
+        mat, name, param, transformed = layer
+        if cancelled():
+            return None
+        if transformed is None:
+            transformed = app.transformed_matrix(mat, name, param, None)
+        forward = app.transform_functions(mat, name, param)[0]
+        key = ('sketch', matrix_generation(mat))
+        sketch = app.derived_cache.get(key)
+        if sketch is None:
+            sketch = sketch_matrix(mat)
+            app.derived_cache.put(key, sketch, nbytes=sketch.positive.nbytes + sketch.negative.nbytes)
+        if not sketch.count:
+            return None
+        if state['limit_mode'] == COMPARISON_LIMITS[0]:
+            vmin, vmax = (float(v) for v in sketch.percentiles(state['limits']))
+        else:
+            vmin, vmax = state['limits'] or (sketch.min, sketch.max)
+        # Maps of other samples may be smaller than the shared window
+        r0, r1, c0, c1 = state['window']
+        window = (min(r0, mat.shape[0]), min(r1, mat.shape[0]), min(c0, mat.shape[1]), min(c1, mat.shape[1]))
+        if window[0] == window[1] or window[2] == window[3]:
+            return None, None, (vmin, vmax)
+        lo, hi = (float(v) for v in forward((sketch.min, sketch.max)))
+        indices, extent = app.level_indices(transformed, window, state['target_pixels'], (lo, hi))
+        lut = build_colormap_lut(state['colormap'], lo, hi, float(forward(vmin)), float(forward(vmax)), state['nan_rgba'])
+        return lut[indices], extent, (vmin, vmax)
+
+    def blit_frame(self, frame):
+        if len(self.panes) != len(frame['panes']) or any(pane['matrix'] is not layer[0] for pane, layer
+                                                         in zip(self.panes, frame['panes'])):
+            return  # Drawn for a previous selection
+        r0, r1, c0, c1 = frame['window']
+        self.limits = []
+        for pane, result in zip(self.panes, frame['images']):
+            ax = pane['ax']
+            if result is None:
+                ax.set_title(f"{pane['label']}\n(no values)", fontsize=10)
+                continue
+            image, extent, (vmin, vmax) = result
+            self.limits.append((vmin, vmax))
+            if pane['image'] is None and image is not None:
+                pane['image'] = ax.imshow(image, extent=extent, interpolation='nearest')
+                pane['cursor'] = (ax.axhline(np.nan, color='white', linewidth=0.8, animated=True),
+                                  ax.axvline(np.nan, color='white', linewidth=0.8, animated=True))
+            elif pane['image'] is not None:
+                pane['image'].set_visible(image is not None)
+                if image is not None:
+                    pane['image'].set_data(image)
+                    pane['image'].set_extent(extent)
+            ax.set_xlim(c0 - 0.5, c1 - 0.5)
+            ax.set_ylim(r1 - 0.5, r0 - 0.5)
+            ax.set_title(f"{pane['label']}\n{vmin:.4g} - {vmax:.4g}", fontsize=10)
+        self.canvas.draw()
+        # The crosshairs are blitted over this while the cursor moves
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def pane_at(self, event):
+        return next((pane for pane in self.panes if event.inaxes is pane['ax']), None)
+
+    def on_scroll(self, event):
+        """Zoom every pane in or out around the cursor."""
+        if self.pane_at(event) is None or event.xdata is None:
+            return
+        _, rows, _, cols = self.full_window()
+        r0, r1, c0, c1 = self.window or (0, rows, 0, cols)
+        factor = 0.8 if event.button == 'up' else 1.25
+        height = min(max((r1 - r0) * factor, 8), rows)
+        width = min(max((c1 - c0) * factor, 8), cols)
+        if height >= rows and width >= cols:
+            self.window = None
+        else:
+            # Keep the pixel under the cursor in place
+            top = np.clip(event.ydata - (event.ydata - r0) * height / (r1 - r0), 0, rows - height)
+            left = np.clip(event.xdata - (event.xdata - c0) * width / (c1 - c0), 0, cols - width)
+            self.window = (int(top), int(top + height), int(left), int(left + width))
+        self.redraw()
+
+    def on_press(self, event):
+        pane = self.pane_at(event)
+        if pane is None or event.button != 1 or self.window is None:
+            return
+        self._pan = (event.x, event.y, self.window, pane['ax'].bbox.width, pane['ax'].bbox.height)
+
+    def on_motion(self, event):
+        if self._pan is not None:
+            x, y, (r0, r1, c0, c1), width, height = self._pan
+            _, rows, _, cols = self.full_window()
+            # Screen y grows upwards, rows grow downwards
+            dc = int(round((x - event.x) * (c1 - c0) / width))
+            dr = int(round((event.y - y) * (r1 - r0) / height))
+            dc = int(np.clip(dc, -c0, cols - c1))
+            dr = int(np.clip(dr, -r0, rows - r1))
+            self.window = (r0 + dr, r1 + dr, c0 + dc, c1 + dc)
+            self.redraw()
+            return
+        self.update_cursor(event)
+
+    def on_release(self, event):
+        self._pan = None
+
+    def update_cursor(self, event):
+        """Show the crosshair at the same pixel in every pane, with each map's value there."""
+        if self.pane_at(event) is None or event.xdata is None or self._background is None:
+            return
+        row, col = int(round(event.ydata)), int(round(event.xdata))
+        readings = []
+        self.canvas.restore_region(self._background)
+        for pane in self.panes:
+            mat = pane['matrix']
+            inside = 0 <= row < mat.shape[0] and 0 <= col < mat.shape[1]
+            readings.append(f"{pane['label']}: {float(mat[row, col]):.4g}" if inside else f"{pane['label']}: -")
+            if pane['cursor'] is not None:
+                hline, vline = pane['cursor']
+                hline.set_ydata([row, row])
+                vline.set_xdata([col, col])
+                pane['ax'].draw_artist(hline)
+                pane['ax'].draw_artist(vline)
+        self.canvas.blit(self.figure.bbox)
+        self.cursor_label.config(text=f"x {col}, y {row}    " + "    ".join(readings))
+
+    def close(self):
+        self.app.renderer.unregister(self.view_name)
+        self.executor.shutdown(wait=False)
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class PhaseClusteringDialog:
+    """Group the pixels of a sample into phases by their multi-element signature."""
+
+    def __init__(self, app, title="Phase Clustering"):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.sample = tk.StringVar()
+        self.scaling = tk.StringVar(value=CLUSTER_SCALINGS[0])
+        self.n_components = tk.IntVar(value=3)
+        self.n_clusters = tk.IntVar(value=5)
+        self.samples = {}  # Sample -> {element: matrix file}
+        self.labels = None
+        self.table = None
+        self.result_queue = queue.Queue()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("1150x720")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        source = app.single_source_path or next((app.rgb_sources[ch] for ch in 'RGB' if app.rgb_sources[ch]), None)
+        if source:
+            self.set_directory(os.path.dirname(os.path.abspath(source)), parse_dataset_root(os.path.basename(source)))
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.LEFT, fill=tk.Y)
+
+        tk.Label(control_frame, text="Directory:", font=("Arial", 12)).pack(anchor='w')
+        row = tk.Frame(control_frame)
+        row.pack(fill=tk.X, pady=(2, 8))
+        tk.Entry(row, textvariable=self.directory, font=("Arial", 11)).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(row, text="Browse", command=self.browse, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        tk.Label(control_frame, text="Sample:", font=("Arial", 12)).pack(anchor='w')
+        self.sample_combo = ttk.Combobox(control_frame, textvariable=self.sample, state='readonly', font=("Arial", 11))
+        self.sample_combo.pack(fill=tk.X, pady=(2, 8))
+        self.sample_combo.bind("<<ComboboxSelected>>", lambda e: self.show_elements())
+
+        tk.Label(control_frame, text="Elements:", font=("Arial", 12)).pack(anchor='w')
+        self.element_list = tk.Listbox(control_frame, selectmode=tk.EXTENDED, height=10, font=("Arial", 11), exportselection=False)
+        self.element_list.pack(fill=tk.X, pady=(2, 8))
+
+        params = tk.Frame(control_frame)
+        params.pack(fill=tk.X)
+        tk.Label(params, text="Scaling:", font=("Arial", 12)).grid(row=0, column=0, sticky='w', pady=2)
+        ttk.Combobox(params, textvariable=self.scaling, values=CLUSTER_SCALINGS, state='readonly', width=17,
+                     font=("Arial", 11)).grid(row=0, column=1, sticky='w', padx=(5, 0), pady=2)
+        tk.Label(params, text="PCA components:", font=("Arial", 12)).grid(row=1, column=0, sticky='w', pady=2)
+        tk.Spinbox(params, from_=1, to=20, textvariable=self.n_components, width=4, font=("Arial", 11)).grid(row=1, column=1, sticky='w', padx=(5, 0))
+        tk.Label(params, text="Phases:", font=("Arial", 12)).grid(row=2, column=0, sticky='w', pady=2)
+        tk.Spinbox(params, from_=2, to=50, textvariable=self.n_clusters, width=4, font=("Arial", 11)).grid(row=2, column=1, sticky='w', padx=(5, 0))
+
+        self.cluster_btn = tk.Button(control_frame, text="Cluster", command=self.start, font=("Arial", 12, "bold"),
+                                     bg="#4CAF50", fg="white")
+        self.cluster_btn.pack(fill=tk.X, pady=(10, 2))
+        tk.Button(control_frame, text="Open in Element Viewer", command=self.open_single, font=("Arial", 11)).pack(fill=tk.X, pady=2)
+        tk.Button(control_frame, text="Export Table...", command=self.export, font=("Arial", 11)).pack(fill=tk.X, pady=2)
+        self.status_label = tk.Label(control_frame, text="", font=("Arial", 10, "italic"), anchor='w', justify=tk.LEFT, wraplength=300)
+        self.status_label.pack(fill=tk.X, pady=(8, 0))
+
+        right = tk.Frame(self.dialog, padx=10, pady=10)
+        right.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(right, show='headings', height=8)
+        scroll_x = ttk.Scrollbar(right, orient=tk.HORIZONTAL, command=self.tree.xview)
+        self.tree.configure(xscrollcommand=scroll_x.set)
+        self.tree.pack(side=tk.BOTTOM, fill=tk.X)
+        scroll_x.pack(side=tk.BOTTOM, fill=tk.X)
+        self.figure, self.ax = plt.subplots(figsize=(5, 5), constrained_layout=True)
+        self.ax.axis('off')
+        self.canvas = FigureCanvasTkAgg(self.figure, master=right)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps")
+        if directory:
+            self.set_directory(directory)
+
+    def set_directory(self, directory, sample=None):
+        self.directory.set(directory)
+        self.samples = group_sample_maps(list_matrix_files(directory))
+        names = sorted(self.samples, key=natural_sort_key)
+        self.sample_combo.config(values=names)
+        self.sample.set(sample if sample in self.samples else next(iter(names), ''))
+        self.show_elements()
+
+    def show_elements(self):
+        self.element_list.delete(0, tk.END)
+        elements = sorted(self.samples.get(self.sample.get(), {}), key=natural_sort_key)
+        self.element_list.insert(tk.END, *elements)
+        # Every element takes part unless deselected
+        for i in range(len(elements)):
+            self.element_list.selection_set(i)
+
+    def start(self):
+        maps = self.samples.get(self.sample.get(), {})
+        elements = [self.element_list.get(i) for i in self.element_list.curselection()]
+        if len(elements) < 2:
+            messagebox.showwarning("No Data", "Select at least two element maps.", parent=self.dialog)
+            return
+        try:
+            n_components = min(max(int(self.n_components.get()), 1), len(elements))
+            n_clusters = min(max(int(self.n_clusters.get()), 2), 255)
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Invalid Value", "Please enter whole numbers of components and phases.", parent=self.dialog)
+            return
+        if self.worker_thread is not None and self.worker_thread.is_alive():
+            return
+        self.cluster_btn.config(state=tk.DISABLED)
+        paths = [maps[element] for element in elements]
+        self.worker_thread = threading.Thread(target=self.run_clustering, daemon=True,
+                                              args=(elements, paths, self.scaling.get(), n_components, n_clusters))
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_clustering(self, elements, paths, scaling, n_components, n_clusters):
+        # Runs on a background thread. Each stage is cached on its own, so changing the number of
+        # components or phases skips the pass that streams the maps for their statistics
+        cache = self.app.derived_cache
+        try:
+            mats = [memmap_matrix_file(path) for path in paths]
+            shapes = {mat.shape for mat in mats}
+            if len(shapes) > 1:
+                raise ValueError("The element maps have different shapes: "
+                                 + ", ".join(f"{e} {m.shape}" for e, m in zip(elements, mats)))
+            stats_key = ('phase-statistics', tuple(MatrixStore.source_key(path) for path in paths), scaling)
+            stats = cache.get(stats_key)
+            if stats is None:
+                self.result_queue.put(('progress', f"Reading {len(mats)} maps..."))
+                stats = feature_statistics(mats, scaling.startswith('Log'))
+                cache.put(stats_key, stats, nbytes=stats['sample'].nbytes)
+            model_key = stats_key + (n_components, n_clusters)
+            result = cache.get(('phases',) + model_key)
+            if result is None:
+                self.result_queue.put(('progress', f"Fitting {n_clusters} phases on {len(stats['sample'])} sampled pixels..."))
+                model = fit_phase_model(stats, scaling, n_components, n_clusters)
+                self.result_queue.put(('progress', "Labelling every pixel..."))
+                labels, table = assign_phases(mats, elements, model)
+                result = cache.put(('phases',) + model_key, (model, labels, table), nbytes=labels.nbytes)
+            self.result_queue.put(('finished',) + result)
+        except Exception as e:
+            self.result_queue.put(('error', str(e)))
+
+    def poll_result(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            while True:
+                item = self.result_queue.get_nowait()
+                if item[0] == 'progress':
+                    self.status_label.config(text=item[1])
+                    continue
+                self.cluster_btn.config(state=tk.NORMAL)
+                if item[0] == 'error':
+                    self.status_label.config(text="")
+                    messagebox.showerror("Error", f"Clustering failed:\n{item[1]}", parent=self.dialog)
+                else:
+                    _, model, self.labels, self.table = item
+                    explained = ", ".join(f"{100 * v:.0f}%" for v in model['explained'])
+                    self.status_label.config(text=f"{len(self.table)} phases; variance per component: {explained}")
+                    self.draw_labels()
+                    self.show_table()
+                return
+        except queue.Empty:
+            pass
+        self.dialog.after(100, self.poll_result)
+
+    def phase_colors(self):
+        # Categorical colours for the phases, black for pixels without a phase
+        from matplotlib.colors import ListedColormap
+
+        n = len(self.table)
+        base = plt.get_cmap('tab10' if n <= 10 else 'tab20')
+        colors = [base(i % base.N) for i in range(n)]
+        return ListedColormap([(0, 0, 0, 1)] + colors), colors
+
+    def draw_labels(self):
+        rows, cols = self.labels.shape
+        step = max(-(-max(rows, cols) // 1024), 1)
+        cmap, colors = self.phase_colors()
+        self.ax.clear()
+        self.ax.imshow(self.labels[::step, ::step], cmap=cmap, vmin=0, vmax=len(colors), interpolation='nearest',
+                       extent=(-0.5, cols - 0.5, rows - 0.5, -0.5))
+        from matplotlib.patches import Patch
+        self.ax.legend(handles=[Patch(color=color, label=f"Phase {i}") for i, color in enumerate(colors, 1)],
+                       loc='upper left', bbox_to_anchor=(1.01, 1), fontsize=8)
+        self.ax.axis('off')
+        self.canvas.draw()
+
+    def show_table(self):
+        columns = list(self.table.columns)
+        self.tree.config(columns=columns)
+        for column in columns:
+            self.tree.heading(column, text=column)
+            self.tree.column(column, width=90, anchor='e', stretch=False)
+        self.tree.delete(*self.tree.get_children())
+        for record in self.table.itertuples(index=False):
+            self.tree.insert('', tk.END, values=[f"{v:.4g}" if isinstance(v, float) else v for v in record])
+
+    def open_single(self):
+        if self.labels is None:
+            messagebox.showwarning("No Phases", "Cluster the maps first.", parent=self.dialog)
+            return
+        # Pixels without a phase are empty cells
+        phases = self.labels.astype(STORAGE_DTYPE)
+        phases[self.labels <= 0] = np.nan
+        self.app.set_single_matrix(phases, f"{self.sample.get()} phases")
+
+    def export(self):
+        if self.table is None:
+            messagebox.showwarning("No Phases", "Cluster the maps first.", parent=self.dialog)
+            return
+        path = filedialog.asksaveasfilename(parent=self.dialog, defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if path:
+            try:
+                self.table.to_csv(path, index=False)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to export the phase table:\n{str(e)}", parent=self.dialog)
+
+    def close(self):
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class QuantificationDialog:
+    """Fit CPS-to-ppm calibrations on reference materials and apply them to samples."""
+
+    def __init__(self, app, title="Quantification"):
+        self.app = app
+        self.standards_dir = tk.StringVar()
+        self.certified_path = tk.StringVar()
+        self.model = tk.StringVar(value=CALIBRATION_MODELS[0])
+        self.through_zero = tk.IntVar(value=0)
+        self.internal_standard = tk.StringVar()
+        self.internal_ppm = tk.DoubleVar(value=0.0)
+        self.standards = {}  # Reference material -> {element: matrix file}
+        self.certified = None
+        self.rois = {}       # Reference material -> (r0, r1, c0, c1)
+        self.result_queue = queue.Queue()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("1100x720")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        calibration = app.calibration
+        if calibration is not None:
+            # The session's calibration is reused for every further sample
+            self.model.set(calibration.model)
+            self.through_zero.set(int(calibration.through_zero))
+            self.internal_standard.set(calibration.internal_standard or '')
+            self.show_fits()
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.LEFT, fill=tk.Y)
+
+        for label, var, command in [("Standards directory:", self.standards_dir, self.browse_standards),
+                                    ("Certified values (CSV or Excel):", self.certified_path, self.browse_certified)]:
+            tk.Label(control_frame, text=label, font=("Arial", 12)).pack(anchor='w')
+            row = tk.Frame(control_frame)
+            row.pack(fill=tk.X, pady=(2, 8))
+            tk.Entry(row, textvariable=var, font=("Arial", 11), width=28).pack(side=tk.LEFT, fill=tk.X, expand=True)
+            tk.Button(row, text="Browse", command=command, font=("Arial", 10)).pack(side=tk.LEFT, padx=(5, 0))
+
+        self.standards_tree = ttk.Treeview(control_frame, columns=('maps', 'certified', 'roi'), height=6)
+        self.standards_tree.heading('#0', text="Standard")
+        self.standards_tree.heading('maps', text="Maps")
+        self.standards_tree.heading('certified', text="Certified")
+        self.standards_tree.heading('roi', text="ROI")
+        for column, width in [('#0', 110), ('maps', 50), ('certified', 70), ('roi', 110)]:
+            self.standards_tree.column(column, width=width)
+        self.standards_tree.pack(fill=tk.X)
+        tk.Button(control_frame, text="Set ROI...", command=self.set_roi, font=("Arial", 10)).pack(anchor='w', pady=(4, 8))
+
+        tk.Label(control_frame, text="Model:", font=("Arial", 12)).pack(anchor='w')
+        ttk.Combobox(control_frame, textvariable=self.model, values=CALIBRATION_MODELS, state='readonly',
+                     font=("Arial", 11)).pack(fill=tk.X, pady=(2, 4))
+        tk.Checkbutton(control_frame, text="Force through zero", variable=self.through_zero, font=("Arial", 11)).pack(anchor='w')
+        tk.Label(control_frame, text="Internal standard (optional):", font=("Arial", 12)).pack(anchor='w', pady=(6, 0))
+        self.internal_combo = ttk.Combobox(control_frame, textvariable=self.internal_standard, values=[''], state='readonly',
+                                           font=("Arial", 11))
+        self.internal_combo.pack(fill=tk.X, pady=(2, 4))
+        tk.Label(control_frame, text="Internal standard in sample (ppm):", font=("Arial", 12)).pack(anchor='w')
+        tk.Entry(control_frame, textvariable=self.internal_ppm, font=("Arial", 11)).pack(fill=tk.X, pady=(2, 8))
+
+        self.fit_btn = tk.Button(control_frame, text="Fit Calibration", command=self.fit, font=("Arial", 12, "bold"),
+                                 bg="#4CAF50", fg="white")
+        self.fit_btn.pack(fill=tk.X, pady=(4, 2))
+        tk.Button(control_frame, text="Apply to Loaded Maps", command=self.apply_loaded, font=("Arial", 12)).pack(fill=tk.X, pady=2)
+        tk.Button(control_frame, text="Quantify Directory...", command=self.quantify_directory, font=("Arial", 12)).pack(fill=tk.X, pady=2)
+        self.status_label = tk.Label(control_frame, text="", font=("Arial", 10, "italic"), anchor='w', justify=tk.LEFT, wraplength=320)
+        self.status_label.pack(fill=tk.X, pady=(8, 0))
+
+        right = tk.Frame(self.dialog, padx=10, pady=10)
+        right.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.fits_tree = ttk.Treeview(right, columns=('slope', 'intercept', 'r2', 'n'), height=8)
+        self.fits_tree.heading('#0', text="Element")
+        for column, text in [('slope', "Slope"), ('intercept', "Intercept"), ('r2', "R\u00b2"), ('n', "Standards")]:
+            self.fits_tree.heading(column, text=text)
+            self.fits_tree.column(column, width=100, anchor='e')
+        self.fits_tree.pack(fill=tk.X)
+        self.fits_tree.bind("<<TreeviewSelect>>", lambda e: self.plot_fit())
+
+        self.figure, self.ax = plt.subplots(figsize=(5, 4), constrained_layout=True)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=right)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse_standards(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of reference material maps")
+        if directory:
+            self.standards_dir.set(directory)
+            self.standards = group_sample_maps(list_matrix_files(directory))
+            elements = sorted({element for maps in self.standards.values() for element in maps}, key=natural_sort_key)
+            self.internal_combo.config(values=[''] + elements)
+            self.rois = {name: roi for name, roi in self.rois.items() if name in self.standards}
+            self.show_standards()
+
+    def browse_certified(self):
+        path = filedialog.askopenfilename(parent=self.dialog, filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx")])
+        if not path:
+            return
+        try:
+            self.certified = read_certified_values(path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read the certified values:\n{str(e)}", parent=self.dialog)
+            return
+        self.certified_path.set(path)
+        self.show_standards()
+
+    def show_standards(self):
+        self.standards_tree.delete(*self.standards_tree.get_children())
+        plain = {re.sub(r'[\s_-]', '', str(name)).lower() for name in self.certified.index} if self.certified is not None else set()
+        for name in sorted(self.standards, key=natural_sort_key):
+            roi = self.rois.get(name)
+            certified = "yes" if re.sub(r'[\s_-]', '', name).lower() in plain else "no"
+            self.standards_tree.insert('', tk.END, iid=name, text=name, values=(
+                len(self.standards[name]), certified, "{}:{}, {}:{}".format(*roi) if roi else "whole map"))
+
+    def set_roi(self):
+        selection = self.standards_tree.selection()
+        if not selection:
+            messagebox.showwarning("No Standard", "Select a standard first.", parent=self.dialog)
+            return
+        name = selection[0]
+        roi = self.rois.get(name)
+        text = simpledialog.askstring("Standard ROI", f"Region of {name} to average, as 'row0:row1, col0:col1'\n(blank for the whole map):",
+                                      initialvalue="{}:{}, {}:{}".format(*roi) if roi else "", parent=self.dialog)
+        if text is None:
+            return
+        try:
+            roi = parse_roi(text)
+        except ValueError as e:
+            messagebox.showerror("Invalid ROI", str(e), parent=self.dialog)
+            return
+        if roi is None:
+            self.rois.pop(name, None)
+        else:
+            self.rois[name] = roi
+        self.show_standards()
+
+    def standard_signal(self, path, roi):
+        # ROI means are cached with the derived maps, keyed by source identity, so refits only reread changed files
+        key = ('standard_signal', MatrixStore.source_key(path), roi)
+        value = self.app.derived_cache.get(key)
+        if value is None:
+            value = roi_mean(self.app.matrix_store.get(path), roi)
+            self.app.derived_cache.put(key, value, nbytes=8)
+        return value
+
+    def fit(self):
+        if not self.standards:
+            messagebox.showwarning("No Standards", "Select a directory of reference material maps first.", parent=self.dialog)
+            return
+        if self.certified is None:
+            messagebox.showwarning("No Certified Values", "Select the table of certified values first.", parent=self.dialog)
+            return
+        internal = self.internal_standard.get() or None
+        path = self.certified_path.get()
+        key = (tuple(sorted((name, element, MatrixStore.source_key(p)) for name, maps in self.standards.items() for element, p in maps.items())),
+               MatrixStore.source_key(path), tuple(sorted(self.rois.items())), self.model.get(), bool(self.through_zero.get()), internal)
+        calibration = self.app.calibration_cache.get(key)
+        if calibration is not None:
+            self.app.calibration = calibration
+            self.show_fits()
+            self.status_label.config(text=f"Reused the calibration of {len(calibration.fits)} element(s) fitted earlier this session.")
+            return
+        self.fit_btn.config(state=tk.DISABLED)
+        self.status_label.config(text="Measuring standards...")
+        args = (self.standards, self.certified, self.model.get(), bool(self.through_zero.get()), internal, dict(self.rois))
+        self.worker_thread = threading.Thread(target=self.run_fit, args=(key, args), daemon=True)
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_fit(self, key, args):
+        # Runs on a background thread; results are handed to Tk through the queue
+        try:
+            self.result_queue.put(('fitted', key, calibrate_standards(*args, signal=self.standard_signal)))
+        except Exception as e:
+            self.result_queue.put(('error', f"Calibration failed:\n{str(e)}"))
+
+    def poll_result(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            item = self.result_queue.get_nowait()
+        except queue.Empty:
+            self.dialog.after(50, self.poll_result)
+            return
+        if item[0] == 'progress':
+            self.status_label.config(text=item[1])
+            self.dialog.after(50, self.poll_result)
+            return
+        self.fit_btn.config(state=tk.NORMAL)
+        if item[0] == 'error':
+            self.status_label.config(text="")
+            messagebox.showerror("Error", item[1], parent=self.dialog)
+        elif item[0] == 'fitted':
+            _, key, calibration = item
+            if not calibration.fits:
+                self.status_label.config(text="No element has both a standard map and a certified value.")
+                return
+            self.app.calibration_cache[key] = calibration
+            self.app.calibration = calibration
+            self.show_fits()
+            self.status_label.config(text=f"Fitted {len(calibration.fits)} element(s) on {len(calibration.standards)} standard(s).")
+        elif item[0] == 'quantified':
+            _, written, skipped, output_dir = item
+            text = f"Wrote {len(written)} ppm map(s) to {output_dir}"
+            if skipped:
+                text += f"\nNot calibrated: {', '.join(sorted(set(skipped), key=natural_sort_key))}"
+            self.status_label.config(text=text)
+
+    def show_fits(self):
+        self.fits_tree.delete(*self.fits_tree.get_children())
+        calibration = self.app.calibration
+        for element in sorted(calibration.fits, key=natural_sort_key):
+            fit = calibration.fits[element]
+            self.fits_tree.insert('', tk.END, iid=element, text=element, values=(
+                f"{fit['slope']:.5g}", f"{fit['intercept']:.5g}", f"{fit['r2']:.4f}", fit['n']))
+        self.plot_fit()
+
+    def plot_fit(self):
+        calibration = self.app.calibration
+        selection = self.fits_tree.selection()
+        self.ax.clear()
+        if calibration is None or not selection or selection[0] not in calibration.fits:
+            self.canvas.draw()
+            return
+        element = selection[0]
+        fit = calibration.fits[element]
+        x = np.array([p[0] for p in fit['points']])
+        y = np.array([p[1] for p in fit['points']])
+        self.ax.scatter(x, y, color='#1f77b4', zorder=3)
+        for px, py, name in fit['points']:
+            self.ax.annotate(name, (px, py), textcoords='offset points', xytext=(4, 4), fontsize=8)
+        line_x = np.linspace(0, x.max() * 1.1, 2)
+        self.ax.plot(line_x, fit['slope'] * line_x + fit['intercept'], color='#d62728')
+        internal = calibration.internal_standard
+        self.ax.set_xlabel(f"{element} CPS / {internal} CPS" if internal else f"{element} CPS")
+        self.ax.set_ylabel(f"{element} / {internal} (certified)" if internal else f"{element} ppm (certified)")
+        self.ax.set_title(f"{element}: R\u00b2 = {fit['r2']:.4f}", fontsize=10)
+        self.canvas.draw()
+
+    def internal_settings(self):
+        """Return (internal standard, its ppm in the sample), or None after telling the user what is missing."""
+        calibration = self.app.calibration
+        if calibration is None:
+            messagebox.showwarning("No Calibration", "Fit a calibration first.", parent=self.dialog)
+            return None
+        if not calibration.internal_standard:
+            return None, None
+        try:
+            ppm = self.internal_ppm.get()
+        except (tk.TclError, ValueError):
+            ppm = 0
+        if not ppm > 0:
+            messagebox.showerror("Internal Standard", f"Enter the {calibration.internal_standard} concentration of the sample.",
+                                 parent=self.dialog)
+            return None
+        return calibration.internal_standard, ppm
+
+    def apply_loaded(self):
+        settings = self.internal_settings()
+        if settings is None:
+            return
+        try:
+            applied, skipped = self.app.quantify_loaded_maps(self.app.calibration, settings[1])
+        except Exception as e:
+            messagebox.showerror("Error", f"Quantification failed:\n{str(e)}", parent=self.dialog)
+            return
+        text = f"Converted to ppm: {', '.join(applied) or 'none'}"
+        if skipped:
+            text += f"\nNot converted: {', '.join(skipped)}"
+        self.status_label.config(text=text)
+
+    def quantify_directory(self):
+        settings = self.internal_settings()
+        if settings is None:
+            return
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of sample maps (CPS)")
+        if not directory:
+            return
+        output_dir = os.path.join(directory, "ppm")
+        self.fit_btn.config(state=tk.DISABLED)
+        self.worker_thread = threading.Thread(target=self.run_quantify, args=(directory, output_dir, settings), daemon=True)
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_quantify(self, directory, output_dir, settings):
+        # Runs on a background thread; every map is converted tile by tile straight into its output file
+        internal_standard, internal_ppm = settings
+        calibration = self.app.calibration
+        written, skipped = [], []
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            for sample, maps in group_sample_maps(list_matrix_files(directory)).items():
+                internal = None
+                if internal_standard:
+                    label = match_element(internal_standard, maps)
+                    if label is None:
+                        skipped.extend(maps)
+                        continue
+                    internal = load_view_matrix(maps[label])
+                for element, path in maps.items():
+                    if internal is not None and element == label:
+                        continue
+                    fit = calibration.fit_for(element)
+                    if fit is None:
+                        skipped.append(element)
+                        continue
+                    self.result_queue.put(('progress', f"Quantifying {sample} {element}..."))
+                    out_path = os.path.join(output_dir, f"{sample} {element}_ppm.npy")
+                    quantify_matrix(load_view_matrix(path), fit, internal, internal_ppm, out_path=out_path)
+                    written.append(out_path)
+            self.result_queue.put(('quantified', written, skipped, output_dir))
+        except Exception as e:
+            self.result_queue.put(('error', f"Quantification failed:\n{str(e)}"))
+
+    def close(self):
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class ScalingDialog:
+    """Compute per-element colour limits shared by every sample of a directory or of the watched catalog."""
+
+    def __init__(self, app, title="Cross-Sample Scaling"):
+        self.app = app
+        self.directory = tk.StringVar()
+        self.limits = tk.StringVar(value=SHARED_LIMITS[1])
+        self.low = tk.DoubleVar(value=1.0)
+        self.high = tk.DoubleVar(value=99.0)
+        self.workers = tk.IntVar(value=os.cpu_count() or 1)
+        self.result_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker_thread = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("760x560")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        scaling = app.shared_scaling
+        if scaling is not None:
+            self.limits.set(scaling['limits'])
+            self.low.set(scaling['percentiles'][0])
+            self.high.set(scaling['percentiles'][1])
+            self.show_scaling()
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.TOP, fill=tk.X)
+        tk.Label(control_frame, text="Directory:", font=("Arial", 12)).grid(row=0, column=0, sticky='w')
+        tk.Entry(control_frame, textvariable=self.directory, font=("Arial", 11), width=40).grid(row=0, column=1, columnspan=3, sticky='we', padx=5)
+        tk.Button(control_frame, text="Browse", command=self.browse, font=("Arial", 10)).grid(row=0, column=4, sticky='w')
+        tk.Label(control_frame, text="Limits:", font=("Arial", 12)).grid(row=1, column=0, sticky='w', pady=(6, 0))
+        ttk.Combobox(control_frame, textvariable=self.limits, values=SHARED_LIMITS, state='readonly', width=12,
+                     font=("Arial", 11)).grid(row=1, column=1, sticky='w', padx=5, pady=(6, 0))
+        percentile_row = tk.Frame(control_frame)
+        percentile_row.grid(row=1, column=2, columnspan=3, sticky='w', pady=(6, 0))
+        tk.Label(percentile_row, text="Percentiles:", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Entry(percentile_row, textvariable=self.low, width=5, font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 2))
+        tk.Label(percentile_row, text="to", font=("Arial", 11)).pack(side=tk.LEFT)
+        tk.Entry(percentile_row, textvariable=self.high, width=5, font=("Arial", 11)).pack(side=tk.LEFT, padx=(2, 10))
+        tk.Label(percentile_row, text="Workers:", font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Entry(percentile_row, textvariable=self.workers, width=4, font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 0))
+
+        button_row = tk.Frame(self.dialog, padx=10)
+        button_row.pack(side=tk.TOP, fill=tk.X)
+        self.compute_btn = tk.Button(button_row, text="Compute from Directory", command=self.start_directory,
+                                     font=("Arial", 12, "bold"), bg="#4CAF50", fg="white")
+        self.compute_btn.pack(side=tk.LEFT)
+        self.catalog_btn = tk.Button(button_row, text="Compute from Watched Files", command=self.start_catalog, font=("Arial", 11))
+        self.catalog_btn.pack(side=tk.LEFT, padx=(5, 0))
+        self.progress_bar = ttk.Progressbar(self.dialog, orient=tk.HORIZONTAL, mode='determinate')
+        self.progress_bar.pack(side=tk.TOP, fill=tk.X, padx=10, pady=(10, 2))
+        self.status_label = tk.Label(self.dialog, text="", font=("Arial", 10, "italic"), anchor='w')
+        self.status_label.pack(side=tk.TOP, fill=tk.X, padx=10)
+
+        apply_row = tk.Frame(self.dialog, padx=10, pady=10)
+        apply_row.pack(side=tk.BOTTOM, fill=tk.X)
+        tk.Button(apply_row, text="Apply to Element Viewer", command=self.app.apply_shared_single_limits, font=("Arial", 11)).pack(side=tk.LEFT)
+        tk.Button(apply_row, text="Apply to RGB Overlay", command=self.app.apply_shared_rgb_limits, font=("Arial", 11)).pack(side=tk.LEFT, padx=(5, 0))
+        tk.Button(apply_row, text="Close", command=self.close, font=("Arial", 11)).pack(side=tk.RIGHT)
+
+        self.tree = ttk.Treeview(self.dialog, columns=('files', 'min', 'low', 'high', 'max'), height=12)
+        self.tree.heading('#0', text="Element")
+        self.tree.column('#0', width=100)
+        for column, text in [('files', "Files"), ('min', "Min"), ('low', "Low pct."), ('high', "High pct."), ('max', "Max")]:
+            self.tree.heading(column, text=text)
+            self.tree.column(column, width=100, anchor='e')
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=10)
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def browse(self):
+        directory = filedialog.askdirectory(parent=self.dialog, title="Select directory of element maps (all samples)")
+        if directory:
+            self.directory.set(directory)
+
+    def start_directory(self):
+        directory = self.directory.get().strip()
+        if not os.path.isdir(directory):
+            messagebox.showerror("Error", "Please select an existing directory.", parent=self.dialog)
+            return
+        self.start(list_matrix_files(directory), directory)
+
+    def start_catalog(self):
+        self.start([entry['path'] for entry in self.app.catalog.all_entries()], "watched files")
+
+    def start(self, paths, source):
+        if not paths:
+            messagebox.showwarning("No Files", "No matrix files were found.", parent=self.dialog)
+            return
+        try:
+            percentiles = (float(self.low.get()), float(self.high.get()))
+            workers = max(int(self.workers.get()), 1)
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Invalid Value", "Please enter numbers for the percentiles and workers.", parent=self.dialog)
+            return
+        if not 0 <= percentiles[0] < percentiles[1] <= 100:
+            messagebox.showerror("Invalid Value", "Percentiles must satisfy 0 ≤ low < high ≤ 100.", parent=self.dialog)
+            return
+        self.cancel_event.clear()
+        self.compute_btn.config(state=tk.DISABLED)
+        self.catalog_btn.config(state=tk.DISABLED)
+        self.progress_bar.config(maximum=len(paths), value=0)
+        self.status_label.config(text=f"Summarizing {len(paths)} map(s)...")
+        self.worker_thread = threading.Thread(target=self.run_scaling, args=(paths, source, percentiles, workers), daemon=True)
+        self.worker_thread.start()
+        self.poll_result()
+
+    def run_scaling(self, paths, source, percentiles, workers):
+        # Runs on a background thread; every file is summarized in its own process
+        try:
+            summary = element_scaling(paths, percentiles, workers, cancel_event=self.cancel_event,
+                                      progress=lambda done, total, path: self.result_queue.put(('progress', done, path)))
+            if summary is not None:
+                self.result_queue.put(('finished', source, percentiles, summary))
+        except Exception as e:
+            self.result_queue.put(('error', str(e)))
+
+    def poll_result(self):
+        if not self.dialog.winfo_exists():
+            return
+        try:
+            while True:
+                item = self.result_queue.get_nowait()
+                if item[0] == 'progress':
+                    self.progress_bar.config(value=item[1])
+                    self.status_label.config(text=os.path.basename(item[2]))
+                    continue
+                self.compute_btn.config(state=tk.NORMAL)
+                self.catalog_btn.config(state=tk.NORMAL)
+                if item[0] == 'error':
+                    self.status_label.config(text="")
+                    messagebox.showerror("Error", f"Computing the shared scaling failed:\n{item[1]}", parent=self.dialog)
+                else:
+                    _, source, percentiles, summary = item
+                    elements, failed = summary['elements'], summary['failed']
+                    files = sum(stats['files'] for stats in elements.values())
+                    text = f"{len(elements)} element(s) over {files} file(s) from {source}"
+                    if failed:
+                        text += f", {len(failed)} failed:\n" + "\n".join(f"{os.path.basename(path)}: {err}"
+                                                                         for path, err in failed[:5])
+                    if elements:
+                        self.app.shared_scaling = {'source': source, 'limits': self.limits.get(),
+                                                   'percentiles': list(percentiles), 'elements': elements}
+                        self.show_scaling()
+                    self.status_label.config(text=text)
+                return
+        except queue.Empty:
+            pass
+        self.dialog.after(100, self.poll_result)
+
+    def show_scaling(self):
+        scaling = self.app.shared_scaling
+        low, high = (percentile_key(q) for q in scaling['percentiles'])
+        self.tree.delete(*self.tree.get_children())
+        for element in sorted(scaling['elements'], key=natural_sort_key):
+            stats = scaling['elements'][element]
+            self.tree.insert('', tk.END, text=element, values=(stats['files'], *(f"{stats[k]:.4g}" for k in ('min', low, high, 'max'))))
+
+    def close(self):
+        if self.app.shared_scaling is not None:
+            # The limit choice applies to the next one-click application as well
+            self.app.shared_scaling['limits'] = self.limits.get()
+        self.cancel_event.set()
+        self.dialog.destroy()
+
+class CorrelationDialog:
+    def __init__(self, app, title="Channel Correlation"):
+        self.app = app
+        self.x_channel = tk.StringVar()
+        self.y_channel = tk.StringVar()
+        self.bins = tk.IntVar(value=256)
+        self.log_scale = tk.IntVar(value=1)
+        # Precomputed per channel pair: histogram, edges and pixel -> bin lookup
+        self.hist = None
+        self.x_edges = None
+        self.y_edges = None
+        self.bin_index = None
+        self.hist_key = None
+        self.coefficients = {}  # (x channel, y channel) -> (pearson, spearman, n)
+        self.selector = None
+
+        self.dialog = tk.Toplevel(app.root)
+        self.dialog.title(title)
+        self.dialog.geometry("620x620")
+        self.dialog.transient(app.root)
+        self.build_dialog()
+        self.update_plot()
+
+    def build_dialog(self):
+        control_frame = tk.Frame(self.dialog, padx=10, pady=10)
+        control_frame.pack(side=tk.TOP, fill=tk.X)
+
+        choices = self.channel_choices()
+        if choices:
+            self.x_channel.set(choices[0])
+            self.y_channel.set(choices[1] if len(choices) > 1 else choices[0])
+        for label, var in [("X:", self.x_channel), ("Y:", self.y_channel)]:
+            tk.Label(control_frame, text=label, font=("Arial", 12)).pack(side=tk.LEFT)
+            combo = ttk.Combobox(control_frame, textvariable=var, values=choices, width=14, state='readonly', font=("Arial", 11))
+            combo.pack(side=tk.LEFT, padx=(2, 10))
+            combo.bind("<<ComboboxSelected>>", lambda e: self.update_plot())
+        tk.Label(control_frame, text="Bins:", font=("Arial", 12)).pack(side=tk.LEFT)
+        bins_box = tk.Spinbox(control_frame, from_=16, to=1024, increment=16, textvariable=self.bins, width=5,
+                              font=("Arial", 11), command=self.update_plot)
+        bins_box.pack(side=tk.LEFT, padx=(2, 10))
+        bins_box.bind("<Return>", lambda e: self.update_plot())
+        tk.Checkbutton(control_frame, text="Log density", variable=self.log_scale, command=self.update_plot,
+                       font=("Arial", 12)).pack(side=tk.LEFT)
+        tk.Button(control_frame, text="Clear Highlight", command=self.clear_highlight, font=("Arial", 11)).pack(side=tk.RIGHT)
+
+        self.stats_label = tk.Label(self.dialog, text="", font=("Arial", 12), anchor='w')
+        self.stats_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0, 10))
+
+        self.figure, self.ax = plt.subplots(constrained_layout=True)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.dialog)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+
+    def channel_choices(self):
+        choices = []
+        for ch in 'RGB':
+            if self.app.rgb_data[ch] is not None:
+                choices.append(f"{ch}: {self.app.channel_element(ch)}")
+        return choices
+
+    def update_plot(self):
+        from matplotlib.colors import LogNorm
+        from matplotlib.widgets import RectangleSelector
+
+        if not self.x_channel.get() or not self.y_channel.get():
+            self.stats_label.config(text="Load at least one RGB channel to compare.")
+            return
+        try:
+            channels = self.app.rgb_channels()
+        except Exception as e:
+            messagebox.showerror("Alignment Error", f"Could not align the channels:\n{str(e)}", parent=self.dialog)
+            return
+        x_mat = channels[self.x_channel.get()[0]]
+        y_mat = channels[self.y_channel.get()[0]]
+        if x_mat is None or y_mat is None:
+            return
+        if x_mat.shape != y_mat.shape:
+            messagebox.showerror("Shape Mismatch", f"The channels have different shapes: {x_mat.shape} and {y_mat.shape}.", parent=self.dialog)
+            return
+        try:
+            bins = min(max(int(self.bins.get()), 2), 4096)
+        except (tk.TclError, ValueError):
+            bins = 256
+
+        # Only rebin when the channel pair or bin count changes, not for display toggles
+        key = (self.x_channel.get(), self.y_channel.get(), matrix_generation(x_mat), matrix_generation(y_mat), bins)
+        if key != self.hist_key:
+            self.hist, self.x_edges, self.y_edges, self.bin_index = density_histogram(x_mat, y_mat, bins)
+            self.hist_key = key
+
+        self.ax.clear()
+        counts = np.ma.masked_equal(self.hist.T, 0)
+        norm = LogNorm(vmin=1, vmax=max(counts.max(), 1)) if self.log_scale.get() else None
+        self.ax.imshow(counts, origin='lower', aspect='auto', cmap='magma', norm=norm, interpolation='nearest',
+                       extent=[self.x_edges[0], self.x_edges[-1], self.y_edges[0], self.y_edges[-1]])
+        self.ax.set_xlabel(self.x_channel.get()[3:])
+        self.ax.set_ylabel(self.y_channel.get()[3:])
+        self.selector = RectangleSelector(self.ax, self.on_select, useblit=True, interactive=True, button=[1])
+        self.canvas.draw()
+        self.update_coefficients(key[:4], x_mat, y_mat)
+
+    def update_coefficients(self, pair, x_mat, y_mat):
+        # Ranking millions of pixels for Spearman takes a few seconds, so it runs on a worker thread
+        if pair in self.coefficients:
+            pearson, spearman, n = self.coefficients[pair]
+            self.stats_label.config(text=f"Pearson r = {pearson:.3f}    Spearman ρ = {spearman:.3f}    N = {n}")
+            return
+        self.stats_label.config(text="Computing correlation coefficients...")
+        result = queue.Queue()
+        threading.Thread(target=lambda: result.put(correlation_coefficients(x_mat, y_mat)), daemon=True).start()
+
+        def poll():
+            if not self.dialog.winfo_exists():
+                return
+            try:
+                self.coefficients[pair] = result.get_nowait()
+            except queue.Empty:
+                self.dialog.after(50, poll)
+                return
+            if self.hist_key is not None and self.hist_key[:4] == pair:
+                self.update_coefficients(pair, x_mat, y_mat)
+        poll()
+
+    def on_select(self, eclick, erelease):
+        if self.bin_index is None:
+            return
+        bins = self.hist.shape[0]
+        x0, x1 = sorted([eclick.xdata, erelease.xdata])
+        y0, y1 = sorted([eclick.ydata, erelease.ydata])
+        # Convert the brushed data range to bin ranges
+        ix0, ix1 = np.clip(np.searchsorted(self.x_edges, [x0, x1], side='right') - 1, 0, bins - 1)
+        iy0, iy1 = np.clip(np.searchsorted(self.y_edges, [y0, y1], side='right') - 1, 0, bins - 1)
+        selected = np.zeros((bins, bins), dtype=bool)
+        selected[ix0:ix1 + 1, iy0:iy1 + 1] = True
+        # Last lookup entry is the NaN bin, which is never selected
+        lookup = np.append(selected.ravel(), False)
+        mask = lookup[self.bin_index].reshape(self.app.rgb_aligned[self.x_channel.get()[0]].shape)
+        self.app.set_rgb_highlight(mask)
+
+    def clear_highlight(self):
+        self.app.set_rgb_highlight(None)
+
+    def close(self):
+        self.app.set_rgb_highlight(None)
+        plt.close(self.figure)
+        self.dialog.destroy()
+
+class RenderScheduler:
+    """Coalesces redraw requests per view and computes frames off the Tk thread.
+
+    Each request bumps the view's generation and marks it dirty. A single
+    after_idle pass then starts one frame for it, however many requests came
+    in. A frame runs in three steps:
+    - prepare() on the Tk thread takes a cheap snapshot of the widget state.
+    - compute(state, cancelled) does the array work on a worker thread.
+    - blit(frame) draws the result back on the Tk thread.
+    A frame that finishes after a newer request for its view is dropped, and
+    compute can poll cancelled() to give up early. The exception is a view
+    that has not been redrawn for max_interval seconds: it keeps its
+    superseded frames, so dragging a slider still updates the view at a
+    steady rate. Views that are not visible stay dirty until show() is
+    called.
+    """
+
+    def __init__(self, root, workers=2, max_interval=0.1):
+        self.root = root
+        self.views = {}       # name -> (prepare, compute, blit, visible)
+        self.generation = {}  # name -> number of the latest request
+        self.dirty = set()    # views with requests no frame has started for yet
+        self.running = {}     # name -> generation of the frame being computed
+        self.last_blit = {}   # name -> time.monotonic() of the last drawn frame
+        self.max_interval = max_interval
+        self.frames = 0
+        self.dropped = 0
+        self._idle = None
+        self._polling = False
+        self._results = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def register(self, name, prepare, compute, blit, visible=None):
+        self.views[name] = (prepare, compute, blit, visible or (lambda: True))
+        self.generation[name] = 0
+        self.last_blit[name] = 0.0
+
+    def unregister(self, name):
+        """Forget a view, e.g. when its window closes; a frame still being computed is dropped."""
+        for table in (self.views, self.generation, self.last_blit, self.running):
+            table.pop(name, None)
+        self.dirty.discard(name)
+
+    def superseded(self, name, generation):
+        """True if a frame of this generation should be dropped."""
+        return (generation != self.generation[name]
+                and time.monotonic() - self.last_blit[name] < self.max_interval)
+
+    def request(self, name):
+        """Ask for a redraw of a view; returns at once."""
+        self.generation[name] += 1
+        self.dirty.add(name)
+        self._schedule()
+
+    def show(self):
+        """Draw views that have become visible with requests pending."""
+        if self.dirty:
+            self._schedule()
+
+    def render_now(self, name, force=False, **options):
+        """Draw a view synchronously on the Tk thread, e.g. before saving it.
+
+        Without force, only a view with a request pending is drawn. options
+        are passed on to its prepare().
+        """
+        if not force and name not in self.dirty and name not in self.running:
+            return
+        prepare, compute, blit, _ = self.views[name]
+        # Any frame still being computed is stale from here on
+        self.generation[name] += 1
+        self.dirty.discard(name)
+        state = prepare(**options)
+        frame = compute(state, lambda: False) if state is not None else None
+        if frame is not None:
+            self._blit(name, frame)
+
+    def _blit(self, name, frame):
+        self.views[name][2](frame)
+        self.last_blit[name] = time.monotonic()
+        self.frames += 1
+
+    def _schedule(self):
+        if self._idle is None:
+            self._idle = self.root.after_idle(self._flush)
+
+    def _flush(self):
+        self._idle = None
+        for name in list(self.dirty):
+            prepare, compute, blit, visible = self.views[name]
+            if name in self.running or not visible():
+                continue  # Picked up when the running frame finishes or the view is shown
+            self.dirty.discard(name)
+            generation = self.generation[name]
+            try:
+                state = prepare()
+            except Exception as e:
+                messagebox.showerror("Display Error", f"Could not draw the view:\n{str(e)}")
+                continue
+            if state is None:
+                continue
+            cancelled = lambda n=name, g=generation: self.superseded(n, g)
+            future = self.executor.submit(compute, state, cancelled)
+            self.running[name] = generation
+            future.add_done_callback(lambda f, n=name, g=generation: self._results.put((n, g, f)))
+        if self.running and not self._polling:
+            self._polling = True
+            self.root.after(5, self._poll)
+
+    def _poll(self):
+        try:
+            while True:
+                name, generation, future = self._results.get_nowait()
+                if name not in self.views:
+                    continue
+                if self.running.get(name) == generation:
+                    del self.running[name]
+                if self.superseded(name, generation):
+                    self.dropped += 1
+                    continue
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    if generation == self.generation[name]:
+                        messagebox.showerror("Display Error", f"Could not draw the view:\n{str(e)}")
+                    continue
+                if frame is not None:
+                    self._blit(name, frame)
+                else:
+                    self.dropped += 1
+        except queue.Empty:
+            pass
+        if self.dirty:
+            self._schedule()
+        if self.running:
+            self.root.after(5, self._poll)
+        else:
+            self._polling = False
+
+class CursorProbe:
+    """Hover readout of every map on a view at the pixel under the cursor.
+
+    The crosshair is a pair of animated lines blitted over a copy of the view
+    taken after each full draw, so following the mouse never redraws the map.
+    Values are single index lookups into the stored matrices, which works just
+    as well on memory-mapped maps.
+    """
+
+    def __init__(self, app, view, label):
+        self.app = app
+        self.view = view
+        self.ax = app.single_ax if view == 'single' else app.rgb_ax
+        self.canvas = app.single_canvas if view == 'single' else app.rgb_canvas
+        self.label = label
+        self.maps = None         # {name: matrix} probed, looked up again after the view is redrawn
+        self.lines = None        # Crosshair (horizontal, vertical)
+        self.background = None   # The view as last drawn, without the crosshair
+        self.shown = False
+        app.view_overlays[view].append(self.draw_overlay)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('axes_leave_event', lambda event: self.hide())
+
+    def draw_overlay(self, ax):
+        # Called again whenever the view is redrawn from scratch
+        self.maps = None
+        self.lines = (ax.axhline(np.nan, color='white', linewidth=0.8, animated=True),
+                      ax.axvline(np.nan, color='white', linewidth=0.8, animated=True))
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.shown = False
+
+    def on_motion(self, event):
+        # Dragging belongs to other tools (e.g. moving a line profile point)
+        if (not self.app.show_probe.get() or event.inaxes is not self.ax or event.xdata is None
+                or event.button is not None or self.lines is None or self.background is None):
+            self.hide()
+            return
+        if self.maps is None:
+            self.maps = self.app.view_maps(self.view)
+        row, col = int(round(event.ydata)), int(round(event.xdata))
+        readings = []
+        for name, mat in self.maps.items():
+            if 0 <= row < mat.shape[0] and 0 <= col < mat.shape[1]:
+                readings.append(f"{name}: {float(mat[row, col]):.4g}")
+        if not readings:
+            self.hide()
+            return
+        try:
+            pixel_size = self.app.pixel_size.get()
+        except (tk.TclError, ValueError):
+            pixel_size = None
+        position = f"x {col}, y {row} px"
+        if pixel_size:
+            position += f" ({col * pixel_size:g}, {row * pixel_size:g} µm)"
+        self.label.config(text=position + "    " + "    ".join(readings))
+        hline, vline = self.lines
+        hline.set_ydata([row, row])
+        vline.set_xdata([col, col])
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(hline)
+        self.ax.draw_artist(vline)
+        self.canvas.blit(self.ax.bbox)
+        self.shown = True
+
+    def hide(self):
+        if not self.shown:
+            return
+        self.shown = False
+        self.label.config(text="")
+        if self.background is not None:
+            self.canvas.restore_region(self.background)
+            self.canvas.blit(self.ax.bbox)
+
 class MuadDataViewer:
     def __init__(self, root):
         self.root = root
@@ -117,6 +2800,7 @@ class MuadDataViewer:
         # Single Element Viewer state
         self.single_matrix = None
         self.single_colormap = tk.StringVar(value='viridis')
+        self.nan_color = tk.StringVar(value='As zero')  # How empty (NaN) cells are drawn
         self.single_min = tk.DoubleVar()
         self.single_max = tk.DoubleVar()
         self.max_constraint = tk.IntVar()  # For constraining max slider value (integer only)
@@ -128,9 +2812,18 @@ class MuadDataViewer:
         self.single_file_name = None   # Store loaded file name
         self._single_colorbar = None   # Store the colorbar object for removal
         self.original_matrix = None    # Store original matrix for math operations
+        self.single_range = None       # (min, max) of the current matrix
+        self.single_view = None        # Zoomed window (row0, row1, col0, col1), None for the whole map
+        self.single_source_path = None # Path the current map was loaded from
+        self.single_math_history = []  # Map Math expressions applied since loading
+        self.single_filter = tk.StringVar(value='None')  # Denoising filter shown in the Element Viewer
+        self.single_filter_size = tk.IntVar(value=3)
+        self.single_transform = tk.StringVar(value='Linear')  # Display transform and its parameter
+        self.single_transform_param = tk.DoubleVar(value=1.0)
 
         # RGB Overlay state
         self.rgb_data = {'R': None, 'G': None, 'B': None}
+        self.rgb_sources = {'R': None, 'G': None, 'B': None}  # Paths the channels were loaded from
         self.rgb_sliders = {}
         self.rgb_labels = {}
         self.rgb_colors = {'R': '#ff0000', 'G': '#00ff00', 'B': '#0000ff'}  # Default colors
@@ -138,6 +2831,36 @@ class MuadDataViewer:
         self.rgb_gradient_canvases = {}
         self.file_root_label = None
         self.normalize_var = tk.IntVar()
+        self.rgb_highlight_mask = None     # Pixels highlighted from the correlation view
+        self.rgb_composer = ChannelComposer()  # Per-channel contributions of the displayed overlay
+        self.view_overlays = {'single': [], 'rgb': []}  # Tools drawing on a view: callables re-adding their artists
+        self.show_probe = tk.IntVar(value=1)  # Cursor probe on both views
+        self._rgb_highlight_artist = None
+        self.rgb_filter = tk.StringVar(value='None')  # Denoising filter applied to every channel
+        self.rgb_filter_size = tk.IntVar(value=3)
+        self.rgb_transform = tk.StringVar(value='Linear')
+        self.rgb_transform_param = tk.DoubleVar(value=1.0)
+        self.register_channels = tk.IntVar()  # Estimate channel offsets by phase correlation
+        self.rgb_aligned = dict.fromkeys('RGB')  # Channels cropped/resampled onto a common grid
+        self.rgb_shifts = {}
+        self._rgb_alignment_key = None
+
+        # Element maps ingested by the directory watcher
+        self.catalog = DatasetCatalog()
+        # Matrices loaded from files, shared by both tabs
+        self.matrix_store = MatrixStore()
+        self.precision_warned = set()
+        # The active CPS-to-ppm calibration, reused for every sample until it is refitted,
+        # and earlier fits keyed by their standards and settings
+        self.calibration = None
+        self.calibration_cache = {}
+        self.shared_scaling = None  # Per-element statistics over many samples, from the Cross-Sample Scaling dialog
+
+        # Filtered and transformed maps are cached per matrix and settings, so moving
+        # sliders or switching back to a filter or transform never recomputes them
+        self.derived_cache = LRUCache(DERIVED_CACHE_BYTES)
+        self.derived_executor = ThreadPoolExecutor(max_workers=2)
+        self._derived_jobs = {}  # cache key -> (future, callbacks to run when it finishes)
 
         # Tabs
         self.tabs = ttk.Notebook(self.root)
@@ -151,6 +2874,41 @@ class MuadDataViewer:
 
         self.build_single_tab()
         self.build_rgb_tab()
+        self.build_menu()
+
+        # Redraws go through the scheduler: coalesced, computed off the Tk thread, and skipped for the hidden tab
+        self.renderer = RenderScheduler(self.root)
+        self.renderer.register('single', self.prepare_single_frame, self.compute_single_frame, self.blit_single_frame,
+                               visible=lambda: self.tabs.select() == str(self.single_tab))
+        self.renderer.register('rgb', self.prepare_rgb_frame, self.compute_rgb_frame, self.blit_rgb_frame,
+                               visible=lambda: self.tabs.select() == str(self.rgb_tab))
+        self.tabs.bind("<<NotebookTabChanged>>", lambda e: self.renderer.show())
+        # Hovering either view reads out every loaded map at the cursor
+        self.probes = {'single': CursorProbe(self, 'single', self.single_probe_label),
+                       'rgb': CursorProbe(self, 'rgb', self.rgb_probe_label)}
+
+    def build_menu(self):
+        menubar = tk.Menu(self.root)
+        file_menu = tk.Menu(menubar, tearoff=0)
+        file_menu.add_command(label="Open Session...", command=self.open_session)
+        file_menu.add_command(label="Save Session...", command=self.save_session)
+        menubar.add_cascade(label="File", menu=file_menu)
+        self.tools_menu = tk.Menu(menubar, tearoff=0)
+        self.tools_menu.add_command(label="Ingest Line Scans...", command=self.open_line_scans)
+        self.tools_menu.add_command(label="Batch Map Math...", command=self.open_batch_math)
+        self.tools_menu.add_command(label="Map Algebra...", command=self.open_map_algebra)
+        self.tools_menu.add_command(label="Quantification...", command=self.open_quantification)
+        self.tools_menu.add_command(label="Channel Correlation...", command=self.open_correlation_view)
+        self.tools_menu.add_command(label="Phase Clustering...", command=self.open_phase_clustering)
+        self.tools_menu.add_command(label="Line Profile...", command=self.open_transect)
+        self.tools_menu.add_checkbutton(label="Cursor Probe", variable=self.show_probe)
+        self.tools_menu.add_command(label="Compare Maps...", command=self.open_comparison)
+        self.tools_menu.add_command(label="Watch Directory...", command=self.open_watch_directory)
+        self.tools_menu.add_command(label="Element Montage...", command=self.open_montage)
+        self.tools_menu.add_command(label="Cross-Sample Scaling...", command=self.open_scaling)
+        self.tools_menu.add_command(label="Matrix Memory...", command=self.configure_matrix_store)
+        menubar.add_cascade(label="Tools", menu=self.tools_menu)
+        self.root.config(menu=menubar)
 
     def build_single_tab(self):
         control_frame = tk.Frame(self.single_tab, padx=10, pady=10)
@@ -166,6 +2924,12 @@ class MuadDataViewer:
         cmap_menu.pack(fill=tk.X)
         cmap_menu.bind("<<ComboboxSelected>>", lambda e: self.view_single_map())
 
+        tk.Label(control_frame, text="Empty Cells", font=("Arial", 13)).pack()
+        nan_menu = ttk.Combobox(control_frame, textvariable=self.nan_color, values=['As zero', 'Transparent', 'White', 'Black', 'Custom...'],
+                                state='readonly', font=("Arial", 12))
+        nan_menu.pack(fill=tk.X)
+        nan_menu.bind("<<ComboboxSelected>>", lambda e: self.pick_nan_color())
+
         tk.Label(control_frame, text="Min Value", font=("Arial", 13)).pack()
         self.min_slider = tk.Scale(control_frame, from_=0, to=1, resolution=0.01, orient=tk.HORIZONTAL, variable=self.single_min, font=("Arial", 13))
         self.min_slider.pack(fill=tk.X)
@@ -190,6 +2954,9 @@ class MuadDataViewer:
         max_constraint_entry.pack(fill=tk.X)
         max_constraint_entry.bind("<Return>", lambda e: self.apply_max_constraint())
 
+        self.build_filter_controls(control_frame, self.single_filter, self.single_filter_size, self.view_single_map)
+        self.build_transform_controls(control_frame, self.single_transform, self.single_transform_param, self.update_histogram_and_view)
+
         tk.Checkbutton(control_frame, text="Show Color Bar", variable=self.show_colorbar, command=self.view_single_map, font=("Arial", 13)).pack(anchor='w')
         tk.Checkbutton(control_frame, text="Show Scale Bar", variable=self.show_scalebar, command=self.view_single_map, font=("Arial", 13)).pack(anchor='w')
 
@@ -200,9 +2967,11 @@ class MuadDataViewer:
         tk.Entry(control_frame, textvariable=self.scale_length, font=("Arial", 13)).pack(fill=tk.X)
 
         tk.Button(control_frame, text="View Map", command=self.view_single_map, font=("Arial", 13)).pack(fill=tk.X, pady=(10, 2))
+        tk.Button(control_frame, text="Apply Shared Limits", command=self.apply_shared_single_limits, font=("Arial", 13)).pack(fill=tk.X, pady=(2, 2))
         
         # Add Map Math button
         tk.Button(control_frame, text="Map Math", command=self.open_map_math, font=("Arial", 13), bg="#FF8C00", fg="black", relief="raised", bd=2).pack(fill=tk.X, pady=(5, 2))
+        tk.Button(control_frame, text="Segment Objects", command=self.open_segmentation, font=("Arial", 13)).pack(fill=tk.X, pady=(5, 2))
         
         # Add Reset to Original button
         tk.Button(control_frame, text="Reset to Original", command=self.reset_to_original, font=("Arial", 13), bg="#4169E1", fg="black", relief="raised", bd=2).pack(fill=tk.X, pady=(2, 2))
@@ -213,10 +2982,14 @@ class MuadDataViewer:
         self.single_file_label = tk.Label(control_frame, text="Loaded file: None", font=("Arial", 11, "italic"), anchor="w", justify="left", wraplength=200)
         self.single_file_label.pack(side=tk.BOTTOM, fill=tk.X, pady=(10, 0))
 
+        self.single_probe_label = tk.Label(display_frame, text="", font=("Arial", 11), anchor="w")
+        self.single_probe_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10)
         self.single_figure, self.single_ax = plt.subplots(constrained_layout=True)
         self.single_ax.axis('off')
         self.single_canvas = FigureCanvasTkAgg(self.single_figure, master=display_frame)
         self.single_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        # Scroll to zoom; large maps are redrawn from the matching pyramid level
+        self.single_canvas.mpl_connect('scroll_event', self.on_single_scroll)
 
     def build_rgb_tab(self):
         control_frame = tk.Frame(self.rgb_tab, padx=10, pady=10)
@@ -265,14 +3038,182 @@ class MuadDataViewer:
         self.color_scale_canvas.pack(fill=tk.X, pady=(2, 10))
 
         tk.Checkbutton(control_frame, text="Normalize to 99th Percentile", variable=self.normalize_var, font=("Arial", 13)).pack(anchor='w', pady=(10, 5))
+        self.build_filter_controls(control_frame, self.rgb_filter, self.rgb_filter_size, self.view_rgb_overlay)
+        self.build_transform_controls(control_frame, self.rgb_transform, self.rgb_transform_param, self.view_rgb_overlay)
+        tk.Checkbutton(control_frame, text="Register Channels", variable=self.register_channels, command=self.view_rgb_overlay, font=("Arial", 13)).pack(anchor='w', pady=(10, 0))
+        self.alignment_label = tk.Label(control_frame, text="", font=("Arial", 11, "italic"), anchor="w", justify="left", wraplength=200)
+        self.alignment_label.pack(fill=tk.X)
         tk.Button(control_frame, text="View Overlay", command=self.view_rgb_overlay, font=("Arial", 13)).pack(fill=tk.X, pady=(10, 2))
+        tk.Button(control_frame, text="Apply Shared Limits", command=self.apply_shared_rgb_limits, font=("Arial", 13)).pack(fill=tk.X, pady=(2, 2))
         tk.Button(control_frame, text="Save RGB Image", command=self.save_rgb_image, font=("Arial", 13)).pack(fill=tk.X)
 
+        self.rgb_probe_label = tk.Label(display_frame, text="", font=("Arial", 11), anchor="w")
+        self.rgb_probe_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10)
         self.rgb_figure, self.rgb_ax = plt.subplots(constrained_layout=True)
         self.rgb_ax.axis('off')
         self.rgb_canvas = FigureCanvasTkAgg(self.rgb_figure, master=display_frame)
         self.rgb_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
+    def build_filter_controls(self, parent, filter_var, size_var, command):
+        """Add a denoising filter chooser with its window size; command redraws the view."""
+        tk.Label(parent, text="Denoise", font=("Arial", 13)).pack(pady=(10, 0))
+        row = tk.Frame(parent)
+        row.pack(fill=tk.X)
+        filter_menu = ttk.Combobox(row, textvariable=filter_var, values=['None'] + list(DENOISE_FILTERS),
+                                   state='readonly', width=16, font=("Arial", 12))
+        filter_menu.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        filter_menu.bind("<<ComboboxSelected>>", lambda e: command())
+        size_box = tk.Spinbox(row, from_=3, to=15, increment=2, textvariable=size_var, width=3, font=("Arial", 12), command=command)
+        size_box.pack(side=tk.LEFT, padx=(5, 0))
+        size_box.bind("<Return>", lambda e: command())
+
+    def build_transform_controls(self, parent, mode_var, param_var, command):
+        """Add a display transform chooser with its parameter; command redraws the view."""
+        tk.Label(parent, text="Display Transform", font=("Arial", 13)).pack(pady=(10, 0))
+        row = tk.Frame(parent)
+        row.pack(fill=tk.X)
+        mode_menu = ttk.Combobox(row, textvariable=mode_var, values=list(VIEW_TRANSFORMS), state='readonly', width=16, font=("Arial", 12))
+        mode_menu.pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        def on_mode(event):
+            param_var.set(VIEW_TRANSFORMS[mode_var.get()])
+            command()
+
+        mode_menu.bind("<<ComboboxSelected>>", on_mode)
+        param_entry = tk.Entry(row, textvariable=param_var, width=5, font=("Arial", 12))
+        param_entry.pack(side=tk.LEFT, padx=(5, 0))
+        param_entry.bind("<Return>", lambda e: command())
+
+    def derived_matrix(self, mat, key, compute, on_ready, background=True):
+        """Return a map derived from mat, from the cache when possible.
+
+        compute(mat, out_path) produces it; out_path is a .npy file in the
+        binary cache for out-of-core maps (reused if it already exists) and None
+        otherwise. With background, a cache miss starts compute on a worker
+        thread and returns None; on_ready is called on the Tk thread once the
+        result is cached.
+        """
+        key = (key[0], matrix_generation(mat)) + tuple(key[1:])
+        cached = self.derived_cache.get(key)
+        if cached is not None:
+            return cached
+        if key in self._derived_jobs:
+            callbacks = self._derived_jobs[key][1]
+            if on_ready not in callbacks:
+                callbacks.append(on_ready)
+            return None
+        out_path = derived_cache_path(mat, key[2], key[3]) if is_out_of_core(mat) else None
+        if out_path and os.path.exists(out_path):
+            return self.derived_cache.put(key, np.load(out_path, mmap_mode='r'))
+        if not background:
+            return self.derived_cache.put(key, compute(mat, out_path))
+        future = self.derived_executor.submit(compute, mat, out_path)
+        self._derived_jobs[key] = (future, [on_ready])
+        self.root.after(50, self.poll_derived_job, key)
+        return None
+
+    def poll_derived_job(self, key):
+        future, callbacks = self._derived_jobs[key]
+        if not future.done():
+            self.root.after(50, self.poll_derived_job, key)
+            return
+        del self._derived_jobs[key]
+        try:
+            self.derived_cache.put(key, future.result())
+        except Exception as e:
+            messagebox.showerror("Display Error", f"Could not apply {key[2]}:\n{str(e)}")
+            return
+        for callback in callbacks:
+            callback()
+
+    def denoised_matrix(self, mat, filter_var, size_var, on_ready):
+        """Return mat with the chosen denoising filter applied, or None while it is computed in the background."""
+        name = filter_var.get()
+        if mat is None or name not in DENOISE_FILTERS:
+            return mat
+        try:
+            size = max(int(size_var.get()), 1)
+        except (tk.TclError, ValueError):
+            size = 3
+        return self.derived_matrix(mat, ('denoise', name, size),
+                                   lambda m, out_path: denoise_matrix(m, name, size, out_path), on_ready)
+
+    def display_transform(self, mode_var, param_var):
+        """Return (name, parameter) of the display transform chosen in a view; bad parameters fall back to the default."""
+        name = mode_var.get()
+        if name not in VIEW_TRANSFORMS:
+            name = 'Linear'
+        try:
+            param = float(param_var.get())
+        except (tk.TclError, ValueError):
+            param = 0
+        if not param > 0:
+            param = VIEW_TRANSFORMS[name]
+        if name == 'Equalize':
+            # The parameter is unused, so it must not tell cached results apart
+            param = EQUALIZATIONS[name]
+        return name, param
+
+    def prepare_transform(self, mat, name, param, on_ready):
+        """Tk-thread half of transformed_matrix for a scheduled frame; returns (name, param, transformed).
+
+        transformed is None when the frame worker should transform the map
+        itself (in-memory maps). Out-of-core maps are transformed by a
+        background job and drawn linearly until it has finished.
+        """
+        if name == 'Linear':
+            return name, param, mat
+        if not is_out_of_core(mat):
+            return name, param, None
+        transformed = self.transformed_matrix(mat, name, param, on_ready)
+        if transformed is None:
+            return 'Linear', 1.0, mat
+        return name, param, transformed
+
+    def transformed_matrix(self, mat, name, param, on_ready):
+        """Return mat through a display transform, or None while a large map is transformed in the background.
+
+        In-memory maps are transformed on the spot, a single vectorized pass.
+        Equalized maps first need the histograms of mat (see equalization_tiles).
+        """
+        if mat is None or name == 'Linear':
+            return mat
+        if name in EQUALIZATIONS:
+            tiles = self.equalization_tiles(mat, on_ready)
+            if tiles is None:
+                return None
+            clip_limit = param if name == 'CLAHE' else None
+            return self.derived_matrix(mat, ('transform', name, param),
+                                       lambda m, out_path: tiles.equalize(m, clip_limit, out_path), on_ready,
+                                       background=is_out_of_core(mat))
+        return self.derived_matrix(mat, ('transform', name, param),
+                                   lambda m, out_path: transform_matrix(m, name, param, out_path), on_ready,
+                                   background=is_out_of_core(mat))
+
+    def equalization_tiles(self, mat, on_ready):
+        """Return the EqualizationTiles of mat, or None while a large map is counted in the background.
+
+        They are counted once per map and shared by both equalization modes and
+        every clip limit. Without on_ready (on a frame worker) they are counted
+        on the spot.
+        """
+        # Kept in memory only; the derived file name is never written
+        return self.derived_matrix(mat, ('equalization', 'tiles', EqualizationTiles.GRID),
+                                   lambda m, out_path: EqualizationTiles.from_matrix(m), on_ready,
+                                   background=on_ready is not None and is_out_of_core(mat))
+
+    def transform_functions(self, mat, name, param, on_ready=None):
+        """Return (forward, inverse) of a display transform for mat, or None while its histograms are counted.
+
+        Equalized views use the global equalization of mat, so slider limits
+        and colorbars stay in original units; under CLAHE they are
+        approximate, since the mapping varies across the map.
+        """
+        if name not in EQUALIZATIONS:
+            return display_transform(name, param)
+        tiles = self.equalization_tiles(mat, on_ready)
+        return None if tiles is None else tiles.functions()
+
     def pick_channel_color(self, channel):
         # Open color chooser and update color for the channel
         channel_labels = {'R': 'Channel 1', 'G': 'Channel 2', 'B': 'Channel 3'}
@@ -311,8 +3252,8 @@ class MuadDataViewer:
                 c = {'red': f'#{i:02x}0000', 'green': f'#00{i:02x}00', 'blue': f'#0000{i:02x}'}[color]
                 canvas.create_line(i, 0, i, 10, fill=c)
 
-    def load_single_file(self):
-        path = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv")])
+    def load_single_file(self, path=None):
+        path = path or filedialog.askopenfilename(filetypes=MATRIX_FILETYPES)
         if not path:
             return
         
@@ -322,58 +3263,49 @@ class MuadDataViewer:
             return
         
         try:
-            if path.endswith('.xlsx'):
-                # Try different Excel engines to handle various formats
-                df = None
-                engines_to_try = ['openpyxl', 'xlrd', 'odf']
-                
-                for engine in engines_to_try:
-                    try:
-                        df = pd.read_excel(path, header=None, engine=engine)
-                        break  # If successful, break out of the loop
-                    except Exception as e:
-                        continue  # Try next engine
-                
-                if df is None:
-                    # If all engines failed, try with explicit sheet name
-                    try:
-                        df = pd.read_excel(path, header=None, sheet_name=0, engine='openpyxl')
-                    except Exception:
-                        try:
-                            df = pd.read_excel(path, header=None, sheet_name=0, engine='xlrd')
-                        except Exception as e:
-                            raise Exception(f"Could not read Excel file with any engine. Please ensure the file is a valid Excel format. Error: {str(e)}")
-            else:
-                df = pd.read_csv(path, header=None)
-            
-            df = df.apply(pd.to_numeric, errors='coerce').dropna(how='all').dropna(axis=1, how='all')
-            mat = df.to_numpy()
-            self.single_matrix = mat
-            # Store original matrix for math operations
-            self.original_matrix = np.array(mat, copy=True)
-            # Update min/max values and sliders
-            min_val = np.nanmin(mat)
-            max_val = np.nanmax(mat)
-            self.single_min.set(min_val)
-            self.single_max.set(max_val)
-            self.min_slider.config(from_=min_val, to=max_val)
-            self.max_slider.config(from_=min_val, to=max_val)
-            self.min_slider.set(min_val)
-            self.max_slider.set(max_val)
-            # Initialize max constraint with actual max value (as integer)
-            self.max_constraint.set(int(max_val))
-            # Update loaded file label
-            self.single_file_name = os.path.basename(path)
-            self.update_file_label()
-            # Update histogram
-            self.update_histogram()
-            self.view_single_map()
+            # Maps too large for memory are memory-mapped and processed tile by tile
+            self.set_single_matrix(self.matrix_store.get(path), os.path.basename(path), path)
+            self.warn_precision_loss(path)
         except Exception as e:
             error_msg = f"Failed to load matrix file:\n{e}\n\nFile path: {path}\nFile exists: {os.path.exists(path) if path else 'No path'}"
             messagebox.showerror("Error", error_msg)
             self.single_file_name = None
             self.update_file_label()
 
+    def warn_precision_loss(self, path):
+        """Warn once per file when a map had to be stored in double precision."""
+        path = os.path.abspath(path)
+        reason = self.matrix_store.precision_loss(path)
+        if reason and path not in self.precision_warned:
+            self.precision_warned.add(path)
+            messagebox.showwarning("Precision", f"{os.path.basename(path)} is kept in double precision, "
+                                                f"using twice the memory, because {reason}.")
+
+    def set_single_matrix(self, mat, file_name, source_path=None):
+        """Show a new map in the Element Viewer; source_path is the file it was loaded from, if any."""
+        self.single_matrix = mat
+        self.single_view = None
+        self.single_source_path = source_path
+        self.single_math_history = []
+        # Store original matrix for math operations (stored matrices are read-only, no copy needed)
+        self.original_matrix = mat
+        # Update min/max values and sliders
+        min_val, max_val = self.single_range = matrix_range(mat)
+        self.single_min.set(min_val)
+        self.single_max.set(max_val)
+        self.min_slider.config(from_=min_val, to=max_val)
+        self.max_slider.config(from_=min_val, to=max_val)
+        self.min_slider.set(min_val)
+        self.max_slider.set(max_val)
+        # Initialize max constraint with actual max value (as integer)
+        self.max_constraint.set(int(max_val))
+        # Update loaded file label
+        self.single_file_name = file_name
+        self.update_file_label()
+        # Update histogram
+        self.update_histogram()
+        self.view_single_map()
+
     def apply_max_constraint(self):
         """Apply the max constraint to limit the max slider value."""
         if self.single_matrix is None:
@@ -386,8 +3318,7 @@ class MuadDataViewer:
             return
         
         # Get current data range
-        min_val = np.nanmin(self.single_matrix)
-        max_val = np.nanmax(self.single_matrix)
+        min_val, max_val = self.single_range
         
         # Apply constraint
         constrained_max = min(max_val, constraint_value)
@@ -405,21 +3336,66 @@ class MuadDataViewer:
         if self.single_matrix is None:
             return
         
-        # Clear the canvas
-        self.histogram_canvas.delete("all")
-        
         # Get data and create histogram (only in current slider range)
-        data = self.single_matrix.flatten()
-        data = data[~np.isnan(data)]  # Remove NaN values
         current_min = self.single_min.get()
         current_max = self.single_max.get()
+        # Bins are evenly spaced on the display transform, labelled in original units
+        name, param = self.display_transform(self.single_transform, self.single_transform_param)
+        functions = None
+        if name in EQUALIZATIONS:
+            display = self.denoised_matrix(self.single_matrix, self.single_filter, self.single_filter_size, self.update_histogram)
+            functions = None if display is None else self.transform_functions(display, name, param, self.update_histogram)
+        else:
+            functions = display_transform(name, param)
+        if functions is None:
+            name = 'Linear'
+            functions = display_transform(name, 1.0)
+        forward, inverse = functions
+        edges = inverse(np.linspace(forward(current_min), forward(current_max), 51))
+        labels = None
+        if name != 'Linear':
+            labels = [current_min, float(inverse((forward(current_min) + forward(current_max)) / 2)), current_max]
+        if is_out_of_core(self.single_matrix):
+            # Streaming a large map takes a while, so it happens on a worker thread
+            mat = self.single_matrix
+            result = queue.Queue()
+
+            def compute():
+                try:
+                    result.put(('done', tiled_histogram(mat, edges)[0]))
+                except Exception as e:
+                    result.put(('error', str(e)))
+            threading.Thread(target=compute, daemon=True).start()
+
+            def poll():
+                try:
+                    kind, value = result.get_nowait()
+                except queue.Empty:
+                    self.root.after(50, poll)
+                    return
+                if kind == 'error':
+                    messagebox.showerror("Histogram Error", f"Could not compute the histogram:\n{value}")
+                elif self.single_matrix is mat:
+                    self.draw_histogram(value, labels)
+            poll()
+            return
+        
+        data = self.single_matrix.flatten()
+        data = data[~np.isnan(data)]  # Remove NaN values
         data = data[(data >= current_min) & (data <= current_max)]
         
         if len(data) == 0:
+            self.histogram_canvas.delete("all")
             return
         
         # Create histogram
-        hist, bin_edges = np.histogram(data, bins=50)
+        hist, bin_edges = np.histogram(data, bins=edges)
+        self.draw_histogram(hist, labels)
+
+    def draw_histogram(self, hist, labels=None):
+        """Draw histogram counts on the data distribution canvas, with optional left, middle and right value labels."""
+        # Clear the canvas
+        self.histogram_canvas.delete("all")
         
         # Get canvas dimensions
         canvas_width = self.histogram_canvas.winfo_width()
@@ -476,6 +3452,10 @@ class MuadDataViewer:
         self.histogram_canvas.create_line(0, 0, 0, canvas_height, fill='red', width=2)
         self.histogram_canvas.create_line(canvas_width, 0, canvas_width, canvas_height, fill='blue', width=2)
 
+        if labels:
+            for x, anchor, value in zip((3, canvas_width / 2, canvas_width - 3), ('nw', 'n', 'ne'), labels):
+                self.histogram_canvas.create_text(x, 2, text=f"{value:.3g}", anchor=anchor, fill='gray', font=("Arial", 7))
+
     def update_color_scale(self):
         """Update the color scale based on loaded channels."""
         # Clear the canvas
@@ -609,16 +3589,129 @@ class MuadDataViewer:
         self.update_histogram()
         self.view_single_map()
 
+    def matrix_levels(self, mat):
+        """Return the pyramid used to draw mat (just the matrix if it fits in memory), shared by every view."""
+        if not is_out_of_core(mat):
+            return [mat]
+        key = ('pyramid', matrix_generation(mat))
+        levels = self.derived_cache.get(key)
+        if levels is None:
+            levels = build_pyramid(mat, pyramid_cache_prefix(mat))
+            # Only the coarse levels held in memory count against the cache
+            self.derived_cache.put(key, levels, nbytes=sum(LRUCache.value_nbytes(level) for level in levels))
+        return levels
+
+    def on_single_scroll(self, event):
+        """Zoom the Element Viewer in or out around the cursor."""
+        if self.single_matrix is None or event.inaxes is not self.single_ax or event.xdata is None:
+            return
+        rows, cols = self.single_matrix.shape[:2]
+        r0, r1, c0, c1 = self.single_view or (0, rows, 0, cols)
+        factor = 0.8 if event.button == 'up' else 1.25
+        height = min(max((r1 - r0) * factor, 8), rows)
+        width = min(max((c1 - c0) * factor, 8), cols)
+        if height >= rows and width >= cols:
+            self.single_view = None
+        else:
+            # Keep the pixel under the cursor in place
+            top = np.clip(event.ydata - (event.ydata - r0) * height / (r1 - r0), 0, rows - height)
+            left = np.clip(event.xdata - (event.xdata - c0) * width / (c1 - c0), 0, cols - width)
+            self.single_view = (int(top), int(top + height), int(left), int(left + width))
+        self.view_single_map()
+
+    def pick_nan_color(self):
+        if self.nan_color.get() == 'Custom...':
+            color_code = colorchooser.askcolor(title="Pick color for empty cells")
+            self.nan_color.set(color_code[1] if color_code and color_code[1] else 'As zero')
+        self.view_single_map()
+
+    def nan_rgba(self):
+        """Colour of empty cells as an RGBA tuple, or None to draw them like zero."""
+        from matplotlib.colors import to_rgba
+
+        choice = self.nan_color.get()
+        if choice in ('As zero', 'Custom...'):
+            return None
+        return (0, 0, 0, 0) if choice == 'Transparent' else to_rgba(choice.lower())
+
+    def level_indices(self, display, window, target_pixels, value_range):
+        """Return (quantized level indices, extent) of the visible part of display.
+
+        In-memory maps are quantized once and cached, so changing the limits or
+        colormap only rebuilds the lookup table; the visible window is then
+        subsampled to about the canvas resolution. Out-of-core maps quantize just
+        the region read from the matching pyramid level.
+        """
+        lo, hi = value_range
+        if is_out_of_core(display):
+            region, extent = pyramid_window(self.matrix_levels(display), window, target_pixels)
+            return quantize_levels(region, lo, hi), extent
+        key = ('levels', matrix_generation(display), lo, hi, LUT_SIZE)
+        indices = self.derived_cache.get(key)
+        if indices is None:
+            indices = self.derived_cache.put(key, quantize_levels(display, lo, hi))
+        r0, r1, c0, c1 = window
+        step = max(max(r1 - r0, c1 - c0) // target_pixels, 1)
+        return indices[r0:r1:step, c0:c1:step], [c0 - 0.5, c1 - 0.5, r1 - 0.5, r0 - 0.5]
+
     def view_single_map(self):
+        """Redraw the Element Viewer; a burst of calls produces a single frame."""
+        self.renderer.request('single')
+
+    def prepare_single_frame(self):
+        # Tk thread: snapshot the widget state the frame is drawn from
         if self.single_matrix is None:
-            return
-        mat = np.array(self.single_matrix, dtype=float)
-        mat[np.isnan(mat)] = 0
-        # Update min/max values from sliders in case they changed
-        vmin = self.single_min.get()
-        vmax = self.single_max.get()
+            return None
+        rows, cols = self.single_matrix.shape[:2]
+        # Only the visible region is read, from the coarsest pyramid level that still fills the canvas
+        widget = self.single_canvas.get_tk_widget()
+        # The raw map is shown until the filter has finished in the background
+        display = self.denoised_matrix(self.single_matrix, self.single_filter, self.single_filter_size, self.view_single_map)
+        if display is None:
+            display = self.single_matrix
+        name, param = self.display_transform(self.single_transform, self.single_transform_param)
+        name, param, transformed = self.prepare_transform(display, name, param, self.view_single_map)
+        return {'matrix': self.single_matrix, 'display': display, 'transform': (name, param), 'transformed': transformed,
+                'window': self.single_view or (0, rows, 0, cols),
+                'target_pixels': max(widget.winfo_width(), widget.winfo_height(), 512),
+                'range': self.single_range, 'limits': (self.single_min.get(), self.single_max.get()),
+                'colormap': self.single_colormap.get(), 'nan_rgba': self.nan_rgba(),
+                'colorbar': self.show_colorbar.get(), 'scalebar': self.show_scalebar.get(),
+                'scale_length': self.scale_length.get(), 'pixel_size': self.pixel_size.get()}
+
+    def compute_single_frame(self, state, cancelled):
+        # Worker thread: transform, quantize and colour the visible region
+        name, param = state['transform']
+        transformed = state['transformed']
+        if transformed is None:
+            transformed = self.transformed_matrix(state['display'], name, param, None)
+        forward, inverse = self.transform_functions(state['display'], name, param)
+        value_range = state['range'] if state['range'] is not None else matrix_range(state['matrix'])
+        if cancelled():
+            return None
+        lo, hi = (float(v) for v in forward(value_range))
+        indices, extent = self.level_indices(transformed, state['window'], state['target_pixels'], (lo, hi))
+        vmin, vmax = state['limits']
+        # Colormap and limits live in a small lookup table; drawing is one indexing pass
+        lut = build_colormap_lut(state['colormap'], lo, hi, float(forward(vmin)), float(forward(vmax)), state['nan_rgba'])
+        return dict(state, image=lut[indices], extent=extent, forward=forward, inverse=inverse, range=value_range)
+
+    def blit_single_frame(self, frame):
+        from matplotlib.cm import ScalarMappable
+        from matplotlib.colors import Normalize, FuncNorm
+
+        if self.single_range is None and frame['matrix'] is self.single_matrix:
+            self.single_range = frame['range']
+        name = frame['transform'][0]
+        forward, inverse = frame['forward'], frame['inverse']
+        window = frame['window']
+        vmin, vmax = frame['limits']
         self.single_ax.clear()
-        im = self.single_ax.imshow(mat, cmap=self.single_colormap.get(), vmin=vmin, vmax=vmax)
+        self.single_ax.imshow(frame['image'], extent=frame['extent'], interpolation='nearest')
+        # The colorbar stays in original units, spaced by the transform
+        norm = Normalize(vmin=vmin, vmax=vmax) if name == 'Linear' else FuncNorm((forward, inverse), vmin=vmin, vmax=vmax)
+        im = ScalarMappable(norm=norm, cmap=frame['colormap'])
+        vmid = float(inverse((forward(vmin) + forward(vmax)) / 2))
         self.single_ax.axis('off')
         
         # Remove previous colorbar if it exists
@@ -630,38 +3723,39 @@ class MuadDataViewer:
             self._single_colorbar = None
         
         # Add colorbar with custom formatting
-        if self.show_colorbar.get():
+        if frame['colorbar']:
             # Create colorbar with reduced height and custom ticks
             self._single_colorbar = self.single_figure.colorbar(im, ax=self.single_ax, fraction=0.023, pad=0.04, aspect=20)
             # Set custom ticks (max, middle, min)
-            ticks = [vmin, (vmin + vmax) / 2, vmax]
+            ticks = [vmin, vmid, vmax]
             self._single_colorbar.set_ticks(ticks)
             # Format with 1-2 decimal places based on value range
             if vmax - vmin > 100:
                 format_str = '{:.1f}'
             else:
                 format_str = '{:.2f}'
-            self._single_colorbar.set_ticklabels([format_str.format(vmin), format_str.format((vmin + vmax) / 2), format_str.format(vmax)])
+            self._single_colorbar.set_ticklabels([format_str.format(vmin), format_str.format(vmid), format_str.format(vmax)])
             # Set font properties
             self._single_colorbar.ax.tick_params(labelsize=8)
             for label in self._single_colorbar.ax.get_yticklabels():
                 label.set_fontname('Arial')
         
         # Add scale bar underneath the colorbar (outside the image area)
-        if self.show_scalebar.get():
-            bar_length = self.scale_length.get() / self.pixel_size.get()
+        if frame['scalebar']:
+            bar_length = frame['scale_length'] / frame['pixel_size']
             # Position scale bar below the image and colorbar with more padding
-            x_start = 10
+            x_start = window[2] + 10
             x_end = x_start + bar_length
-            y_pos = mat.shape[0] + 25  # More padding below the image area
+            y_pos = window[1] + 25  # More padding below the image area
             
             # Draw scale bar
             self.single_ax.plot([x_start, x_end], [y_pos, y_pos], color='black', lw=2, solid_capstyle='butt')
             # Add scale bar label to the right of the bar
             label_offset = 10
-            self.single_ax.text(x_end + label_offset, y_pos, f"{int(self.scale_length.get())} µm", 
+            self.single_ax.text(x_end + label_offset, y_pos, f"{int(frame['scale_length'])} µm", 
                                color='black', fontsize=6, ha='left', va='center', fontname='Arial')
         
+        self.draw_view_overlays('single')
         # Use constrained_layout instead of tight_layout to prevent image shifting
         self.single_figure.set_constrained_layout(True)
         self.single_canvas.draw()
@@ -669,12 +3763,13 @@ class MuadDataViewer:
     def save_single_image(self):
         if self.single_matrix is None:
             return
+        self.renderer.render_now('single')
         out_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG", "*.png")])
         if out_path:
             self.single_figure.savefig(out_path, dpi=300, bbox_inches='tight')
 
-    def load_rgb_file(self, channel):
-        path = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv")])
+    def load_rgb_file(self, channel, path=None):
+        path = path or filedialog.askopenfilename(filetypes=MATRIX_FILETYPES)
         if not path:
             return
         
@@ -684,100 +3779,208 @@ class MuadDataViewer:
             return
         
         try:
-            if path.endswith('.xlsx'):
-                # Try different Excel engines to handle various formats
-                df = None
-                engines_to_try = ['openpyxl', 'xlrd', 'odf']
-                
-                for engine in engines_to_try:
-                    try:
-                        df = pd.read_excel(path, header=None, engine=engine)
-                        break  # If successful, break out of the loop
-                    except Exception as e:
-                        continue  # Try next engine
-                
-                if df is None:
-                    # If all engines failed, try with explicit sheet name
-                    try:
-                        df = pd.read_excel(path, header=None, sheet_name=0, engine='openpyxl')
-                    except Exception:
-                        try:
-                            df = pd.read_excel(path, header=None, sheet_name=0, engine='xlrd')
-                        except Exception as e:
-                            raise Exception(f"Could not read Excel file with any engine. Please ensure the file is a valid Excel format. Error: {str(e)}")
-            else:
-                df = pd.read_csv(path, header=None)
-            
-            df = df.apply(pd.to_numeric, errors='coerce').dropna(how='all').dropna(axis=1, how='all')
-            mat = df.to_numpy()
-            self.rgb_data[channel] = mat
+            mat = self.matrix_store.get(path, overview=True)
             file_name = os.path.basename(path)
-            root_name = file_name.split()[0]
-            elem = next((part for part in file_name.split() if any(e in part for e in ['ppm', 'CPS'])), 'Unknown')
-            self.rgb_labels[channel]['elem'].config(text=f"Loaded Element: {elem.split('_')[0]}")
-            if self.file_root_label.cget("text") == "Dataset: None":
-                self.file_root_label.config(text=f"Dataset: {root_name}")
-            max_val = float(np.nanmax(mat))
-            if np.isfinite(max_val):
-                self.rgb_sliders[channel]['max'].config(from_=0, to=max_val)
-                self.rgb_sliders[channel]['max'].set(max_val)
+            self.set_rgb_channel(channel, mat, parse_element_name(file_name), parse_dataset_root(file_name), path)
+            self.warn_precision_loss(path)
             messagebox.showinfo("Loaded", f"{channel} channel loaded with shape {mat.shape}")
-            # Update color scale
-            self.update_color_scale()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load {channel} channel:\n{e}")
 
+    def set_rgb_channel(self, channel, mat, element, sample, source_path=None):
+        """Put a map in an RGB channel; source_path is the file it was loaded from, if any."""
+        self.rgb_data[channel] = mat
+        self.rgb_sources[channel] = source_path
+        self.rgb_labels[channel]['elem'].config(text=f"Loaded Element: {element}")
+        if self.file_root_label.cget("text") == "Dataset: None":
+            self.file_root_label.config(text=f"Dataset: {sample}")
+        max_val = float(np.nanmax(mat))
+        if np.isfinite(max_val):
+            self.rgb_sliders[channel]['max'].config(from_=0, to=max_val)
+            self.rgb_sliders[channel]['max'].set(max_val)
+        # Align once now so redraws reuse the aligned channels
+        self.rgb_channels()
+        # Update color scale
+        self.update_color_scale()
+
+    def rgb_channels(self):
+        """Return the loaded RGB channels on a common pixel grid.
+
+        Channels are only re-aligned when one of them or the registration
+        setting changes; otherwise the cached aligned arrays are returned.
+        """
+        key = (self.register_channels.get(),) + tuple(
+            None if self.rgb_data[ch] is None else matrix_generation(self.rgb_data[ch]) for ch in 'RGB')
+        if key != self._rgb_alignment_key:
+            if all(self.rgb_data[ch] is None for ch in 'RGB'):
+                self.rgb_aligned, self.rgb_shifts = dict.fromkeys('RGB'), {}
+            else:
+                self.rgb_aligned, self.rgb_shifts = align_channels(self.rgb_data, bool(self.register_channels.get()))
+            self._rgb_alignment_key = key
+            shifted = [f"{ch}: {dy:+.2f}, {dx:+.2f} px" for ch, (dy, dx) in self.rgb_shifts.items() if dy or dx]
+            self.alignment_label.config(text="Shifts: " + "; ".join(shifted) if shifted else "")
+        return self.rgb_aligned
+
     def view_rgb_overlay(self, event=None):
-        def rescale(mat, vmax):
-            return np.clip(mat / (vmax + 1e-6), 0, 1)
-        def get_scaled_matrix(channel):
-            mat = self.rgb_data[channel]
-            vmax = self.rgb_sliders[channel]['max'].get()
-            if self.normalize_var.get():
-                p99 = np.nanpercentile(mat, 99)
-                vmax = min(vmax, p99)
-            scaled = rescale(mat, vmax)
-            scaled[np.isnan(scaled)] = 0
-            return scaled
-        shape = None
-        for ch in 'RGB':
-            if self.rgb_data[ch] is not None:
-                shape = self.rgb_data[ch].shape
-                break
-        if shape is None:
+        """Redraw the RGB overlay; a burst of calls (e.g. dragging a slider) produces a single frame."""
+        self.renderer.request('rgb')
+
+    def prepare_rgb_frame(self, full_resolution=False):
+        # Tk thread: snapshot the channels and settings the frame is drawn from
+        try:
+            channels = self.rgb_channels()
+        except Exception as e:
+            messagebox.showerror("Alignment Error", f"Could not align the channels:\n{str(e)}")
+            return None
+        if all(channels[ch] is None for ch in 'RGB'):
             messagebox.showwarning("No Data", "Please load at least one channel.")
-            return
-        composite = []
+            return None
+        name, param = self.display_transform(self.rgb_transform, self.rgb_transform_param)
+        layers = []
         for ch in 'RGB':
-            mat = self.rgb_data[ch]
+            if channels[ch] is None:
+                continue
+            mat = self.denoised_matrix(channels[ch], self.rgb_filter, self.rgb_filter_size, self.view_rgb_overlay)
             if mat is None:
-                composite.append(np.zeros(shape))
-            else:
-                composite.append(get_scaled_matrix(ch))
-        # Now, instead of stacking as RGB, use the selected color for each channel
-        rgb = np.zeros((shape[0], shape[1], 3), dtype=float)
-        for idx, ch in enumerate('RGB'):
-            color_hex = self.rgb_colors[ch]
-            r = int(color_hex[1:3], 16) / 255.0
-            g = int(color_hex[3:5], 16) / 255.0
-            b = int(color_hex[5:7], 16) / 255.0
-            # Add the channel's scaled matrix times the color
-            rgb[..., 0] += composite[idx] * r
-            rgb[..., 1] += composite[idx] * g
-            rgb[..., 2] += composite[idx] * b
-        rgb = np.clip(rgb, 0, 1)
-        rgb[np.isnan(rgb)] = 0
-        black_mask = np.all(rgb == 0, axis=2)
-        rgb[black_mask] = [0, 0, 0]
+                mat = channels[ch]
+            layers.append((ch, mat) + self.prepare_transform(mat, name, param, self.view_rgb_overlay)
+                          + (self.rgb_sliders[ch]['max'].get(), self.rgb_colors[ch]))
+        widget = self.rgb_canvas.get_tk_widget()
+        target_pixels = None if full_resolution else max(widget.winfo_width(), widget.winfo_height(), 512)
+        # A full-resolution frame gets its own composer so the on-screen one keeps its channels
+        composer = ChannelComposer() if full_resolution else self.rgb_composer
+        return {'layers': layers, 'normalize': self.normalize_var.get(), 'target_pixels': target_pixels,
+                'composer': composer}
+
+    def compute_rgb_frame(self, state, cancelled):
+        # Worker thread: rescale only the channels whose data or scaling changed, averaged down to
+        # about the canvas size, and update their share of the composed overlay
+        shape = state['layers'][0][1].shape
+        factor = max(max(shape) // state['target_pixels'], 1) if state['target_pixels'] else 1
+        composer = state['composer']
+        with composer.lock:
+            composer.reset((shape, factor), (-(-shape[0] // factor), -(-shape[1] // factor)))
+            for ch in set(composer.channels) - {layer[0] for layer in state['layers']}:
+                composer.update(ch, None, None, None)
+            for ch, mat, name, param, transformed, vmax, color_hex in state['layers']:
+                if cancelled():
+                    return None
+                weights = tuple(int(color_hex[start:start + 2], 16) / 255.0 for start in (1, 3, 5))
+                key = (matrix_generation(mat), name, param, vmax, bool(state['normalize']))
+                scaled = composer.scaled(ch) if composer.key(ch) == key else None
+                if scaled is None:
+                    scaled = self.scale_rgb_channel(composer, ch, key, mat, transformed, factor)
+                elif composer.channels[ch][2] == weights:
+                    continue
+                composer.update(ch, key, scaled, weights)
+            # Handed to Tk as 8-bit, which matplotlib draws much faster than floats
+            return {'rgb': composer.image(), 'shape': shape, 'factor': factor}
+
+    def scale_rgb_channel(self, composer, ch, key, mat, transformed, factor):
+        """Return one RGB channel scaled to 0-1 against its maximum and block-averaged by factor."""
+        generation, name, param, vmax, normalize = key
+        if transformed is None:
+            transformed = self.transformed_matrix(mat, name, param, None)
+        # Slider limits are in original units; every transform maps 0 (equalization: the minimum) to 0
+        vmax = float(self.transform_functions(mat, name, param)[0](vmax))
+        if normalize:
+            # The percentile only depends on the data, not on the slider being dragged
+            data_key = (generation, name, param)
+            cached = composer.percentiles.get(ch)
+            if cached is None or cached[0] != data_key:
+                cached = composer.percentiles[ch] = (data_key, np.nanpercentile(transformed, 99))
+            vmax = min(vmax, cached[1])
+        # Single precision and in-place operations keep the per-frame work to a few passes
+        scaled = np.multiply(transformed, np.float32(1 / (vmax + 1e-6)), dtype=np.float32)
+        np.clip(scaled, 0, 1, out=scaled)
+        np.nan_to_num(scaled, copy=False)
+        return block_mean(scaled, factor)
+
+    def blit_rgb_frame(self, frame):
+        rgb = frame['rgb']
+        rows, cols = frame['shape']
+        factor = frame['factor']
         self.rgb_ax.clear()
-        self.rgb_ax.imshow(rgb)
+        self._rgb_highlight_artist = None
+        # Averaged blocks keep full-resolution pixel coordinates, so overlays line up at any size
+        self.rgb_ax.imshow(rgb, extent=(-0.5, rgb.shape[1] * factor - 0.5, rgb.shape[0] * factor - 0.5, -0.5))
+        self.rgb_ax.set_xlim(-0.5, cols - 0.5)
+        self.rgb_ax.set_ylim(rows - 0.5, -0.5)
+        if self.rgb_highlight_mask is not None and self.rgb_highlight_mask.shape == (rows, cols):
+            self.draw_rgb_highlight()
         self.rgb_ax.axis('off')
+        self.draw_view_overlays('rgb')
         self.rgb_figure.tight_layout()
         self.rgb_canvas.draw()
 
+    def view_maps(self, view):
+        """{name: matrix} of the maps loaded on a view, all on the grid it is drawn on.
+
+        The Element Viewer map comes with any RGB channel of the same shape,
+        read at full resolution.
+        """
+        if view == 'rgb':
+            channels = self.rgb_channels()
+            return {f"{self.channel_element(ch)} ({ch})": channels[ch] for ch in 'RGB' if channels[ch] is not None}
+        if self.single_matrix is None:
+            return {}
+        name = parse_element_name(self.single_file_name or '')
+        maps = {name if name != 'Unknown' else 'Map': self.single_matrix}
+        seen = {os.path.abspath(self.single_source_path)} if self.single_source_path and not self.is_matrix_modified() else set()
+        # RGB channels may be shown as overviews, so they are sampled at full resolution
+        for ch in 'RGB':
+            path = self.rgb_sources[ch]
+            if not path or os.path.abspath(path) in seen:
+                continue
+            seen.add(os.path.abspath(path))
+            mat = self.matrix_store.get(path)
+            if mat.shape == self.single_matrix.shape:
+                maps.setdefault(self.channel_element(ch), mat)
+        return maps
+
+    def draw_view_overlays(self, view):
+        """Let open tools (e.g. a line profile) re-add their artists after a view was redrawn from scratch."""
+        ax = self.single_ax if view == 'single' else self.rgb_ax
+        for draw in self.view_overlays[view]:
+            draw(ax)
+
+    def channel_element(self, channel):
+        """Return the element label of a loaded RGB channel, or the channel letter."""
+        label = self.rgb_labels[channel]['elem'].cget("text")
+        if label.startswith("Loaded Element: "):
+            label = label[len("Loaded Element: "):]
+        return label if label != "None" else channel
+
+    def open_correlation_view(self):
+        """Open the density-binned scatter plot of two RGB channels."""
+        if all(self.rgb_data[c] is None for c in 'RGB'):
+            messagebox.showwarning("No Data", "Please load at least one channel.")
+            return
+        CorrelationDialog(self)
+
+    def set_rgb_highlight(self, mask):
+        """Highlight the pixels in mask on the RGB overlay, or clear the highlight if mask is None."""
+        self.rgb_highlight_mask = mask
+        if self._rgb_highlight_artist is not None:
+            try:
+                self._rgb_highlight_artist.remove()
+            except Exception:
+                pass
+            self._rgb_highlight_artist = None
+        if mask is not None and self.rgb_ax.images:
+            self.draw_rgb_highlight()
+        self.rgb_canvas.draw_idle()
+
+    def draw_rgb_highlight(self):
+        # Two-entry lookup: transparent for unselected pixels, yellow for selected ones
+        colors = np.array([[0, 0, 0, 0], [255, 255, 0, 190]], dtype=np.uint8)
+        self._rgb_highlight_artist = self.rgb_ax.imshow(colors[self.rgb_highlight_mask.view(np.uint8)], interpolation='nearest')
+
     def save_rgb_image(self):
         if all(self.rgb_data[c] is None for c in 'RGB'):
             return
+        # Saved at full resolution, not averaged down to the canvas
+        self.renderer.render_now('rgb', force=True, full_resolution=True)
         out_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG", "*.png")])
         if out_path:
             self.rgb_figure.savefig(out_path, dpi=300, bbox_inches='tight')
@@ -795,53 +3998,17 @@ class MuadDataViewer:
             try:
                 # Store original matrix if not already stored
                 if self.original_matrix is None:
-                    self.original_matrix = np.array(self.single_matrix, copy=True)
+                    self.original_matrix = self.single_matrix
                 
-                # Create a copy of the current matrix for processing
-                mat = np.array(self.single_matrix, dtype=float)
-                
-                # Create a mask for non-empty cells (where there are actual values)
-                # We'll consider cells with values > 0 as non-empty
-                non_empty_mask = (mat > 0) & ~np.isnan(mat)
-                
-                # Apply the expression only to non-empty cells
-                result_mat = np.array(mat, copy=True)
-                
-                # For each non-empty cell, apply the expression
-                for i in range(mat.shape[0]):
-                    for j in range(mat.shape[1]):
-                        if non_empty_mask[i, j]:
-                            x = mat[i, j]
-                            try:
-                                # Safely evaluate the expression for this cell
-                                result = eval(dialog.result, {"__builtins__": {}}, {"x": x, "np": np})
-                                result_mat[i, j] = result
-                            except Exception as e:
-                                messagebox.showerror("Evaluation Error", f"Error evaluating expression for cell [{i},{j}]:\n{str(e)}")
-                                return
+                # Apply the expression only to non-empty cells (values > 0)
+                try:
+                    result_mat = self.evaluate_single_expression(self.single_matrix, dialog.result)
+                except Exception as e:
+                    messagebox.showerror("Evaluation Error", f"Error evaluating expression:\n{str(e)}")
+                    return
                 
                 # Update the current matrix with the result
-                self.single_matrix = result_mat
-                
-                # Update min/max values and sliders
-                min_val = np.nanmin(result_mat)
-                max_val = np.nanmax(result_mat)
-                self.single_min.set(min_val)
-                self.single_max.set(max_val)
-                self.min_slider.config(from_=min_val, to=max_val)
-                self.max_slider.config(from_=min_val, to=max_val)
-                self.min_slider.set(min_val)
-                self.max_slider.set(max_val)
-                
-                # Update max constraint
-                self.max_constraint.set(int(max_val))
-                
-                # Update histogram and view
-                self.update_histogram()
-                self.view_single_map()
-                
-                # Update file label to show modification status
-                self.update_file_label()
+                self.show_single_result(result_mat, dialog.result)
                 
                 # Ask user if they want to save the result
                 save_result = messagebox.askyesno("Save Result", 
@@ -853,6 +4020,297 @@ class MuadDataViewer:
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to apply expression:\n{str(e)}")
     
+    def show_single_result(self, result_mat, expression=None):
+        """Show a computed map in the Element Viewer, recording its Map Math expression if it has one."""
+        self.single_matrix = result_mat
+        if expression is not None:
+            self.single_math_history.append(expression)
+
+        # Update min/max values and sliders
+        min_val, max_val = self.single_range = matrix_range(result_mat)
+        self.single_min.set(min_val)
+        self.single_max.set(max_val)
+        self.min_slider.config(from_=min_val, to=max_val)
+        self.max_slider.config(from_=min_val, to=max_val)
+        self.min_slider.set(min_val)
+        self.max_slider.set(max_val)
+
+        # Update max constraint
+        self.max_constraint.set(int(max_val))
+
+        # Update histogram and view
+        self.update_histogram()
+        self.view_single_map()
+
+        # Update file label to show modification status
+        self.update_file_label()
+
+    def evaluate_single_expression(self, mat, expression):
+        """Apply a Map Math expression, tile by tile into the cache for out-of-core maps."""
+        if is_out_of_core(mat):
+            key = f"{mat.filename}|{os.path.getmtime(mat.filename)}|{expression}"
+            out_path = os.path.join(CACHE_DIR, "math_" + hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy")
+            return tiled_apply_expression(mat, expression, out_path)
+        return apply_expression(mat, expression)
+
+    def open_watch_directory(self):
+        """Open the directory watcher that ingests new instrument exports as they arrive."""
+        WatchDialog(self)
+
+    def refresh_watched_file(self, path):
+        """Reload any view showing path after it changed on disk, keeping its display settings."""
+        path = os.path.abspath(path)
+        self.matrix_store.discard(path)
+        if (self.single_source_path and os.path.abspath(self.single_source_path) == path
+                and not self.is_matrix_modified()):
+            # Served from the binary cache the watcher just wrote
+            mat = self.matrix_store.get(path)
+            if self.single_matrix is None or mat.shape != self.single_matrix.shape:
+                self.single_view = None
+            self.single_matrix = mat
+            self.original_matrix = mat
+            min_val, max_val = self.single_range = matrix_range(mat)
+            # Keep the current limits where they still fit the new data
+            vmin = min(max(self.single_min.get(), min_val), max_val)
+            vmax = min(max(self.single_max.get(), min_val), max_val)
+            self.min_slider.config(from_=min_val, to=max_val)
+            self.max_slider.config(from_=min_val, to=max_val)
+            self.single_min.set(vmin)
+            self.single_max.set(vmax)
+            self.update_histogram()
+            self.view_single_map()
+
+        changed = False
+        for ch in 'RGB':
+            source = self.rgb_sources[ch]
+            if source and os.path.abspath(source) == path:
+                mat = self.matrix_store.get(path, overview=True)
+                self.rgb_data[ch] = mat
+                max_val = float(np.nanmax(mat))
+                if np.isfinite(max_val):
+                    slider = self.rgb_sliders[ch]['max']
+                    current = min(slider.get(), max_val)
+                    slider.config(from_=0, to=max_val)
+                    slider.set(current)
+                changed = True
+        if changed:
+            self.view_rgb_overlay()
+
+    def configure_matrix_store(self):
+        """Show how the shared matrix store is doing and let the user change its memory budget."""
+        stats = self.matrix_store.stats()
+        budget = simpledialog.askinteger(
+            "Matrix Memory",
+            f"{stats['matrices']} matrices stored, {stats['bytes'] / 1024 ** 2:.0f} MB in memory\n"
+            f"Hits: {stats['hits']}   Misses: {stats['misses']}   Evictions: {stats['evictions']}   Reloads: {stats['reloads']}\n\n"
+            "Memory budget (MB):",
+            initialvalue=stats['budget'] // 1024 ** 2, minvalue=64, parent=self.root)
+        if budget:
+            self.matrix_store.cache.resize(budget * 1024 ** 2)
+
+    def open_comparison(self):
+        """Open linked side-by-side views of several maps."""
+        ComparisonDialog(self)
+
+    def open_transect(self):
+        """Open a line profile on the tab being shown."""
+        view = 'rgb' if self.tabs.select() == str(self.rgb_tab) else 'single'
+        if (self.single_matrix is None if view == 'single' else all(self.rgb_data[c] is None for c in 'RGB')):
+            messagebox.showwarning("No Data", "Please load a map to draw the line on first.")
+            return
+        TransectDialog(self, view)
+
+    def spline_coefficients(self, mat, on_ready):
+        """Cached cubic spline coefficients of an in-memory map, or None while they are computed.
+
+        Memory-mapped maps have none; they are profiled by linear interpolation.
+        """
+        if is_out_of_core(mat):
+            return None
+        return self.derived_matrix(mat, ('spline', 'cubic', 3), lambda m, out_path: spline_coefficients(m), on_ready)
+
+    def open_scaling(self):
+        """Open the dialog that computes colour limits shared by all samples."""
+        ScalingDialog(self)
+
+    def shared_limits(self, element):
+        """(low, high) shared colour limits of an element, or None if there are none for it."""
+        scaling = self.shared_scaling
+        if scaling is None:
+            return None
+        label = match_element(element, scaling['elements'])
+        if label is None:
+            return None
+        stats = scaling['elements'][label]
+        if scaling['limits'] == 'Percentiles':
+            limits = tuple(stats[percentile_key(q)] for q in scaling['percentiles'])
+        else:
+            limits = (stats['min'], stats['max'])
+        return limits if all(np.isfinite(limits)) and limits[0] < limits[1] else None
+
+    def apply_shared_single_limits(self):
+        """Set the Element Viewer limits to the shared limits of its element."""
+        if self.single_matrix is None:
+            messagebox.showwarning("No Data", "Please load a matrix file first.")
+            return
+        if self.shared_scaling is None:
+            messagebox.showwarning("No Shared Limits", "Compute them under Tools > Cross-Sample Scaling... first.")
+            return
+        element = parse_element_name(self.single_file_name or '')
+        limits = self.shared_limits(element)
+        if limits is None:
+            messagebox.showwarning("No Shared Limits", f"The shared scaling has no limits for {element}.")
+            return
+        # The sliders must reach the shared limits even where this map's own range is narrower
+        lo, hi = min(limits[0], self.single_range[0]), max(limits[1], self.single_range[1])
+        self.min_slider.config(from_=lo, to=hi)
+        self.max_slider.config(from_=lo, to=hi)
+        self.single_min.set(limits[0])
+        self.single_max.set(limits[1])
+        self.min_slider.set(limits[0])
+        self.max_slider.set(limits[1])
+        self.update_histogram_and_view()
+
+    def apply_shared_rgb_limits(self):
+        """Set every RGB channel's maximum to the shared limit of its element."""
+        if all(self.rgb_data[c] is None for c in 'RGB'):
+            messagebox.showwarning("No Data", "Please load at least one channel.")
+            return
+        if self.shared_scaling is None:
+            messagebox.showwarning("No Shared Limits", "Compute them under Tools > Cross-Sample Scaling... first.")
+            return
+        missing = []
+        for ch in 'RGB':
+            if self.rgb_data[ch] is None:
+                continue
+            limits = self.shared_limits(self.channel_element(ch))
+            if limits is None:
+                missing.append(self.channel_element(ch))
+                continue
+            slider = self.rgb_sliders[ch]['max']
+            slider.config(to=max(float(slider.cget('to')), limits[1]))
+            slider.set(limits[1])
+        # Per-view percentile normalization would override the shared maxima
+        self.normalize_var.set(0)
+        self.view_rgb_overlay()
+        if missing:
+            messagebox.showwarning("No Shared Limits", f"The shared scaling has no limits for {', '.join(missing)}.")
+
+    def open_phase_clustering(self):
+        """Open the multi-element phase clustering of a sample."""
+        PhaseClusteringDialog(self)
+
+    def open_segmentation(self):
+        """Open the object segmentation of the Element Viewer map."""
+        if self.single_matrix is None:
+            messagebox.showwarning("No Data", "Please load a matrix file first.")
+            return
+        SegmentationDialog(self)
+
+    def open_line_scans(self):
+        """Open the ingestion dialog that builds maps from raw time-resolved line exports."""
+        LineScanDialog(self)
+
+    def open_montage(self):
+        """Open the small-multiples montage of all element maps of a sample."""
+        MontageDialog(self)
+
+    def open_quantification(self):
+        """Open the standards-based CPS-to-ppm quantification."""
+        QuantificationDialog(self)
+
+    def quantify_loaded_maps(self, calibration, internal_ppm=None):
+        """Convert the Element Viewer map and the RGB channels to ppm with calibration.
+
+        Returns (converted, not converted) element names. Maps without a fit,
+        or whose sample has no internal standard map, are left unchanged.
+        """
+        applied, skipped = [], []
+        internal_standard = calibration.internal_standard
+
+        def internal_map(source, overview):
+            if not internal_standard:
+                return None
+            path = sibling_element_path(source, internal_standard) if source else None
+            return self.matrix_store.get(path, overview) if path else None
+
+        if self.single_matrix is not None:
+            element = parse_element_name(self.single_file_name or '')
+            fit = calibration.fit_for(element)
+            # Only maps still holding the instrument counts of their file are converted
+            source = self.single_source_path if not self.is_matrix_modified() else None
+            internal = internal_map(source, False)
+            if fit is None or source is None or (internal_standard and internal is None):
+                skipped.append(element)
+            else:
+                if internal is None:
+                    # Without an internal standard the calibration is an ordinary Map Math step
+                    expression = calibration_expression(fit)
+                    self.show_single_result(self.evaluate_single_expression(self.single_matrix, expression), expression)
+                else:
+                    out_path = None
+                    if is_out_of_core(self.single_matrix):
+                        key = f"{self.single_matrix.filename}|{internal.filename}|{fit['slope']!r}|{fit['intercept']!r}|{internal_ppm!r}"
+                        out_path = os.path.join(CACHE_DIR, "ppm_" + hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy")
+                    self.show_single_result(quantify_matrix(self.single_matrix, fit, internal, internal_ppm, out_path))
+                applied.append(element)
+
+        changed = False
+        for ch in 'RGB':
+            if self.rgb_data[ch] is None:
+                continue
+            element = self.channel_element(ch)
+            fit = calibration.fit_for(element)
+            internal = internal_map(self.rgb_sources[ch], True)
+            if fit is None or not self.rgb_sources[ch] or (internal_standard and internal is None):
+                skipped.append(element)
+                continue
+            mat = quantify_matrix(self.rgb_data[ch], fit, internal, internal_ppm)
+            mat.flags.writeable = False
+            self.rgb_data[ch] = mat
+            # The channel no longer matches its file, so sessions store the converted matrix itself
+            self.rgb_sources[ch] = None
+            max_val = float(np.nanmax(mat))
+            if np.isfinite(max_val):
+                self.rgb_sliders[ch]['max'].config(from_=0, to=max_val)
+                self.rgb_sliders[ch]['max'].set(max_val)
+            applied.append(f"{element} ({ch})")
+            changed = True
+        if changed:
+            self.view_rgb_overlay()
+        return applied, skipped
+
+    def open_batch_math(self):
+        """Open the batch Map Math dialog for a whole directory of element maps."""
+        BatchMathDialog(self.root)
+
+    def open_map_algebra(self):
+        """Open the map algebra dialog for expressions across the element maps of a sample."""
+        MapAlgebraDialog(self)
+
+    def map_algebra_result(self, expression, paths, overview=False):
+        """Evaluate a MapExpression over a sample's files ({element label: path}).
+
+        Safe to call from worker threads. Results are kept in the derived-map
+        cache under the expression's canonical form and the identity of its
+        input files, so 'Zn/Ca' and 'Zn66 / Ca44' are computed once. With
+        overview, out-of-core files are read as their RGB channel overview.
+        """
+        sources = tuple(MatrixStore.source_key(paths[label], overview) for label in expression.inputs)
+        key = ('algebra', expression.key, sources)
+        cached = self.derived_cache.get(key)
+        if cached is not None:
+            return cached
+        maps = {label: self.matrix_store.get(paths[label], overview) for label in expression.inputs}
+        out_path = None
+        if any(is_out_of_core(mat) for mat in maps.values()):
+            out_path = os.path.join(CACHE_DIR, "algebra_" + hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + ".npy")
+            if os.path.exists(out_path):
+                return self.derived_cache.put(key, np.load(out_path, mmap_mode='r'))
+        result = expression.evaluate(maps, out_path)
+        result.flags.writeable = False
+        return self.derived_cache.put(key, result)
+
     def save_math_result(self, result_matrix, expression):
         """Save the math result to a file with automatic naming."""
         if self.single_file_name is None:
@@ -868,16 +4326,23 @@ class MuadDataViewer:
             defaultextension=".xlsx",
             filetypes=[
                 ("Excel files", "*.xlsx"),
-                ("CSV files", "*.csv")
+                ("CSV files", "*.csv"),
+                ("NumPy binary", "*.npy")
             ],
             initialfile=default_name
         )
         
         if save_path:
             try:
-                if save_path.endswith('.xlsx'):
+                if is_out_of_core(result_matrix) and not save_path.endswith('.npy'):
+                    messagebox.showerror("Save Error", "Maps too large for memory can only be saved in NumPy binary (.npy) format.")
+                    return
+                if save_path.endswith('.npy'):
+                    # Streams from the memory map for out-of-core maps
+                    save_matrix_binary(save_path, result_matrix)
+                elif save_path.endswith('.xlsx'):
                     # Save as Excel
-                    df = pd.DataFrame(result_matrix)
+                    df = pd.DataFrame(decimal_values(result_matrix))
                     df.to_excel(save_path, header=False, index=False)
                 elif save_path.endswith('.csv'):
                     # Save as CSV
@@ -896,11 +4361,11 @@ class MuadDataViewer:
     def reset_to_original(self):
         """Reset the current matrix to the original loaded matrix."""
         if self.original_matrix is not None:
-            self.single_matrix = np.array(self.original_matrix, copy=True)
+            self.single_matrix = self.original_matrix
+            self.single_math_history = []
             
             # Update min/max values and sliders
-            min_val = np.nanmin(self.single_matrix)
-            max_val = np.nanmax(self.single_matrix)
+            min_val, max_val = self.single_range = matrix_range(self.single_matrix)
             self.single_min.set(min_val)
             self.single_max.set(max_val)
             self.min_slider.config(from_=min_val, to=max_val)
@@ -922,10 +4387,168 @@ class MuadDataViewer:
         else:
             messagebox.showwarning("No Original", "No original matrix to reset to.")
 
+    def get_session_state(self):
+        """Return (state, matrices) describing everything needed to restore the current view."""
+        state = {'tab': self.tabs.index(self.tabs.select()),
+                 'pixel_size': self.pixel_size.get(),
+                 'scale_length': self.scale_length.get(),
+                 'nan_color': self.nan_color.get()}
+        matrices = {}
+        if self.single_matrix is not None:
+            modified = self.is_matrix_modified()
+            state['single'] = {
+                'file_name': self.single_file_name,
+                'colormap': self.single_colormap.get(),
+                'min': self.single_min.get(),
+                'max': self.single_max.get(),
+                'range': [float(v) for v in self.single_range],
+                'slider_to': float(self.max_slider.cget('to')),
+                'max_constraint': self.max_constraint.get(),
+                'show_colorbar': self.show_colorbar.get(),
+                'show_scalebar': self.show_scalebar.get(),
+                'view': list(self.single_view) if self.single_view else None,
+                'math_history': list(self.single_math_history),
+                'transform': self.single_transform.get(),
+                'transform_param': self.single_transform_param.get(),
+                'filter': self.single_filter.get(),
+                'filter_size': self.single_filter_size.get(),
+            }
+            matrices['single'] = (self.single_matrix, None if modified else self.single_source_path)
+            if modified and self.original_matrix is not None:
+                matrices['single_original'] = (self.original_matrix, self.single_source_path)
+
+        channels = {}
+        for ch in 'RGB':
+            if self.rgb_data[ch] is None:
+                continue
+            slider = self.rgb_sliders[ch]['max']
+            channels[ch] = {'element': self.channel_element(ch), 'max': float(slider.get()), 'slider_to': float(slider.cget('to'))}
+            matrices[ch] = (self.rgb_data[ch], self.rgb_sources[ch])
+        state['rgb'] = {'colors': dict(self.rgb_colors), 'normalize': self.normalize_var.get(),
+                        'register': self.register_channels.get(),
+                        'transform': self.rgb_transform.get(), 'transform_param': self.rgb_transform_param.get(),
+                        'filter': self.rgb_filter.get(), 'filter_size': self.rgb_filter_size.get(),
+                        'dataset': self.file_root_label.cget("text"), 'channels': channels}
+        if self.calibration is not None:
+            state['calibration'] = self.calibration.to_dict()
+        if self.shared_scaling is not None:
+            state['shared_scaling'] = self.shared_scaling
+        return state, matrices
+
+    def save_session(self):
+        """Save the loaded data and view state to a session file."""
+        if self.single_matrix is None and all(self.rgb_data[c] is None for c in 'RGB'):
+            messagebox.showwarning("No Data", "Nothing is loaded yet.")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=SESSION_EXTENSION,
+                                            filetypes=[("Muad'Data session", f"*{SESSION_EXTENSION}")])
+        if not path:
+            return
+        try:
+            state, matrices = self.get_session_state()
+            save_session_file(path, state, matrices)
+        except Exception as e:
+            messagebox.showerror("Save Error", f"Failed to save the session:\n{str(e)}")
+
+    def open_session(self):
+        """Restore a session file, loading its matrices from their binary files."""
+        path = filedialog.askopenfilename(filetypes=[("Muad'Data session", f"*{SESSION_EXTENSION}")])
+        if not path:
+            return
+        try:
+            state = load_session_file(path)
+            self.apply_session_state(state, path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open session:\n{str(e)}")
+
+    def apply_session_state(self, state, session_path):
+        self.pixel_size.set(state.get('pixel_size', 1))
+        if state.get('calibration'):
+            self.calibration = Calibration.from_dict(state['calibration'])
+        if state.get('shared_scaling'):
+            self.shared_scaling = state['shared_scaling']
+        self.scale_length.set(state.get('scale_length', 50))
+        self.nan_color.set(state.get('nan_color', 'As zero'))
+
+        # RGB Overlay
+        rgb = state.get('rgb', {})
+        for ch, color in rgb.get('colors', {}).items():
+            self.rgb_colors[ch] = color
+            self.rgb_color_buttons[ch].configure(bg=color)
+            self.draw_gradient(self.rgb_gradient_canvases[ch], color)
+        self.normalize_var.set(rgb.get('normalize', 0))
+        self.register_channels.set(rgb.get('register', 0))
+        self.rgb_transform.set(rgb.get('transform', 'Linear'))
+        self.rgb_transform_param.set(rgb.get('transform_param', 1.0))
+        self.rgb_filter.set(rgb.get('filter', 'None'))
+        self.rgb_filter_size.set(rgb.get('filter_size', 3))
+        channels = rgb.get('channels', {})
+        for ch in 'RGB':
+            info = channels.get(ch)
+            if info is None:
+                self.rgb_data[ch] = None
+                self.rgb_sources[ch] = None
+                self.rgb_labels[ch]['elem'].config(text="Loaded Element: None")
+                continue
+            self.rgb_data[ch] = resolve_session_matrix(state, ch, session_path)
+            self.rgb_sources[ch] = state['matrices'][ch]['source']
+            self.rgb_labels[ch]['elem'].config(text=f"Loaded Element: {info['element']}")
+            self.rgb_sliders[ch]['max'].config(from_=0, to=info['slider_to'])
+            self.rgb_sliders[ch]['max'].set(info['max'])
+        self.file_root_label.config(text=rgb.get('dataset', "Dataset: None"))
+        self.update_color_scale()
+
+        # Element Viewer
+        single = state.get('single')
+        if single is not None:
+            original = resolve_session_matrix(state, 'single_original', session_path)
+            try:
+                mat = resolve_session_matrix(state, 'single', session_path)
+            except FileNotFoundError:
+                # Rebuild a lost Map Math result from the original and its expressions
+                if original is None or not single['math_history']:
+                    raise
+                mat = original
+                for expression in single['math_history']:
+                    mat = self.evaluate_single_expression(mat, expression)
+            self.single_matrix = mat
+            self.original_matrix = original if original is not None else mat
+            ref = state['matrices']['single_original' if original is not None else 'single']
+            self.single_source_path = ref['source']
+            self.single_file_name = single['file_name']
+            self.single_math_history = list(single['math_history'])
+            self.single_view = tuple(single['view']) if single['view'] else None
+            # The saved range avoids a pass over the data
+            min_val, max_val = self.single_range = tuple(single['range'])
+            self.single_colormap.set(single['colormap'])
+            self.min_slider.config(from_=min_val, to=max_val)
+            self.max_slider.config(from_=min_val, to=single['slider_to'])
+            self.single_min.set(single['min'])
+            self.single_max.set(single['max'])
+            self.max_constraint.set(single['max_constraint'])
+            self.show_colorbar.set(single['show_colorbar'])
+            self.show_scalebar.set(single['show_scalebar'])
+            self.single_transform.set(single.get('transform', 'Linear'))
+            self.single_transform_param.set(single.get('transform_param', 1.0))
+            self.single_filter.set(single.get('filter', 'None'))
+            self.single_filter_size.set(single.get('filter_size', 3))
+            self.update_file_label()
+            self.view_single_map()
+            self.update_histogram()
+
+        self.tabs.select(state.get('tab', 0))
+        if channels:
+            self.root.after_idle(self.view_rgb_overlay)
+
     def is_matrix_modified(self):
         """Check if the current matrix has been modified from the original."""
         if self.original_matrix is None or self.single_matrix is None:
             return False
+        if self.single_matrix is self.original_matrix:
+            return False
+        if is_out_of_core(self.single_matrix) or is_out_of_core(self.original_matrix):
+            # Map Math on out-of-core maps always produces a new file
+            return self.single_matrix is not self.original_matrix
         return not np.array_equal(self.single_matrix, self.original_matrix)
     
     def update_file_label(self):
@@ -938,7 +4561,38 @@ class MuadDataViewer:
                 base_text += " (Modified)"
             self.single_file_label.config(text=base_text)
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='muaddata', description="Muad'Data elemental map viewer.")
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help="serve element maps as z/x/y PNG tiles over HTTP")
+    serve.add_argument('paths', nargs='+', help="matrix files or directories of them")
+    serve.add_argument('--host', default='127.0.0.1', help="address to listen on; use 0.0.0.0 to share on the lab network")
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--cache-mb', type=int, default=TILE_CACHE_BYTES // 1024 ** 2, help="memory for cached tiles")
+    serve.add_argument('--workers', type=int, default=None, help="tile rendering threads")
+    ingest = commands.add_parser('ingest', help="build element maps from raw time-resolved line exports")
+    ingest.add_argument('directory', help="directory with one raw export per laser line")
+    ingest.add_argument('--output', default=None, help="output directory (default: <directory>/maps)")
+    ingest.add_argument('--sample', default=None, help="sample name (default: the directory name)")
+    ingest.add_argument('--spot-size', type=float, required=True, help="spot size in micrometres")
+    ingest.add_argument('--scan-speed', type=float, required=True, help="scan speed in micrometres per second")
+    ingest.add_argument('--blank', type=float, default=15.0, help="gas blank at the start of each line, in seconds")
+    ingest.add_argument('--start', type=float, default=None, help="time the laser starts firing (default: end of the blank)")
+    ingest.add_argument('--pixels', type=int, default=None, help="pixels per line (default: longest line)")
+    ingest.add_argument('--workers', type=int, default=None, help="worker processes")
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        run_tile_server(args.paths, args.host, args.port, args.cache_mb, args.workers)
+        return
+    if args.command == 'ingest':
+        output_dir = args.output or os.path.join(args.directory, "maps")
+        outputs = ingest_line_scans(list_line_scan_files(args.directory), output_dir,
+                                    args.sample or os.path.basename(os.path.normpath(args.directory)),
+                                    args.spot_size, args.scan_speed, args.blank, args.start, args.pixels, args.workers,
+                                    progress=lambda done, total, msg: print(f"{done}/{total}: {msg}"))
+        print(f"{len(outputs)} map(s) written to {output_dir}")
+        return
+
     root = tk.Tk()
     root.geometry("1100x700")
     app = MuadDataViewer(root)
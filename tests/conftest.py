@@ -0,0 +1,23 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The core module sits next to muad_data_viewer.py at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import muad_data_core as core  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the binary cache of parsed spreadsheets out of the home directory."""
+    path = tmp_path / "cache"
+    monkeypatch.setattr(core, 'CACHE_DIR', str(path))
+    return path
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
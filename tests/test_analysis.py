@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import muad_data_core as core
+
+
+def test_value_sketch_percentiles_within_relative_accuracy(rng):
+    values = np.concatenate([rng.lognormal(0, 2, 20000), -rng.lognormal(1, 1, 5000), np.zeros(500), [np.nan] * 50])
+    sketch = core.ValueSketch()
+    sketch.add(values)
+    percentiles = [0, 1, 10, 25, 50, 75, 90, 99, 100]
+    exact = np.nanpercentile(values, percentiles)
+    approx = sketch.percentiles(percentiles)
+    assert sketch.count == len(values) - 50
+    assert approx[0] == exact[0] and approx[-1] == exact[-1]
+    # Sketch quantiles are the centre of a GAMMA-wide bucket, so within (GAMMA - 1) / 2 of a true neighbour
+    np.testing.assert_allclose(approx, exact, rtol=(core.ValueSketch.GAMMA - 1) / 2 + 1e-3, atol=1e-12)
+
+
+def test_value_sketch_merge_equals_single_sketch(rng):
+    values = rng.lognormal(3, 1, 10000)
+    whole = core.ValueSketch()
+    whole.add(values)
+    merged = core.ValueSketch()
+    for part in np.array_split(values, 7):
+        other = core.ValueSketch()
+        other.add(part)
+        merged.merge(other)
+    np.testing.assert_array_equal(merged.positive, whole.positive)
+    assert (merged.count, merged.min, merged.max) == (whole.count, whole.min, whole.max)
+    np.testing.assert_array_equal(merged.percentiles([5, 50, 95]), whole.percentiles([5, 50, 95]))
+
+
+def test_value_sketch_without_values():
+    assert np.isnan(core.ValueSketch().percentiles([50])).all()
+
+
+def reference_bin_line_scan(time, counts, pixel_time, blank_seconds, start_seconds, n_pixels):
+    background = np.nanmedian(counts[time < blank_seconds], axis=0)
+    pixels = np.full((n_pixels, counts.shape[1]), np.nan)
+    index = np.floor((time - start_seconds) / pixel_time)
+    for p in range(n_pixels):
+        inside = (time >= start_seconds) & (index == p)
+        for i in range(counts.shape[1]):
+            values = counts[inside, i]
+            values = values[~np.isnan(values)]
+            if len(values):
+                pixels[p, i] = values.mean()
+    return pixels - background
+
+
+def test_bin_line_scan_matches_a_per_pixel_loop(rng):
+    time = np.arange(0, 12, 0.13)
+    counts = rng.poisson(100, (len(time), 3)).astype(float)
+    counts[time >= 2, 1] += 5000
+    counts[rng.random(counts.shape) < 0.05] = np.nan
+    # A gap in the acquisition leaves a pixel without samples
+    keep = (time < 6) | (time > 7.2)
+    time, counts = time[keep], counts[keep]
+    result = core.bin_line_scan(time, counts, 0.5, 2.0, 2.3)
+    n_pixels = int(np.floor((time[-1] - 2.3) / 0.5)) + 1
+    expected = reference_bin_line_scan(time, counts, 0.5, 2.0, 2.3, n_pixels)
+    assert result.shape == (n_pixels, 3)
+    np.testing.assert_allclose(result, expected, equal_nan=True)
+    assert np.isnan(result).all(axis=1).any()
+
+
+def test_bin_line_scan_pads_to_n_pixels():
+    time = np.arange(0, 3, 0.1)
+    counts = np.ones((len(time), 1))
+    result = core.bin_line_scan(time, counts, 0.5, 1.0, 1.0, n_pixels=10)
+    assert result.shape == (10, 1)
+    np.testing.assert_allclose(result[:4], 0.0)
+    assert np.isnan(result[4:]).all()
+
+
+def test_object_statistics_match_per_object_numpy(rng):
+    mask = ndimage.binary_opening(rng.random((60, 80)) > 0.55)
+    labels, count = ndimage.label(mask)
+    zn = rng.lognormal(2, 1, labels.shape)
+    zn[rng.random(labels.shape) < 0.1] = np.nan
+    table = core.object_statistics(labels, count, {'Zn': zn}, pixel_size=2.0)
+    assert len(table) == count > 3
+    for _, row in table.iterrows():
+        rows, cols = np.nonzero(labels == row['object'])
+        values = zn[rows, cols]
+        assert row['area_px'] == len(rows)
+        assert row['area_um2'] == 4.0 * len(rows)
+        assert row['centroid_row'] == pytest.approx(rows.mean())
+        assert row['centroid_col'] == pytest.approx(cols.mean())
+        assert (row['row_min'], row['row_max'], row['col_min'], row['col_max']) == \
+            (rows.min(), rows.max(), cols.min(), cols.max())
+        assert row['Zn_sum'] == pytest.approx(np.nansum(values))
+        if np.isnan(values).all():
+            assert np.isnan(row['Zn_mean'])
+        else:
+            assert row['Zn_mean'] == pytest.approx(np.nanmean(values))
+            assert row['Zn_max'] == pytest.approx(np.nanmax(values))
+
+
+def test_object_statistics_without_objects():
+    table = core.object_statistics(np.zeros((5, 5), dtype=int), 0, {'Zn': np.ones((5, 5))})
+    assert len(table) == 0 and 'Zn_mean' in table
+
+
+def test_fit_calibration_recovers_an_exact_line():
+    signal = np.array([10.0, 200.0, 1500.0, 4000.0])
+    fit = core.fit_calibration(signal, 0.02 * signal + 1.5)
+    assert fit['slope'] == pytest.approx(0.02)
+    assert fit['intercept'] == pytest.approx(1.5)
+    assert fit['r2'] == pytest.approx(1.0)
+    assert fit['n'] == 4
+
+
+def test_fit_calibration_matches_polyfit(rng):
+    signal = np.array([50.0, 400.0, 2500.0, 9000.0, np.nan])
+    concentration = np.array([1.1, 7.7, 52.0, 181.0, 3.0])
+    slope, intercept = np.polyfit(signal[:4], concentration[:4], 1)
+    fit = core.fit_calibration(signal, concentration)
+    assert (fit['slope'], fit['intercept'], fit['n']) == (pytest.approx(slope), pytest.approx(intercept), 4)
+    # polyfit weights the residuals, so 1/c gives the 1/c^2 weighting of squared residuals
+    slope, intercept = np.polyfit(signal[:4], concentration[:4], 1, w=1 / concentration[:4])
+    fit = core.fit_calibration(signal, concentration, weighted=True)
+    assert (fit['slope'], fit['intercept']) == (pytest.approx(slope), pytest.approx(intercept))
+
+
+def test_fit_calibration_through_zero_and_errors():
+    signal, concentration = np.array([1.0, 2.0, 4.0]), np.array([2.1, 3.9, 8.2])
+    fit = core.fit_calibration(signal, concentration, through_zero=True)
+    assert fit['intercept'] == 0.0
+    assert fit['slope'] == pytest.approx((signal * concentration).sum() / (signal ** 2).sum())
+    assert core.fit_calibration([5.0], [10.0])['slope'] == pytest.approx(2.0)
+    with pytest.raises(ValueError):
+        core.fit_calibration([np.nan], [1.0])
+
+
+def textured_map(rng, shape=(200, 240)):
+    return ndimage.gaussian_filter(rng.random(shape), 3.0)
+
+
+def window(mat, dy=0, dx=0):
+    # Two windows of one larger map, dy rows and dx columns apart, so nothing wraps around
+    return mat[30 + dy:158 + dy, 30 + dx:190 + dx]
+
+
+@pytest.mark.parametrize('dy, dx', [(0, 0), (3, -5), (-7, 11)])
+def test_phase_correlation_recovers_integer_shift(rng, dy, dx):
+    texture = textured_map(rng)
+    # moving[r - dy, c - dx] == reference[r, c]
+    found_dy, found_dx, peak = core.phase_correlation(window(texture), window(texture, dy, dx))
+    assert (found_dy, found_dx) == (pytest.approx(dy, abs=0.05), pytest.approx(dx, abs=0.05))
+    assert peak > 0.3
+
+
+@pytest.mark.parametrize('dy, dx', [(2.5, -1.25), (-0.4, 3.7)])
+def test_phase_correlation_recovers_subpixel_shift(rng, dy, dx):
+    texture = textured_map(rng)
+    moving = window(ndimage.shift(texture, (-dy, -dx)))
+    found_dy, found_dx, _ = core.phase_correlation(window(texture), moving)
+    # Closer than the nearest whole pixel
+    assert (found_dy, found_dx) == (pytest.approx(dy, abs=0.2), pytest.approx(dx, abs=0.2))
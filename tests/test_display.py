@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import muad_data_core as core
+
+
+def test_global_equalization_maps_values_onto_their_rank(rng):
+    mat = rng.lognormal(1, 2, (120, 90))
+    mat[:3, :3] = np.nan
+    tiles = core.EqualizationTiles.from_matrix(mat)
+    out = tiles.equalize(mat)
+    values = mat[~np.isnan(mat)]
+    ranks = (np.argsort(np.argsort(values)) + 0.5) / len(values)
+    assert np.isnan(out[:3, :3]).all()
+    # Bin edges come from the sketch, so ranks are only known to a fraction of a bin
+    np.testing.assert_allclose(out[~np.isnan(mat)], ranks, atol=0.01)
+    forward, inverse = tiles.functions()
+    np.testing.assert_allclose(forward(mat), out, atol=1e-6)
+    np.testing.assert_allclose(inverse(forward(values)), values, rtol=1e-6)
+
+
+def test_equalization_of_memory_mapped_map_matches_in_memory(rng, tmp_path):
+    mat = rng.gamma(2.0, 50.0, (150, 110)).astype(np.float32)
+    np.save(tmp_path / "map.npy", mat)
+    mapped = np.load(tmp_path / "map.npy", mmap_mode='r')
+    in_memory = core.EqualizationTiles.from_matrix(mat)
+    tiled = core.EqualizationTiles.from_matrix(mapped, budget_bytes=4096)
+    assert tiled.positions is None
+    np.testing.assert_array_equal(tiled.counts, in_memory.counts)
+    for clip_limit in (None, 3.0):
+        np.testing.assert_allclose(tiled.equalize(mapped, clip_limit, budget_bytes=4096),
+                                   in_memory.equalize(mat, clip_limit), atol=1e-6)
+
+
+def test_clahe_stays_in_range_and_follows_local_contrast(rng):
+    # A dim left half and a bright right half: CLAHE spreads both over the full range
+    mat = np.hstack([rng.random((64, 64)), 100 + rng.random((64, 64))])
+    tiles = core.EqualizationTiles.from_matrix(mat, grid=2)
+    out = tiles.equalize(mat, clip_limit=tiles.BINS)
+    assert np.nanmin(out) >= 0 and np.nanmax(out) <= 1
+    glob = tiles.equalize(mat)
+    assert np.ptp(out[:, :16]) > 2 * np.ptp(glob[:, :16])
+    # Up to the first tile centres only one tile's mapping applies, and it keeps the order of values
+    order = np.argsort(mat[:16, :32], axis=None)
+    assert np.all(np.diff(out[:16, :32].ravel()[order]) >= -1e-6)
+
+
+def test_equalization_of_empty_map_fails():
+    with pytest.raises(ValueError):
+        core.EqualizationTiles.from_matrix(np.full((5, 5), np.nan))
+
+
+def composed(channels, shape):
+    total = np.zeros(shape + (3,), dtype=np.float64)
+    for scaled, weights in channels.values():
+        total += scaled[..., None] * np.asarray(weights)
+    return total
+
+
+def test_channel_composer_keeps_the_sum_of_contributions(rng):
+    shape = (20, 30)
+    composer = core.ChannelComposer()
+    composer.reset('grid', shape)
+    maps = {c: rng.random(shape).astype(np.float32) for c in 'RGB'}
+    current = {}
+    steps = [('R', maps['R'], (1, 0, 0)), ('G', maps['G'], (0, 1, 0)), ('B', maps['B'], (0, 0, 1)),
+             ('R', maps['R'], (1, 0.5, 0)),                     # colour only
+             ('G', maps['G'] * 0.5, (0, 1, 0)),                 # scaling only
+             ('B', maps['R'], (0.2, 0.2, 0.9)),                 # data and colour
+             ('G', None, None)]                                 # removed
+    for channel, scaled, weights in steps:
+        composer.update(channel, ('key', channel), scaled, weights)
+        if scaled is None:
+            current.pop(channel)
+        else:
+            current[channel] = (scaled, weights)
+        np.testing.assert_allclose(composer.total, composed(current, shape), atol=1e-5)
+    assert composer.key('R') == ('key', 'R') and composer.key('G') is None
+    expected = (np.clip(composed(current, shape), 0, 1) * 255 + 0.5).astype(np.uint8)
+    assert np.abs(composer.image().astype(int) - expected).max() <= 1
+
+
+def test_channel_composer_rebuilds_after_many_updates(rng):
+    shape = (8, 8)
+    composer = core.ChannelComposer()
+    composer.reset('grid', shape)
+    scaled = rng.random(shape).astype(np.float32)
+    for i in range(core.ChannelComposer.REBUILD_EVERY + 3):
+        composer.update('R', 'key', scaled, (np.sin(i) ** 2, 0.3, 0.0))
+    np.testing.assert_allclose(composer.total, composed({'R': (scaled, (np.sin(i) ** 2, 0.3, 0.0))}, shape),
+                               atol=1e-5)
+    # A new grid starts from an empty sum
+    composer.reset('other grid', (4, 4))
+    assert composer.channels == {} and not composer.total.any()
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+import muad_data_core as core
+
+ELEMENTS = ['Zn66', 'Ca44', 'Fe57']
+
+
+@pytest.fixture
+def maps(rng):
+    maps = {label: rng.lognormal(2, 1, (70, 45)) for label in ELEMENTS}
+    maps['Ca44'][0, :5] = 0.0
+    return maps
+
+
+def test_evaluate_matches_numpy(maps, tmp_path):
+    expression = core.MapExpression("np.maximum(Zn, Ca) / (Fe + 1) - np.sqrt(Zn) ** 2 + total", ELEMENTS)
+    zn, ca, fe = maps['Zn66'], maps['Ca44'], maps['Fe57']
+    expected = np.maximum(zn, ca) / (fe + 1) - np.sqrt(zn) ** 2 + (ca + fe + zn)
+    np.testing.assert_allclose(expression.evaluate(maps), expected, rtol=1e-12)
+    tiled = expression.evaluate(maps, out_path=str(tmp_path / "out.npy"), budget_bytes=4096)
+    np.testing.assert_allclose(tiled, expected, rtol=1e-12)
+
+
+def test_undefined_results_are_empty_cells(maps):
+    result = core.MapExpression("Zn / Ca", ELEMENTS).evaluate(maps)
+    assert np.isnan(result[0, :5]).all()
+    np.testing.assert_allclose(result[1:], maps['Zn66'][1:] / maps['Ca44'][1:])
+
+
+def test_common_subexpressions_share_one_node(maps):
+    expression = core.MapExpression("Zn/Ca + Zn66 / Ca44", ELEMENTS)
+    divide = np.true_divide.__name__  # 'divide' in recent NumPy
+    assert expression.key == f"add({divide}(Zn66, Ca44), {divide}(Zn66, Ca44))"
+    assert expression.nodes == [('map', 'Zn66'), ('map', 'Ca44'), ('call', divide, 0, 1), ('call', 'add', 2, 2)]
+    assert expression.inputs == ['Zn66', 'Ca44']
+    with np.errstate(divide='ignore'):
+        expected = 2 * maps['Zn66'] / maps['Ca44']
+    expected[~np.isfinite(expected)] = np.nan
+    np.testing.assert_allclose(expression.evaluate(maps), expected)
+    # The same expression written differently has the same key
+    assert core.MapExpression("(Zn66/Ca44) + (Zn/Ca)", ELEMENTS).key == expression.key
+
+
+@pytest.mark.parametrize('text, value', [("Zn * (2 + 3)", 5.0), ("np.sqrt(16) * Zn", 4.0),
+                                         ("Zn * np.maximum(2, 3) ** 2", 9.0), ("-(-2) * Zn", 2.0)])
+def test_constant_subexpressions_are_folded(maps, text, value):
+    expression = core.MapExpression(text, ELEMENTS)
+    calls = [node for node in expression.nodes if node[0] == 'call']
+    assert len(calls) == 1 and calls[0][1] == 'multiply'
+    assert ('const', value) in [expression.nodes[arg] for arg in calls[0][2:]]
+    np.testing.assert_allclose(expression.evaluate(maps), value * maps['Zn66'])
+
+
+def test_undefined_constants_give_empty_cells(maps):
+    expression = core.MapExpression("Zn + np.log(0)", ELEMENTS)
+    assert ('const', -np.inf) in expression.nodes
+    assert np.isnan(expression.evaluate(maps)).all()
+
+
+def test_expression_of_constants_alone_cannot_be_evaluated(maps):
+    expression = core.MapExpression("2 + 3", ELEMENTS)
+    assert expression.nodes[expression.root] == ('const', 5.0)
+    with pytest.raises(ValueError, match="does not use any element map"):
+        expression.evaluate(maps)
+
+
+@pytest.mark.parametrize('text, message', [
+    ("np.sqrt()", "np.sqrt takes 1 argument, not 0"),
+    ("np.sqrt(Zn, Ca)", "np.sqrt takes 1 argument, not 2"),
+    ("np.log10(Zn, 2)", "np.log10 takes 1 argument, not 2"),
+    ("np.minimum(Zn)", "np.minimum takes 2 arguments, not 1"),
+    ("np.maximum(Zn, Ca, Fe)", "np.maximum takes 2 arguments, not 3"),
+])
+def test_function_argument_counts_are_checked(text, message):
+    with pytest.raises(ValueError, match=message):
+        core.MapExpression(text, ELEMENTS)
+
+
+@pytest.mark.parametrize('text, message', [
+    ("np.sin(Zn)", "Unsupported expression"),
+    ("np.sqrt(x=Zn)", "Unsupported expression"),
+    ("Zn % Ca", "Unsupported expression"),
+    ("Zn / Pb", "no Pb map"),
+    ("Zn /", "Invalid expression"),
+])
+def test_invalid_expressions_are_rejected(text, message):
+    with pytest.raises(ValueError, match=message):
+        core.MapExpression(text, ELEMENTS)
+
+
+def test_total_needs_element_maps():
+    with pytest.raises(ValueError, match="no element maps"):
+        core.MapExpression("total", [])
+
+
+def test_maps_of_different_shapes_are_rejected(maps):
+    maps['Ca44'] = maps['Ca44'][:-1]
+    with pytest.raises(ValueError, match="different shapes"):
+        core.MapExpression("Zn / Ca", ELEMENTS).evaluate(maps)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+import muad_data_core as core
+
+
+def skewed_map(rng, shape=(157, 93)):
+    """Heavy-tailed values with empty cells, like a trace element map."""
+    mat = rng.lognormal(2.0, 1.5, shape)
+    mat[rng.random(shape) < 0.05] = np.nan
+    return mat
+
+
+def memmapped(tmp_path, mat, name="map.npy"):
+    path = tmp_path / name
+    np.save(path, mat)
+    return np.load(path, mmap_mode='r')
+
+
+@pytest.mark.parametrize('budget', [None, 1, 8 * 93, 8 * 93 * 10 + 5])
+def test_iter_tiles_covers_every_row_once(budget):
+    mat = np.zeros((157, 93))
+    bands = list(core.iter_tiles(mat, budget))
+    assert bands[0].start == 0 and bands[-1].stop == 157
+    assert all(a.stop == b.start for a, b in zip(bands, bands[1:]))
+    if budget:
+        # Each band fits the budget, but always holds at least one row
+        assert all((s.stop - s.start) * 93 * 8 <= max(budget, 93 * 8) for s in bands)
+
+
+def test_tiled_stats_matches_numpy(rng, tmp_path):
+    mat = skewed_map(rng)
+    stats = core.tiled_stats(memmapped(tmp_path, mat), budget_bytes=4096)
+    assert stats['count'] == np.count_nonzero(~np.isnan(mat))
+    assert stats['min'] == np.nanmin(mat)
+    assert stats['max'] == np.nanmax(mat)
+    assert stats['mean'] == pytest.approx(np.nanmean(mat))
+
+
+def test_tiled_stats_of_empty_map():
+    stats = core.tiled_stats(np.full((4, 4), np.nan))
+    assert stats['count'] == 0 and np.isnan(stats['mean'])
+
+
+def test_tiled_histogram_matches_numpy(rng, tmp_path):
+    mat = skewed_map(rng)
+    values = mat[~np.isnan(mat)]
+    hist, edges = core.tiled_histogram(memmapped(tmp_path, mat), bins=40, budget_bytes=4096)
+    ref_hist, ref_edges = np.histogram(values, bins=40)
+    np.testing.assert_allclose(edges, ref_edges)
+    np.testing.assert_array_equal(hist, ref_hist)
+
+
+def test_tiled_histogram_with_edges_and_range(rng):
+    mat = skewed_map(rng)
+    values = mat[~np.isnan(mat)]
+    edges = np.array([0.0, 1.0, 5.0, 20.0, 1000.0])
+    np.testing.assert_array_equal(core.tiled_histogram(mat, edges, budget_bytes=2048)[0],
+                                  np.histogram(values, edges)[0])
+    hist, ref = core.tiled_histogram(mat, 10, (0, 50))[0], np.histogram(values, 10, (0, 50))[0]
+    np.testing.assert_array_equal(hist, ref)
+
+
+PERCENTILES = [0, 0.1, 1, 25, 50, 62.5, 99, 99.9, 100]
+
+
+def test_tiled_percentiles_match_nanpercentile(rng, tmp_path):
+    mat = skewed_map(rng)
+    result = core.tiled_percentiles(memmapped(tmp_path, mat), PERCENTILES, budget_bytes=4096, bins=64)
+    np.testing.assert_allclose(result, np.nanpercentile(mat, PERCENTILES), rtol=1e-12)
+
+
+def test_tiled_and_in_memory_percentiles_agree(rng, tmp_path):
+    mat = skewed_map(rng, (400, 250)).astype(np.float32)
+    in_memory = core.tiled_percentiles(mat, PERCENTILES)
+    tiled = core.tiled_percentiles(memmapped(tmp_path, mat), PERCENTILES, budget_bytes=8 * 250 * 7)
+    np.testing.assert_array_equal(tiled, in_memory)
+    np.testing.assert_allclose(in_memory, np.nanpercentile(mat.astype(float), PERCENTILES), rtol=1e-12)
+
+
+def test_tiled_percentiles_with_ties_and_no_values():
+    mat = np.repeat(np.arange(5.0), 20).reshape(10, 10)
+    np.testing.assert_allclose(core.tiled_percentiles(mat, PERCENTILES, bins=3), np.percentile(mat, PERCENTILES))
+    assert np.isnan(core.tiled_percentiles(np.full((3, 3), np.nan), [50])).all()
@@ -0,0 +1,119 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import muad_data_core as core
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = core.LRUCache(max_bytes=250)
+    for key in 'abc':
+        cache.put(key, np.zeros(10))  # 80 bytes each
+    assert cache.get('a') is not None  # 'b' is now the oldest
+    cache.put('d', np.zeros(10))
+    assert 'b' not in cache and all(key in cache for key in 'acd')
+    assert cache.get('b') is None
+    assert cache.stats() == {'entries': 3, 'bytes': 240, 'budget': 250, 'hits': 1, 'misses': 1, 'evictions': 1}
+    assert len(cache) == 3
+
+
+def test_lru_cache_sizes_pop_and_resize(tmp_path):
+    np.save(tmp_path / "map.npy", np.zeros((100, 100)))
+    cache = core.LRUCache(max_bytes=1000)
+    # Memory-mapped values live on disk and cost nothing
+    cache.put('mapped', np.load(tmp_path / "map.npy", mmap_mode='r'))
+    assert cache.nbytes == 0
+    cache.put('png', b'x' * 300, nbytes=300)
+    cache.put('big', np.zeros(1000))  # over budget on its own, but the newest entry is kept
+    assert cache.keys() == ['big'] and cache.nbytes == 8000
+    assert cache.pop('big') is not None and cache.nbytes == 0
+    cache.put('a', np.zeros(50))
+    cache.put('b', np.zeros(50))
+    cache.resize(500)
+    assert cache.keys() == ['b'] and cache.stats()['evictions'] == 3
+
+
+@pytest.fixture
+def slow_loads(monkeypatch):
+    """Count the maps MatrixStore reads, and make every read take a while."""
+    calls = []
+    load = core.load_view_matrix
+
+    def slow(path, notes=None):
+        calls.append(path)
+        time.sleep(0.05)
+        return load(path, notes)
+
+    monkeypatch.setattr(core, 'load_view_matrix', slow)
+    return calls
+
+
+def test_matrix_store_loads_each_file_once(tmp_path, rng, slow_loads):
+    path = str(tmp_path / "S1 Zn66_ppm.npy")
+    np.save(path, rng.random((50, 40)))
+    store = core.MatrixStore()
+    with ThreadPoolExecutor(8) as executor:
+        mats = list(executor.map(lambda _: store.get(path), range(16)))
+    assert len(slow_loads) == 1
+    assert all(mat is mats[0] for mat in mats)
+    assert mats[0].dtype == np.float32 and not mats[0].flags.writeable
+    stats = store.stats()
+    assert (stats['matrices'], stats['bytes'], stats['reloads']) == (1, 50 * 40 * 4, 0)
+
+
+def test_matrix_store_counts_reloads_of_evicted_maps_only(tmp_path, rng, slow_loads):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"S{i} Zn66_ppm.npy"))
+        np.save(paths[-1], rng.random((50, 40)))
+    store = core.MatrixStore(max_bytes=2 * 50 * 40 * 4)
+    for path in paths + paths[:1]:
+        store.get(path)
+    assert store.stats()['reloads'] == 1 and store.stats()['evictions'] == 2
+    # A discarded file is read again because it changed, which is not a reload
+    store.discard(paths[0])
+    assert paths[0] not in {key[0] for key in store.cache.keys()}
+    store.get(paths[0])
+    assert store.stats()['reloads'] == 1 and len(slow_loads) == 5
+
+
+def test_matrix_store_shares_load_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / "S1 Zn66_ppm.npy")
+    np.save(path, np.zeros((3, 3)))
+
+    def failing(path, notes=None):
+        time.sleep(0.05)
+        raise ValueError("unreadable")
+
+    monkeypatch.setattr(core, 'load_view_matrix', failing)
+    store = core.MatrixStore()
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(store.get, path) for _ in range(4)]
+    assert all(isinstance(future.exception(), ValueError) for future in futures)
+    assert store._loading == {} and len(store.cache) == 0
+
+
+def test_matrix_store_remembers_maps_kept_in_double_precision(tmp_path):
+    path = str(tmp_path / "S1 Zn66_ppm.npy")
+    np.save(path, 1e6 + np.linspace(0, 1e-3, 12).reshape(3, 4))
+    store = core.MatrixStore()
+    assert store.get(path).dtype == np.float64
+    assert store.precision_loss(path)
+    store.discard(path)
+    assert store.precision_loss(path) is None
+
+
+def test_storage_choice(rng):
+    assert core.compact_matrix(rng.random((4, 4)))[0].dtype == np.float32
+    counts = np.full((4, 4), 2 ** 24 + 1, dtype=np.float64)
+    mat, reason = core.compact_matrix(counts)
+    assert mat.dtype == np.uint32 and reason is None
+    np.testing.assert_array_equal(mat, counts)
+    assert core.compact_matrix(-counts)[0].dtype == np.int32
+    counts[0, 0] = np.nan
+    mat, reason = core.compact_matrix(counts)
+    assert mat.dtype == np.float64 and 'empty cells' in reason
+    assert core.working_dtype(np.zeros(1, np.float32), np.zeros(1, np.float32)) == np.float32
+    assert core.working_dtype(np.zeros(1, np.float32), np.zeros(1, np.uint32)) == np.float64
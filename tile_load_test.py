@@ -0,0 +1,71 @@
+# Load test for the Muad'Data tile server (python muad_data_viewer.py serve ...)
+import argparse
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+def tile_urls(base, info, count, colormaps, seed=0):
+    """Random tile URLs spread over every zoom level of the served maps."""
+    rng = random.Random(seed)
+    urls = []
+    for _ in range(count):
+        m = rng.choice(info)
+        z = rng.randrange(m['zoom_levels'])
+        scale = 2 ** (m['zoom_levels'] - 1 - z)
+        rows = -(-m['shape'][0] // scale)
+        cols = -(-m['shape'][1] // scale)
+        x = rng.randrange(-(-cols // m['tile_size']))
+        y = rng.randrange(-(-rows // m['tile_size']))
+        urls.append(f"{base}/tiles/{quote(m['name'])}/{z}/{x}/{y}.png?cmap={rng.choice(colormaps)}")
+    return urls
+
+def fetch(url):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - start, status
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure tile throughput and latency of a running tile server.")
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--colormaps', default='viridis,magma,gray',
+                        help="comma-separated colormaps to request; more colormaps mean fewer cache hits")
+    args = parser.parse_args()
+
+    base = args.url.rstrip('/')
+    with urllib.request.urlopen(base + '/maps') as response:
+        info = json.load(response)
+    if not info:
+        raise SystemExit("The server has no maps loaded.")
+    urls = tile_urls(base, info, args.requests, args.colormaps.split(','))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(fetch, urls))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, status in results if status != 200)
+
+    def percentile(p):
+        return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] * 1000
+
+    with urllib.request.urlopen(base + '/stats') as response:
+        stats = json.load(response)
+    print(f"{len(results)} tiles in {elapsed:.2f} s with {args.concurrency} clients, {failures} failed")
+    print(f"Throughput: {len(results) / elapsed:.1f} tiles/s")
+    print(f"Latency: p50 {percentile(50):.1f} ms, p99 {percentile(99):.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+    print(f"Server cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, {stats['cache_evictions']} evictions")
+
+if __name__ == '__main__':
+    main()